@@ -0,0 +1,145 @@
+"""
+Compares the InfluxDB and MongoDB result transformations to what they were before they used column index maps, on
+wide series and wide/deep documents.
+
+Usage: python -m benchmarks.result_transforms [rows] [columns]
+"""
+import random
+import sys
+import time
+
+from redash.query_runner import TYPE_STRING
+from redash.query_runner.influx_db import _transform_rows
+from redash.query_runner.mongodb import TYPES_MAP, parse_results
+
+
+class InfluxResult(object):
+    def __init__(self, raw):
+        self.raw = raw
+
+
+def legacy_influx_transform(results):
+    """influx_db._transform_result as it was, without the JSON encoding."""
+    result_columns = []
+    result_rows = []
+
+    for result in results:
+        for series in result.raw.get('series', []):
+            for column in series['columns']:
+                if column not in result_columns:
+                    result_columns.append(column)
+            tags = series.get('tags', {})
+            for key in tags.keys():
+                if key not in result_columns:
+                    result_columns.append(key)
+
+    for result in results:
+        for series in result.raw.get('series', []):
+            for point in series['values']:
+                result_row = {}
+                for column in result_columns:
+                    tags = series.get('tags', {})
+                    if column in tags:
+                        result_row[column] = tags[column]
+                    elif column in series['columns']:
+                        index = series['columns'].index(column)
+                        value = point[index]
+                        result_row[column] = value
+                result_rows.append(result_row)
+
+    return [{'name': c} for c in result_columns], result_rows
+
+
+def _legacy_get_column_by_name(columns, column_name):
+    for c in columns:
+        if "name" in c and c["name"] == column_name:
+            return c
+
+    return None
+
+
+def legacy_mongodb_parse_results(results):
+    """mongodb.parse_results as it was."""
+    rows = []
+    columns = []
+
+    for row in results:
+        parsed_row = {}
+
+        for key in row:
+            if isinstance(row[key], dict):
+                for inner_key in row[key]:
+                    column_name = u'{}.{}'.format(key, inner_key)
+                    if _legacy_get_column_by_name(columns, column_name) is None:
+                        columns.append({
+                            "name": column_name,
+                            "friendly_name": column_name,
+                            "type": TYPES_MAP.get(type(row[key][inner_key]), TYPE_STRING)
+                        })
+
+                    parsed_row[column_name] = row[key][inner_key]
+
+            else:
+                if _legacy_get_column_by_name(columns, key) is None:
+                    columns.append({
+                        "name": key,
+                        "friendly_name": key,
+                        "type": TYPES_MAP.get(type(row[key]), TYPE_STRING)
+                    })
+
+                parsed_row[key] = row[key]
+
+        rows.append(parsed_row)
+
+    return rows, columns
+
+
+def influx_results(rows, columns):
+    """Wide series: `columns` fields, split over a few series with their own tags."""
+    names = ['time'] + ['field_{}'.format(i) for i in xrange(columns - 1)]
+    series = []
+    for host in ('a', 'b', 'c', 'd'):
+        values = [[i] + [random.random() for _ in xrange(columns - 1)] for i in xrange(rows // 4)]
+        series.append({'name': 'cpu', 'columns': names, 'tags': {'host': host}, 'values': values})
+    return [InfluxResult({'series': series})]
+
+
+def wide_documents(rows, columns):
+    return [{'field_{}'.format(i): random.random() for i in xrange(columns)} for _ in xrange(rows)]
+
+
+def deep_documents(rows, columns):
+    """Documents of sub-documents, which are flattened into <key>.<inner key> columns."""
+    groups = max(columns // 10, 1)
+    return [{'group_{}'.format(g): {'field_{}'.format(i): random.randint(0, 100) for i in xrange(10)}
+             for g in xrange(groups)}
+            for _ in xrange(rows)]
+
+
+def measure(function, data):
+    started = time.time()
+    result = function(data)
+    return result, time.time() - started
+
+
+def main(rows, columns):
+    print "{} rows, {} columns".format(rows, columns)
+    print "{:<22} {:>12} {:>12} {:>9}".format('case', 'before', 'after', 'speedup')
+
+    cases = [
+        ('influxdb wide series', influx_results(rows, columns), legacy_influx_transform, _transform_rows),
+        ('mongodb wide docs', wide_documents(rows, columns), legacy_mongodb_parse_results, parse_results),
+        ('mongodb deep docs', deep_documents(rows, columns), legacy_mongodb_parse_results, parse_results),
+    ]
+
+    for name, data, legacy, current in cases:
+        legacy_result, legacy_time = measure(legacy, data)
+        result, current_time = measure(current, data)
+        assert legacy_result == result, name
+        print "{:<22} {:>11.3f}s {:>11.3f}s {:>8.1f}x".format(name, legacy_time, current_time,
+                                                            legacy_time / max(current_time, 1e-6))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 200)
@@ -0,0 +1,93 @@
+"""
+Compares column type inference with ColumnTypeGuesser to guessing every cell with the previous guess_type.
+
+Usage: python -m benchmarks.type_inference [rows]
+"""
+import datetime
+import random
+import sys
+import time
+
+from dateutil import parser
+
+from redash.query_runner import (TYPE_BOOLEAN, TYPE_DATETIME, TYPE_FLOAT, TYPE_INTEGER, TYPE_STRING,
+                                 ColumnTypeGuesser, get_column_type_from_set, numpy)
+
+
+def legacy_guess_type(string_value):
+    """guess_type as it was before column type inference."""
+    if string_value == '' or string_value is None:
+        return TYPE_STRING
+
+    if type(string_value) == unicode:
+        string_value = string_value.encode('utf-8')
+
+    if type(string_value) != str:
+        string_value = str(string_value)
+
+    try:
+        val = float(string_value)
+        if val.is_integer():
+            return TYPE_INTEGER
+
+        return TYPE_FLOAT
+    except (ValueError, OverflowError):
+        pass
+
+    if string_value.lower() in ('true', 'false'):
+        return TYPE_BOOLEAN
+
+    try:
+        parser.parse(string_value)
+        return TYPE_DATETIME
+    except (ValueError, OverflowError):
+        pass
+
+    return TYPE_STRING
+
+
+def legacy_column_type(values):
+    return get_column_type_from_set(set(legacy_guess_type(value) for value in values))
+
+
+def columns(rows):
+    words = ['alpha', 'beta', 'gamma', 'delta', 'epsilon', 'zeta', 'eta', 'theta']
+    start = datetime.datetime(2019, 1, 1)
+    return {
+        'integers': [str(random.randint(-10 ** 6, 10 ** 6)) for _ in xrange(rows)],
+        'floats': [str(random.random() * 1000) for _ in xrange(rows)],
+        'typed floats': [random.random() * 1000 for _ in xrange(rows)],
+        'iso datetimes': [(start + datetime.timedelta(seconds=random.randint(0, 10 ** 8))).isoformat()
+                          for _ in xrange(rows)],
+        'text': [u' '.join(random.sample(words, 3)) for _ in xrange(rows)],
+        'numbers then text': [str(i) for i in xrange(rows // 2)] + [u'n/a'] * (rows - rows // 2),
+    }
+
+
+def measure(function, values):
+    started = time.time()
+    result = function(values)
+    return result, time.time() - started
+
+
+def guess_with_guesser(values):
+    guesser = ColumnTypeGuesser(sample_size=0)
+    for i in xrange(0, len(values), 1000):
+        guesser.update(values[i:i + 1000])
+    return guesser.type
+
+
+def main(rows):
+    print "{} rows per column, NumPy {}".format(rows, 'available' if numpy is not None else 'not installed')
+    print "{:<20} {:>10} {:>12} {:>12} {:>9}".format('column', 'type', 'guess_type', 'guesser', 'speedup')
+
+    for name, values in sorted(columns(rows).items()):
+        legacy_type, legacy_time = measure(legacy_column_type, values)
+        new_type, new_time = measure(guess_with_guesser, values)
+        assert legacy_type == new_type, (name, legacy_type, new_type)
+        print "{:<20} {:>10} {:>11.3f}s {:>11.3f}s {:>8.1f}x".format(name, new_type, legacy_time, new_time,
+                                                                   legacy_time / max(new_time, 1e-6))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
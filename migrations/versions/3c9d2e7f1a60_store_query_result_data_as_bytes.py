@@ -0,0 +1,32 @@
+"""Store query result data as bytes
+
+Revision ID: 3c9d2e7f1a60
+Revises: 245a77dd4aea
+Create Date: 2026-10-18 10:12:31.402113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c9d2e7f1a60'
+down_revision = '245a77dd4aea'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.alter_column('query_results', 'data',
+                    type_=sa.LargeBinary(),
+                    postgresql_using="convert_to(data, 'UTF8')")
+
+
+def downgrade():
+    # Columnar payloads can't be represented as text, so those results are dropped.
+    op.execute("UPDATE queries SET latest_query_data_id = NULL WHERE latest_query_data_id IN "
+               "(SELECT id FROM query_results WHERE substring(data from 1 for 5) = 'RDCOL'::bytea)")
+    op.execute("DELETE FROM query_results WHERE substring(data from 1 for 5) = 'RDCOL'::bytea")
+    op.alter_column('query_results', 'data',
+                    type_=sa.Text(),
+                    postgresql_using="convert_from(data, 'UTF8')")
@@ -0,0 +1,30 @@
+"""Add query result data location
+
+Revision ID: 8a4f6b1d2c95
+Revises: 3c9d2e7f1a60
+Create Date: 2026-10-18 11:03:47.518220
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a4f6b1d2c95'
+down_revision = '3c9d2e7f1a60'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('query_results', sa.Column('data_location', sa.String(length=255), nullable=True))
+    op.add_column('query_results', sa.Column('data_size', sa.Integer(), nullable=True))
+    op.add_column('query_results', sa.Column('data_checksum', sa.String(length=64), nullable=True))
+    op.alter_column('query_results', 'data', nullable=True)
+
+
+def downgrade():
+    op.alter_column('query_results', 'data', nullable=False)
+    op.drop_column('query_results', 'data_checksum')
+    op.drop_column('query_results', 'data_size')
+    op.drop_column('query_results', 'data_location')
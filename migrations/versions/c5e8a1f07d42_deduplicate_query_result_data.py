@@ -0,0 +1,35 @@
+"""Deduplicate query result data
+
+Revision ID: c5e8a1f07d42
+Revises: 8a4f6b1d2c95
+Create Date: 2026-10-18 12:20:05.871943
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5e8a1f07d42'
+down_revision = '8a4f6b1d2c95'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('query_results', sa.Column('data_ref_id', sa.Integer(), nullable=True))
+    op.create_foreign_key('query_results_data_ref_id_fkey', 'query_results', 'query_results', ['data_ref_id'], ['id'])
+    op.create_index(op.f('ix_query_results_data_ref_id'), 'query_results', ['data_ref_id'], unique=False)
+    op.create_index(op.f('ix_query_results_data_checksum'), 'query_results', ['data_checksum'], unique=False)
+    op.create_index(op.f('ix_query_results_data_location'), 'query_results', ['data_location'], unique=False)
+
+
+def downgrade():
+    # Copy shared payloads back before dropping the references.
+    op.execute("UPDATE query_results SET data = ref.data FROM query_results ref "
+               "WHERE query_results.data_ref_id = ref.id")
+    op.drop_index(op.f('ix_query_results_data_location'), table_name='query_results')
+    op.drop_index(op.f('ix_query_results_data_ref_id'), table_name='query_results')
+    op.drop_index(op.f('ix_query_results_data_checksum'), table_name='query_results')
+    op.drop_constraint('query_results_data_ref_id_fkey', 'query_results', type_='foreignkey')
+    op.drop_column('query_results', 'data_ref_id')
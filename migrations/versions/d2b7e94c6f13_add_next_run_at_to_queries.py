@@ -0,0 +1,58 @@
+"""Add next_run_at to queries
+
+Revision ID: d2b7e94c6f13
+Revises: c5e8a1f07d42
+Create Date: 2026-10-18 13:02:44.190532
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.sql import table
+
+from redash.models import MutableDict, PseudoJSON, next_scheduled_run
+from redash.utils import utcnow
+
+
+# revision identifiers, used by Alembic.
+revision = 'd2b7e94c6f13'
+down_revision = 'c5e8a1f07d42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('queries', sa.Column('next_run_at', sa.DateTime(True), nullable=True))
+    op.create_index(op.f('ix_queries_next_run_at'), 'queries', ['next_run_at'], unique=False)
+
+    queries = table(
+        'queries',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('schedule', MutableDict.as_mutable(PseudoJSON)),
+        sa.Column('schedule_failures', sa.Integer),
+        sa.Column('latest_query_data_id', sa.Integer),
+        sa.Column('next_run_at', sa.DateTime(True)))
+    query_results = table(
+        'query_results',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('retrieved_at', sa.DateTime(True)))
+
+    now = utcnow()
+    conn = op.get_bind()
+    scheduled_queries = conn.execute(
+        sa.select([queries.c.id, queries.c.schedule, queries.c.schedule_failures, query_results.c.retrieved_at])
+        .select_from(queries.outerjoin(query_results, queries.c.latest_query_data_id == query_results.c.id))
+        .where(queries.c.schedule.isnot(None)))
+
+    for query in scheduled_queries.fetchall():
+        next_run_at = next_scheduled_run(query.schedule, query.retrieved_at or now, query.schedule_failures)
+        if next_run_at is not None:
+            conn.execute(
+                queries
+                .update()
+                .where(queries.c.id == query.id)
+                .values(next_run_at=next_run_at))
+
+
+def downgrade():
+    op.drop_index(op.f('ix_queries_next_run_at'), table_name='queries')
+    op.drop_column('queries', 'next_run_at')
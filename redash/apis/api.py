@@ -46,6 +46,7 @@ from redash.apis.handlers.queries import (MyQueriesResource, QueryArchiveResourc
 from redash.apis.handlers.query_results import (JobResource,
                                                 QueryResultDropdownResource,
                                                 QueryDropdownsResource,
+                                                QueryExportResource,
                                                 QueryResultListResource,
                                                 QueryResultResource)
 from redash.apis.handlers.query_snippets import (QuerySnippetListResource,
@@ -153,6 +154,7 @@ api.add_resource(QueryResultResource,
                  '/api/queries/<query_id>/results.<filetype>',
                  '/api/queries/<query_id>/results/<query_result_id>.<filetype>',
                  endpoint='query_result')
+api.add_resource(QueryExportResource, '/api/queries/<query_id>/export.csv', endpoint='query_export')
 api.add_resource(JobResource,
                  '/api/jobs/<job_id>',
                  '/api/queries/<query_id>/jobs/<job_id>',
@@ -1,4 +1,5 @@
-from flask import make_response, request
+from celery.utils import uuid
+from flask import Response, make_response, request, stream_with_context
 from flask_login import current_user
 from flask_restful import abort
 
@@ -9,9 +10,10 @@ from redash.apis.handlers.base import BaseResource, get_object_or_404
 from redash.models.parameterized_query import ParameterizedQuery, InvalidParameterError, dropdown_values
 from redash.permissions import (has_access, not_view_only, require_access,is_admin_or_owner,
                                 require_permission, view_only)
+from redash.query_runner import NotSupported
 from redash.tasks import QueryTask
-from redash.tasks.queries import enqueue_query
-from redash.utils import (collect_parameters_from_request, json_dumps, to_filename)
+from redash.tasks.queries import QueryAdmission, enqueue_query
+from redash.utils import (arrow_export, collect_parameters_from_request, json_dumps, to_filename, utcnow)
 
 logger = logging.getLogger(__name__)
 
@@ -51,6 +53,35 @@ def run_query(query, parameters, data_source, query_id, max_age=0):
         return {'job': job.to_dict()}
 
 
+def parse_result_slice_arguments(args):
+    """
+    Reads the `offset`, `limit`, `columns` and `order_by` query string arguments used to fetch only part of a
+    query result. `columns` and `order_by` are comma separated column names; prefix an `order_by` column with `-`
+    to sort in descending order.
+    """
+    try:
+        offset = int(args.get('offset', 0))
+        limit = int(args['limit']) if args.get('limit') else None
+    except ValueError:
+        abort(400, message='offset and limit must be integers.')
+
+    if offset < 0 or (limit is not None and limit < 0):
+        abort(400, message='offset and limit must not be negative.')
+
+    # An empty `columns` means all of them, like leaving it out.
+    columns = [name.strip() for name in args.get('columns', '').split(',') if name.strip()] or None
+
+    order_by = []
+    for name in args.get('order_by', '').split(','):
+        name = name.strip()
+        if name.startswith('-'):
+            order_by.append((name[1:], True))
+        elif name:
+            order_by.append((name, False))
+
+    return {'columns': columns, 'offset': offset, 'limit': limit, 'order_by': order_by}
+
+
 def get_download_filename(query_result, query, filetype):
     retrieved_at = query_result.retrieved_at.strftime("%Y_%m_%d")
     if query:
@@ -171,7 +202,15 @@ class QueryResultResource(BaseResource):
 
         :param number query_id: The ID of the query whose results should be fetched
         :param number query_result_id: the ID of the query result to fetch
-        :param string filetype: Format to return. One of 'json', 'xlsx', or 'csv'. Defaults to 'json'.
+        :param string filetype: Format to return. One of 'json', 'xlsx', 'csv', 'parquet' or 'arrow' (Arrow IPC
+                                file). Defaults to 'json'.
+        :qparam number offset: (json only) Number of rows to skip
+        :qparam number limit: (json only) Maximum number of rows to return
+        :qparam string columns: (json only) Comma separated names of the columns to return
+        :qparam string order_by: (json only) Comma separated names of columns to sort rows by, `-` prefixed for
+                                 descending order
+
+        The returned data includes `total_rows`, the number of rows of the whole result.
 
         :<json number id: Query result ID
         :<json string query: Query that produced this result
@@ -239,6 +278,10 @@ class QueryResultResource(BaseResource):
                 response = self.make_json_response(query_result)
             elif filetype == 'xlsx':
                 response = self.make_excel_response(query_result)
+            elif filetype in ('parquet', 'arrow'):
+                if not arrow_export.enabled:
+                    abort(400, message='{} downloads require pyarrow, which is not installed.'.format(filetype))
+                response = self.make_arrow_response(query_result, filetype)
             else:
                 response = self.make_csv_response(query_result)
 
@@ -258,19 +301,100 @@ class QueryResultResource(BaseResource):
             abort(404, message='No cached result found for this query.')
 
     def make_json_response(self, query_result):
-        data = json_dumps({'query_result': query_result.to_dict()})
+        data = json_dumps({'query_result': query_result.to_dict(**parse_result_slice_arguments(request.args))})
         headers = {'Content-Type': "application/json"}
         return make_response(data, 200, headers)
 
     @staticmethod
     def make_csv_response(query_result):
         headers = {'Content-Type': "text/csv; charset=UTF-8"}
-        return make_response(query_result.make_csv_content(), 200, headers)
+        return Response(stream_with_context(query_result.iter_csv_content()), 200, headers)
 
     @staticmethod
     def make_excel_response(query_result):
         headers = {'Content-Type': "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"}
-        return make_response(query_result.make_excel_content(), 200, headers)
+        return Response(stream_with_context(query_result.iter_excel_content()), 200, headers)
+
+    @staticmethod
+    def make_arrow_response(query_result, filetype):
+        if filetype == 'parquet':
+            headers = {'Content-Type': "application/vnd.apache.parquet"}
+            content = query_result.iter_parquet_content()
+        else:
+            headers = {'Content-Type': "application/vnd.apache.arrow.file"}
+            content = query_result.iter_arrow_content()
+        return Response(stream_with_context(content), 200, headers)
+
+
+class QueryExportResource(BaseResource):
+    def get(self, query_id):
+        """
+        Execute a saved query and stream its results as CSV, produced by the data source itself (e.g. with
+        PostgreSQL's COPY). Meant for bulk extracts: rows aren't converted in Python and no query result is stored.
+
+        :param number query_id: The ID of the query to export
+        :qparam string p_<name>: Value of the query's parameter <name>
+        """
+        query = get_object_or_404(models.Query.get_by_id_and_org, query_id, self.current_org)
+        data_source = query.data_source
+
+        if not self.current_user.is_api_user() and not is_admin_or_owner(query.user_id):
+            if models.QueryGroup.get_by_query_groups(query, query.query_groups).first() is None:
+                abort(403, message='You do not have permission to run queries with this data source.')
+
+        if data_source.paused:
+            abort(400, message='{} is paused. Please try later.'.format(data_source.name))
+
+        parameterized = query.parameterized
+        try:
+            parameterized.apply(collect_parameters_from_request(request.args))
+        except InvalidParameterError as e:
+            abort(400, message=e.message)
+
+        if parameterized.missing_params:
+            abort(400, message=u'Missing parameter value for: {}'.format(u", ".join(parameterized.missing_params)))
+
+        self.record_event({
+            'action': 'export_query',
+            'object_id': query.id,
+            'object_type': 'query',
+        })
+
+        admission = QueryAdmission(uuid(), data_source, settings.QUERY_EXPORT_TIME_LIMIT)
+        countdown = admission.acquire()
+        if countdown is not None:
+            admission.withdraw()
+            response = make_response(json_dumps({'message': 'Too many queries are running on this data source.'}),
+                                     429, {'Content-Type': 'application/json'})
+            response.headers.add_header('Retry-After', str(countdown))
+            return response
+
+        try:
+            content, error = data_source.query_runner.export_csv(parameterized.text, self.current_user)
+        except NotSupported:
+            content, error = None, 'Direct exports are not supported by {} data sources.'.format(data_source.type)
+        except Exception:
+            admission.release()
+            raise
+
+        if error is not None:
+            admission.release()
+            abort(400, message=error)
+
+        def release_when_done(content):
+            try:
+                for chunk in content:
+                    yield chunk
+            finally:
+                content.close()
+                admission.release()
+
+        filename = u"{}_{}.csv".format(to_filename(query.name) if query.name != '' else str(query.id),
+                                       utcnow().strftime("%Y_%m_%d"))
+        headers = {'Content-Type': "text/csv; charset=UTF-8"}
+        response = Response(stream_with_context(release_when_done(content)), 200, headers)
+        response.headers.add_header("Content-Disposition", 'attachment; filename="{}"'.format(filename.encode("utf-8")))
+        return response
 
 
 class JobResource(BaseResource):
@@ -27,12 +27,14 @@ def create_app():
     from .destinations import import_destinations
     from .models import db, users
     from .query_runner import import_query_runners
+    from .result_storage import import_result_storages
 
     app = Redash()
 
-    # Load query runners and destinations
+    # Load query runners, destinations and result storages
     import_query_runners(settings.QUERY_RUNNERS)
     import_destinations(settings.DESTINATIONS)
+    import_result_storages(settings.RESULT_STORAGES)
 
     security.init_app(app)
     db.init_app(app)
@@ -2,36 +2,39 @@ import cStringIO
 import calendar
 import csv
 import datetime
+import hashlib
 import logging
-import time
+import tempfile
 
 import pytz
 import xlsxwriter
 from six import python_2_unicode_compatible, text_type
-from sqlalchemy import distinct, or_, and_, UniqueConstraint
+from sqlalchemy import distinct, exists, or_, and_, UniqueConstraint
 from sqlalchemy import func
 from sqlalchemy.dialects import postgresql
 from sqlalchemy.event import listens_for
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.orm import backref, contains_eager, joinedload, subqueryload, load_only
+from sqlalchemy.orm import aliased, backref, contains_eager, joinedload, subqueryload, load_only
 from sqlalchemy_utils import generic_relationship
 from sqlalchemy_utils.models import generic_repr
 from sqlalchemy_utils.types import TSVectorType
 from sqlalchemy_utils.types.encrypted.encrypted_type import FernetEngine
 
-from redash import redis_connection, utils, settings
+from redash import redis_connection, result_storage, utils, settings
 from redash.destinations import (get_configuration_schema_for_destination_type,
                                  get_destination)
 from redash.models.parameterized_query import ParameterizedQuery
 from redash.query_runner import (get_configuration_schema_for_query_runner_type,
-                                 get_query_runner)
+                                 get_query_runner, iter_batches)
 from redash.utils import generate_token, json_dumps, json_loads
+from redash.utils import arrow_export
+from redash.utils.columnar import ColumnarReader, is_columnar
 from redash.utils.configuration import ConfigurationContainer
 from .base import db, gfk_type, Column, GFKBase, SearchBaseQuery
 from .changes import ChangeTrackingMixin, Change  # noqa
 from .mixins import BelongsToOrgMixin, TimestampMixin
 from .organizations import Organization
-from .types import EncryptedConfiguration, Configuration, MutableDict, MutableList, PseudoJSON
+from .types import EncryptedConfiguration, Configuration, MutableDict, MutableList, PseudoJSON, ResultData
 from .users import (AccessPermission, AnonymousUser, ApiUser, Group, User)  # noqa
 from redash.permissions import (can_modify, require_admin_or_owner,
                                 require_object_modify_permission,has_permission,
@@ -40,31 +43,6 @@ from redash.permissions import (can_modify, require_admin_or_owner,
 logger = logging.getLogger(__name__)
 
 
-class ScheduledQueriesExecutions(object):
-    KEY_NAME = 'sq:executed_at'
-
-    def __init__(self):
-        self.executions = {}
-
-    def refresh(self):
-        self.executions = redis_connection.hgetall(self.KEY_NAME)
-
-    def update(self, query_id):
-        redis_connection.hmset(self.KEY_NAME, {
-            query_id: time.time()
-        })
-
-    def get(self, query_id):
-        timestamp = self.executions.get(str(query_id))
-        if timestamp:
-            timestamp = utils.dt_from_timestamp(timestamp)
-
-        return timestamp
-
-
-scheduled_queries_executions = ScheduledQueriesExecutions()
-
-
 @python_2_unicode_compatible
 @generic_repr('id', 'name', 'type', 'org_id', 'created_at', 'folder_id')
 class DataSource(BelongsToOrgMixin, db.Model):
@@ -143,9 +121,13 @@ class DataSource(BelongsToOrgMixin, db.Model):
 
     def delete(self):
         Query.query.filter(Query.data_source == self).update(dict(data_source_id=None, latest_query_data_id=None))
-        QueryResult.query.filter(QueryResult.data_source == self).delete()
+        query_results = QueryResult.query.filter(QueryResult.data_source == self)
+        data_locations = [location for location, in query_results.with_entities(QueryResult.data_location).filter(
+            QueryResult.data_location.isnot(None))]
+        query_results.delete()
         res = db.session.delete(self)
         db.session.commit()
+        QueryResult.delete_stored_data(data_locations)
         return res
 
     def get_schema(self, refresh=False, prefix=None):
@@ -204,7 +186,7 @@ class DataSource(BelongsToOrgMixin, db.Model):
 
     @property
     def query_runner(self):
-        return get_query_runner(self.type, self.options)
+        return get_query_runner(self.type, self.options, self.id)
 
     @classmethod
     def get_by_name(cls, name):
@@ -246,7 +228,14 @@ class QueryResult(db.Model, BelongsToOrgMixin):
     data_source = db.relationship(DataSource, backref=backref('query_results'))
     query_hash = Column(db.String(32), index=True)
     query_text = Column('query', db.Text)
-    data = Column(db.Text)
+    data = Column(ResultData, nullable=True)
+    # Set when the payload lives in a result storage backend instead of the data column.
+    data_location = Column(db.String(255), nullable=True, index=True)
+    data_size = Column(db.Integer, nullable=True)
+    data_checksum = Column(db.String(64), nullable=True, index=True)
+    # Set when the payload is the same as the one stored in another query result's data column.
+    data_ref_id = Column(db.Integer, db.ForeignKey('query_results.id'), nullable=True, index=True)
+    data_ref = db.relationship('QueryResult', remote_side=[id])
     runtime = Column(postgresql.DOUBLE_PRECISION)
     retrieved_at = Column(db.DateTime(True))
 
@@ -255,24 +244,136 @@ class QueryResult(db.Model, BelongsToOrgMixin):
     def __str__(self):
         return u"%d | %s | %s" % (self.id, self.query_hash, self.retrieved_at)
 
-    def to_dict(self):
+    def to_dict(self, columns=None, offset=0, limit=None, order_by=None):
         return {
             'id': self.id,
             'query_hash': self.query_hash,
             'query': self.query_text,
-            'data': json_loads(self.data),
+            'data': self.load_data(columns, offset, limit, order_by),
             'data_source_id': self.data_source_id,
             'runtime': self.runtime,
             'retrieved_at': self.retrieved_at
         }
 
+    @classmethod
+    def find_by_checksum(cls, data_source_id, checksum):
+        """
+        Returns a recent query result of the data source holding a payload with the given checksum. Only results
+        well within the cleanup age are considered, so the payload can't be removed while it's being reused. Results
+        of other data sources aren't, as references between them would keep a data source from being deleted.
+        """
+        age_threshold = (utils.utcnow() - datetime.timedelta(days=settings.QUERY_RESULTS_CLEANUP_MAX_AGE) +
+                         datetime.timedelta(hours=1))
+        return cls.query.filter(
+            cls.data_source_id == data_source_id,
+            cls.data_checksum == checksum,
+            cls.data_ref_id.is_(None),
+            cls.retrieved_at > age_threshold
+        ).options(load_only('id', 'data_location')).order_by(cls.id.desc()).first()
+
+    def set_data(self, data):
+        """
+        Stores the payload in the data column, or in the result storage backend if it's large enough. Payloads are
+        content addressed: when a recent result already holds the same bytes, it's referenced instead of copied.
+
+        `data` is the payload itself or the result writer it was written to, which is only read in full when the
+        payload goes to the data column.
+        """
+        if isinstance(data, text_type):
+            data = data.encode('utf-8')
+
+        if isinstance(data, str):
+            self.data_size = len(data)
+            self.data_checksum = hashlib.sha256(data).hexdigest()
+        else:
+            self.data_size = data.size
+            self.data_checksum = data.checksum
+        self.data = None
+        self.data_location = None
+        self.data_ref_id = None
+
+        # The foreign key isn't set before the result is flushed.
+        data_source_id = self.data_source.id if self.data_source is not None else self.data_source_id
+        existing = self.find_by_checksum(data_source_id, self.data_checksum)
+        if existing is not None:
+            if existing.data_location is not None:
+                self.data_location = existing.data_location
+            else:
+                self.data_ref_id = existing.id
+        elif settings.RESULT_STORAGE_BACKEND and self.data_size >= settings.RESULT_STORAGE_THRESHOLD:
+            key = u'{}/{}'.format(self.org_id, self.data_checksum)
+            self.data_location = result_storage.put(key, data if isinstance(data, str) else data.open())
+        else:
+            self.data = data if isinstance(data, str) else data.getvalue()
+
+    @property
+    def payload(self):
+        """The raw result data, wherever it is stored."""
+        if self.data_ref_id is not None:
+            return self.data_ref.payload
+
+        if self.data_location is None:
+            return self.data
+
+        payload = result_storage.get(self.data_location)
+        if self.data_checksum is not None and hashlib.sha256(payload).hexdigest() != self.data_checksum:
+            raise Exception("Checksum mismatch for query result {} data at {}.".format(self.id, self.data_location))
+
+        return payload
+
+    def load_data(self, columns=None, offset=0, limit=None, order_by=None):
+        """
+        Decodes the result data, optionally only the given columns (by name) and a range of rows, after sorting by
+        order_by, a list of (column name, descending) pairs. Columnar payloads decode just what was asked for, JSON
+        ones are parsed in full and then sliced.
+        """
+        payload = self.payload
+        if is_columnar(payload):
+            return ColumnarReader(payload).to_dict(columns, offset, limit, order_by)
+
+        data = json_loads(payload)
+        data['total_rows'] = len(data['rows'])
+
+        if order_by:
+            for name, descending in reversed(order_by):
+                data['rows'].sort(key=lambda row: row.get(name), reverse=descending)
+
+        if offset or limit is not None:
+            stop = None if limit is None else offset + limit
+            data['rows'] = data['rows'][offset:stop]
+
+        if columns is not None:
+            data['columns'] = [column for column in data['columns'] if column['name'] in columns]
+            data['rows'] = [{name: row[name] for name in columns if name in row} for row in data['rows']]
+
+        return data
+
+    @classmethod
+    def delete_stored_data(cls, locations):
+        """
+        Removes payloads from the result storage backend once their query results are deleted. Payloads are shared by
+        results with the same content, so those some result still points to are kept.
+        """
+        for location in set(locations):
+            still_used = cls.query.filter(cls.data_location == location).with_entities(cls.id).first()
+            if still_used is not None:
+                continue
+
+            try:
+                result_storage.delete(location)
+            except Exception:
+                logger.exception("Failed deleting query result data at %s.", location)
+
     @classmethod
     def unused(cls, days=7):
         age_threshold = datetime.datetime.now() - datetime.timedelta(days=days)
+        referencing = aliased(cls)
         return (
             cls.query.filter(
                 Query.id.is_(None),
-                cls.retrieved_at < age_threshold
+                cls.retrieved_at < age_threshold,
+                # Results holding a payload other results refer to are kept until those are gone.
+                ~exists().where(referencing.data_ref_id == cls.id)
             )
                 .outerjoin(Query)
         ).options(load_only('id'))
@@ -306,8 +407,8 @@ class QueryResult(db.Model, BelongsToOrgMixin):
                            query_text=query,
                            runtime=run_time,
                            data_source=data_source,
-                           retrieved_at=retrieved_at,
-                           data=data)
+                           retrieved_at=retrieved_at)
+        query_result.set_data(data)
         db.session.add(query_result)
         logging.info("Inserted query (%s) data; id=%s", query_hash, query_result.id)
         # TODO: Investigate how big an impact this select-before-update makes.
@@ -315,8 +416,12 @@ class QueryResult(db.Model, BelongsToOrgMixin):
             Query.query_hash == query_hash,
             Query.data_source == data_source
         )
+        # Queries sharing this result are next due counting from when it started executing.
+        started_at = retrieved_at - datetime.timedelta(seconds=run_time)
         for q in queries:
             q.latest_query_data = query_result
+            if q.schedule:
+                q.schedule_next_run(started_at)
             # don't auto-update the updated_at timestamp
             q.skip_updated_at = True
             db.session.add(q)
@@ -329,43 +434,91 @@ class QueryResult(db.Model, BelongsToOrgMixin):
     def groups(self):
         return self.data_source.groups
 
-    def make_csv_content(self):
+    def iter_data(self, batch_size=None):
+        """
+        Returns the result's columns and an iterator over batches of its rows. Columnar payloads are decoded one
+        chunk at a time.
+        """
+        payload = self.payload
+        if is_columnar(payload):
+            reader = ColumnarReader(payload)
+            return reader.columns, reader.iter_batches()
+
+        data = json_loads(payload)
+        return data['columns'], iter_batches(data['rows'], batch_size)
+
+    def iter_csv_content(self):
         s = cStringIO.StringIO()
 
-        query_data = json_loads(self.data)
-        writer = csv.DictWriter(s, extrasaction="ignore", fieldnames=[col['name'] for col in query_data['columns']])
+        columns, batches = self.iter_data()
+        writer = csv.DictWriter(s, extrasaction="ignore", fieldnames=[col['name'] for col in columns])
         writer.writer = utils.UnicodeWriter(s)
         writer.writeheader()
-        for row in query_data['rows']:
-            writer.writerow(row)
 
-        return s.getvalue()
+        for batch in batches:
+            for row in batch:
+                writer.writerow(row)
+            yield s.getvalue()
+            s.seek(0)
+            s.truncate()
 
-    def make_excel_content(self):
-        s = cStringIO.StringIO()
+        yield s.getvalue()
+
+    def make_csv_content(self):
+        return ''.join(self.iter_csv_content())
 
-        query_data = json_loads(self.data)
-        book = xlsxwriter.Workbook(s, {'constant_memory': True})
+    def write_excel_content(self, filename):
+        columns, batches = self.iter_data()
+        book = xlsxwriter.Workbook(filename, {'constant_memory': True})
         sheet = book.add_worksheet("result")
 
         column_names = []
-        for (c, col) in enumerate(query_data['columns']):
+        for (c, col) in enumerate(columns):
             sheet.write(0, c, col['name'])
             column_names.append(col['name'])
 
-        for (r, row) in enumerate(query_data['rows']):
-            for (c, name) in enumerate(column_names):
-                v = row.get(name)
-                if isinstance(v, list) or isinstance(v, dict):
-                    v = str(v).encode('utf-8')
-                sheet.write(r + 1, c, v)
+        r = 0
+        for batch in batches:
+            for row in batch:
+                r += 1
+                for (c, name) in enumerate(column_names):
+                    v = row.get(name)
+                    if isinstance(v, list) or isinstance(v, dict):
+                        v = str(v).encode('utf-8')
+                    sheet.write(r, c, v)
 
         book.close()
 
-        return s.getvalue()
+    @staticmethod
+    def _iter_file_content(write, suffix, chunk_size=64 * 1024):
+        """Writes a file to a temporary location using `write`, then reads it back in chunks."""
+        with tempfile.NamedTemporaryFile(suffix=suffix) as f:
+            write(f.name)
+            for chunk in iter(lambda: f.read(chunk_size), ''):
+                yield chunk
 
+    def iter_excel_content(self):
+        return self._iter_file_content(self.write_excel_content, '.xlsx')
 
-def should_schedule_next(previous_iteration, now, interval, time=None, day_of_week=None, failures=0):
+    def make_excel_content(self):
+        return ''.join(self.iter_excel_content())
+
+    def iter_parquet_content(self):
+        def write(filename):
+            columns, batches = self.iter_data(arrow_export.ROW_GROUP_SIZE)
+            arrow_export.write_parquet(filename, columns, batches)
+
+        return self._iter_file_content(write, '.parquet')
+
+    def iter_arrow_content(self):
+        def write(filename):
+            columns, batches = self.iter_data(arrow_export.ROW_GROUP_SIZE)
+            arrow_export.write_arrow(filename, columns, batches)
+
+        return self._iter_file_content(write, '.arrow')
+
+
+def next_iteration_time(previous_iteration, interval, time=None, day_of_week=None, failures=0):
     # if time exists then interval > 23 hours (82800s)
     # if day_of_week exists then interval > 6 days (518400s)
     if (time is None):
@@ -394,7 +547,30 @@ def should_schedule_next(previous_iteration, now, interval, time=None, day_of_we
                           datetime.timedelta(days=days_to_add)).replace(hour=hour, minute=minute)
     if failures:
         next_iteration += datetime.timedelta(minutes=2 ** failures)
-    return now > next_iteration
+    return next_iteration
+
+
+def should_schedule_next(previous_iteration, now, interval, time=None, day_of_week=None, failures=0):
+    return now > next_iteration_time(previous_iteration, interval, time, day_of_week, failures)
+
+
+def next_scheduled_run(schedule, previous_iteration, failures=0):
+    """
+    Returns when a query with the given schedule, which last ran at previous_iteration, is due next. Returns None if
+    it's not scheduled or its schedule ends before then.
+    """
+    if not schedule or schedule.get('interval') is None:
+        return None
+
+    next_iteration = next_iteration_time(previous_iteration, schedule['interval'], schedule.get('time'),
+                                         schedule.get('day_of_week'), failures or 0)
+
+    if schedule.get('until') is not None:
+        schedule_until = pytz.utc.localize(datetime.datetime.strptime(schedule['until'], '%Y-%m-%d'))
+        if next_iteration >= schedule_until:
+            return None
+
+    return next_iteration
 
 
 @python_2_unicode_compatible
@@ -427,6 +603,7 @@ class Query(ChangeTrackingMixin, TimestampMixin, BelongsToOrgMixin, db.Model):
     is_draft = Column(db.Boolean, default=True, index=True)
     schedule = Column(MutableDict.as_mutable(PseudoJSON), nullable=True)
     schedule_failures = Column(db.Integer, default=0)
+    next_run_at = Column(db.DateTime(True), nullable=True, index=True)
     visualizations = db.relationship("Visualization", cascade="all, delete-orphan")
     options = Column(MutableDict.as_mutable(PseudoJSON), default={})
     search_vector = Column(TSVectorType('id', 'name', 'description', 'query',
@@ -647,39 +824,21 @@ class Query(ChangeTrackingMixin, TimestampMixin, BelongsToOrgMixin, db.Model):
     def outdated_queries(cls):
         queries = (
             Query.query
-                .options(joinedload(Query.latest_query_data).load_only('retrieved_at'))
-                .filter(Query.schedule.isnot(None))
+                .options(joinedload(Query.org), joinedload(Query.data_source))
+                .filter(Query.next_run_at <= utils.utcnow())
                 .order_by(Query.id)
         )
 
-        now = utils.utcnow()
         outdated_queries = {}
-        scheduled_queries_executions.refresh()
-
         for query in queries:
-            if query.schedule['interval'] is None:
-                continue
-
-            if query.schedule['until'] is not None:
-                schedule_until = pytz.utc.localize(datetime.datetime.strptime(query.schedule['until'], '%Y-%m-%d'))
-
-                if schedule_until <= now:
-                    continue
-
-            if query.latest_query_data:
-                retrieved_at = query.latest_query_data.retrieved_at
-            else:
-                retrieved_at = now
-
-            retrieved_at = scheduled_queries_executions.get(query.id) or retrieved_at
-
-            if should_schedule_next(retrieved_at, now, query.schedule['interval'], query.schedule['time'],
-                                    query.schedule['day_of_week'], query.schedule_failures):
-                key = "{}:{}".format(query.query_hash, query.data_source_id)
-                outdated_queries[key] = query
+            key = "{}:{}".format(query.query_hash, query.data_source_id)
+            outdated_queries[key] = query
 
         return outdated_queries.values()
 
+    def schedule_next_run(self, previous_iteration):
+        self.next_run_at = next_scheduled_run(self.schedule, previous_iteration, self.schedule_failures)
+
     @classmethod
     def search(cls, term, group_ids, user_id=None, include_drafts=False,
                limit=None, include_archived=False):
@@ -822,6 +981,15 @@ def gen_query_hash(target, val, oldval, initiator):
     target.schedule_failures = 0
 
 
+@listens_for(Query.schedule, 'set')
+def schedule_next_run(target, val, oldval, initiator):
+    if target.latest_query_data is not None:
+        previous_iteration = target.latest_query_data.retrieved_at
+    else:
+        previous_iteration = utils.utcnow()
+    target.next_run_at = next_scheduled_run(val, previous_iteration, target.schedule_failures)
+
+
 @listens_for(Query.user_id, 'set')
 def query_last_modified_by(target, val, oldval, initiator):
     target.last_modified_by_id = val
@@ -938,7 +1106,8 @@ class Alert(TimestampMixin, BelongsToOrgMixin, db.Model):
         return super(Alert, cls).get_by_id_and_org(object_id, org, Query)
 
     def evaluate(self):
-        data = json_loads(self.query_rel.latest_query_data.data)
+        # Only the first row is ever looked at.
+        data = self.query_rel.latest_query_data.load_data(limit=1)
 
         if data['rows'] and self.options['column'] in data['rows'][0]:
             value = data['rows'][0][self.options['column']]
@@ -8,7 +8,7 @@ from flask_restful import abort
 from funcy import distinct
 
 from redash.permissions import require_access, view_only
-from redash.utils import mustache_render, json_loads
+from redash.utils import mustache_render
 
 
 def _pluck_name_and_value(default_column, row):
@@ -33,7 +33,7 @@ def _load_result(query_id, should_require_access):
     if query.data_source:
     #    require_access(query.data_source.groups, current_user, view_only)
         query_result = models.QueryResult.get_by_id_and_org(query.latest_query_data_id, current_org)
-        return json_loads(query_result.data)
+        return query_result.load_data()
     else:
         abort(400, message="This query is detached from any data source. Please select a different query.")
 
@@ -2,6 +2,7 @@ from sqlalchemy.ext.indexable import index_property
 from sqlalchemy.ext.mutable import Mutable
 from sqlalchemy.types import TypeDecorator
 from sqlalchemy_utils import EncryptedType
+from six import text_type
 
 from redash.utils import json_dumps, json_loads
 from redash.utils.configuration import ConfigurationContainer
@@ -43,6 +44,19 @@ class PseudoJSON(TypeDecorator):
         return json_loads(value)
 
 
+class ResultData(TypeDecorator):
+    """
+    Query result payloads are stored as bytes, either as a JSON document or in the columnar encoding of
+    redash.utils.columnar.
+    """
+    impl = db.LargeBinary
+
+    def process_bind_param(self, value, dialect):
+        if isinstance(value, text_type):
+            return value.encode('utf-8')
+        return value
+
+
 class MutableDict(Mutable, dict):
     @classmethod
     def coerce(cls, key, value):
@@ -4,6 +4,7 @@ from sqlalchemy import union_all
 
 from redash import redis_connection, __version__, settings
 from redash.models import db, DataSource, Query, QueryResult, Dashboard, Widget
+from redash.tasks.queries import QueryAdmission
 from redash.utils import json_loads
 from redash.worker import celery
 
@@ -129,11 +130,42 @@ def parse_tasks(task_lists, state):
     return rows
 
 
+def get_deferred_tasks():
+    """Queries deferred by their data source's or org's concurrency limit, which wait on a worker for their retry."""
+    scheduled = celery.control.inspect().scheduled()
+    if scheduled is None:
+        return []
+
+    return parse_tasks({worker: [task['request'] for task in tasks] for worker, tasks in scheduled.items()},
+                       'deferred')
+
+
+def add_admission_state(tasks):
+    query_tasks = [task for task in tasks if task['task_name'] == 'redash.tasks.execute_query']
+    if not query_tasks:
+        return tasks
+
+    deferred_reasons = redis_connection.mget([QueryAdmission.deferred_reason_key(task['task_id'])
+                                              for task in query_tasks])
+
+    for task, deferred_reason in zip(query_tasks, deferred_reasons):
+        if task['state'] == 'active':
+            task['admission'] = 'admitted'
+        elif deferred_reason is not None:
+            task['admission'] = 'deferred'
+            task['deferred_reason'] = deferred_reason
+        else:
+            task['admission'] = 'pending'
+
+    return tasks
+
+
 def celery_tasks():
     tasks = parse_tasks(celery.control.inspect().active(), 'active')
     tasks += parse_tasks(celery.control.inspect().reserved(), 'reserved')
+    tasks += get_deferred_tasks()
 
     for queue_name in get_queues():
         tasks += get_waiting_in_queue(queue_name)
 
-    return tasks
+    return add_admission_state(tasks)
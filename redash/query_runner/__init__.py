@@ -1,11 +1,24 @@
+import datetime
+import hashlib
 import logging
+import re
 from collections import OrderedDict
+from itertools import izip
 
 import requests
-from dateutil import parser
-from sympy import sympify
+import sqlparse
+from dateutil import parser, tz
+from sympy import lambdify, sympify
 
-from redash.utils import json_loads
+from redash import settings
+from redash.query_runner.connection_pool import connection_pool
+from redash.query_runner.http_session import http_sessions
+from redash.utils import JSONEncoder, json_dumps, json_loads
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 logger = logging.getLogger(__name__)
 
@@ -14,6 +27,8 @@ __all__ = [
     'BaseHTTPQueryRunner',
     'InterruptException',
     'BaseSQLQueryRunner',
+    'ResultStream',
+    'iter_batches',
     'TYPE_DATETIME',
     'TYPE_BOOLEAN',
     'TYPE_INTEGER',
@@ -26,10 +41,14 @@ __all__ = [
     'import_query_runners',
     'guess_type',
     'guess_type_and_decode',
+    'guess_column_type',
+    'guess_column_type_and_decode',
+    'ColumnTypeGuesser',
     'default_value_for_type',
     'handle_extra_columns',
     'handle_alias',
     'handle_select_and_ordering',
+    'columns_to_rows',
     'get_column_type_from_set'
 ]
 
@@ -59,12 +78,77 @@ class NotSupported(Exception):
     pass
 
 
+def iter_batches(rows, batch_size=None):
+    batch_size = batch_size or settings.QUERY_RESULTS_ROW_BATCH_SIZE
+    batch = []
+
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+class ResultStream(object):
+    """
+    A query result as column metadata plus an iterator over batches of rows (lists of row dicts).
+
+    Runners that only learn their columns while reading the rows (MongoDB, Query Results) keep extending
+    `columns` until the batches are exhausted, so consumers should only rely on it after iterating.
+    """
+
+    def __init__(self, columns, batches, json_encoder=JSONEncoder, **json_options):
+        self.columns = columns
+        self.batches = batches
+        self.json_encoder = json_encoder
+        self.json_options = json_options
+        self.json_data = None
+
+    @classmethod
+    def from_json(cls, json_data):
+        """Wrap the JSON string returned by a runner that doesn't stream; it's only parsed when iterated."""
+        stream = cls(None, None)
+        stream.json_data = json_data
+        return stream
+
+    def __iter__(self):
+        if self.batches is None:
+            data = json_loads(self.json_data)
+            self.columns = data.get('columns', [])
+            self.batches = iter_batches(data.get('rows', []))
+
+        return iter(self.batches)
+
+    def close(self):
+        if hasattr(self.batches, 'close'):
+            self.batches.close()
+
+    def to_dict(self):
+        rows = []
+        for batch in self:
+            rows.extend(batch)
+
+        return {'columns': self.columns, 'rows': rows}
+
+    def to_json(self):
+        if self.json_data is not None:
+            return self.json_data
+
+        return json_dumps(self.to_dict(), cls=self.json_encoder, **self.json_options)
+
+
 class BaseQueryRunner(object):
     noop_query = None
+    # Runners that implement run_query_stream set this, and get run_query on top of it.
+    streaming = False
 
     def __init__(self, configuration):
         self.syntax = 'sql'
         self.configuration = configuration
+        self.data_source_id = None
 
     @classmethod
     def name(cls):
@@ -95,7 +179,42 @@ class BaseQueryRunner(object):
             raise Exception(error)
 
     def run_query(self, query, user):
-        raise NotImplementedError()
+        if not self.streaming:
+            raise NotImplementedError()
+
+        stream, error = self.run_query_stream(query, user)
+        if stream is None:
+            return None, error
+
+        try:
+            return stream.to_json(), error
+        finally:
+            stream.close()
+
+    def run_query_stream(self, query, user):
+        """
+        Run the query and return a ResultStream and an error message (one of them being None). Errors that happen
+        after the stream was returned are raised while iterating it.
+        """
+        if self.streaming:
+            raise NotImplementedError()
+
+        data, error = self.run_query(query, user)
+        if data is None:
+            return None, error
+
+        return ResultStream.from_json(data), error
+
+    def export_csv(self, query, user):
+        """
+        Runs the query and returns an iterator over its results as CSV (with a header row) and an error message,
+        with the database producing the CSV itself. Only some runners support it.
+        """
+        raise NotSupported()
+
+    def get_session(self):
+        """A requests session of the data source, which keeps its connections alive between requests."""
+        return http_sessions.get(self.data_source_id)
 
     def fetch_columns(self, columns):
         column_names = []
@@ -135,6 +254,98 @@ class BaseQueryRunner(object):
 
 
 class BaseSQLQueryRunner(BaseQueryRunner):
+    """
+    Runners which implement _connect() can get their connections through acquire_connection() and
+    release_connection(), which reuse them across queries of the same data source (see connection_pool).
+
+    Connections are only reused by runners setting pool_connections, whose _reset_connection() brings back the
+    whole session state (variables, temporary tables, ...), as the next query may be run by another user.
+    """
+    pool_connections = False
+
+    def _connect(self):
+        raise NotImplementedError()
+
+    def _check_connection(self, connection):
+        cursor = connection.cursor()
+        cursor.execute(self.noop_query)
+        cursor.fetchall()
+        cursor.close()
+
+    def _reset_connection(self, connection):
+        """Brings a connection back to the state of a new one before it's reused."""
+        raise NotImplementedError()
+
+    @property
+    def _pool_key(self):
+        if not self.pool_connections or not settings.SQL_CONNECTION_POOL_ENABLED or self.data_source_id is None:
+            return None
+
+        if not hasattr(self, '_pool_fingerprint'):
+            configuration = json_dumps(dict(self.configuration.iteritems()), sort_keys=True)
+            self._pool_fingerprint = hashlib.sha1(configuration).hexdigest()
+
+        return self.data_source_id, self._pool_fingerprint
+
+    def acquire_connection(self):
+        key = self._pool_key
+        if key is None:
+            return self._connect()
+
+        return connection_pool.acquire(key, self._connect, self._check_connection)
+
+    def release_connection(self, connection, discard=False):
+        """Returns a connection to the pool. Connections in an unknown state (errors, cancellations) are discarded."""
+        key = self._pool_key
+
+        if key is not None and not discard:
+            try:
+                self._reset_connection(connection)
+            except Exception:
+                discard = True
+
+        if key is None or discard:
+            try:
+                connection.close()
+            except Exception:
+                logger.debug("Failed closing connection.", exc_info=True)
+        else:
+            connection_pool.release(key, connection)
+
+    @property
+    def batch_size(self):
+        """Rows fetched from the database at a time, configurable per data source."""
+        return int(self.configuration.get('batch_size') or settings.QUERY_RESULTS_ROW_BATCH_SIZE)
+
+    def _single_statement(self, query):
+        """Returns the parsed statement when the query holds exactly one (comments aside), None otherwise."""
+        statements = [statement for statement in sqlparse.parse(query)
+                      if statement.token_first(skip_cm=True) is not None]
+        if len(statements) != 1:
+            return None
+        return statements[0]
+
+    def _fetch_batches(self, connection, cursor, columns, fetch=None):
+        """
+        Yields the rows of an executed cursor, batch_size rows at a time, then releases the connection. Unless all
+        the rows were read (e.g. the stream was closed early), the connection is discarded.
+        """
+        if fetch is None:
+            fetch = lambda: cursor.fetchmany(self.batch_size)
+        column_names = [c['name'] for c in columns]
+        discard = True
+
+        try:
+            while True:
+                rows = fetch()
+                if not rows:
+                    break
+
+                yield [dict(zip(column_names, row)) for row in rows]
+
+            discard = False
+        finally:
+            self.release_connection(connection, discard=discard)
 
     def get_schema(self, prefix=None):
         schema_dict = {}
@@ -205,7 +416,7 @@ class BaseHTTPQueryRunner(BaseQueryRunner):
         error = None
         response = None
         try:
-            response = requests.request(http_method, url, auth=auth, **kwargs)
+            response = self.get_session().request(http_method, url, auth=auth, **kwargs)
             # Raise a requests HTTP exception with the appropriate reason
             # for 4xx and 5xx response status codes which is later caught
             # and passed back.
@@ -249,12 +460,14 @@ def register(query_runner_class):
                      "dependencies.", query_runner_class.name())
 
 
-def get_query_runner(query_runner_type, configuration):
+def get_query_runner(query_runner_type, configuration, data_source_id=None):
     query_runner_class = query_runners.get(query_runner_type, None)
     if query_runner_class is None:
         return None
 
-    return query_runner_class(configuration)
+    query_runner = query_runner_class(configuration)
+    query_runner.data_source_id = data_source_id
+    return query_runner
 
 
 def get_configuration_schema_for_query_runner_type(query_runner_type):
@@ -270,6 +483,33 @@ def import_query_runners(query_runner_imports):
         __import__(runner_import)
 
 
+# Timestamps in the ISO 8601 forms databases and APIs usually return; parsed without dateutil, to the same values.
+_ISO_DATETIME = re.compile(r'^(\d{4})-(\d\d)-(\d\d)(?:[T ](\d\d):(\d\d)(?::(\d\d)(?:\.(\d{1,6}))?)?'
+                           r'(Z|[+-]\d\d:?\d\d)?)?$')
+
+
+def _parse_datetime(string_value):
+    match = _ISO_DATETIME.match(string_value)
+    if match is not None:
+        year, month, day, hour, minute, second, fraction, offset = match.groups()
+        if offset is None:
+            tzinfo = None
+        elif offset == 'Z':
+            tzinfo = tz.tzutc()
+        else:
+            sign = -1 if offset[0] == '-' else 1
+            offset = offset[1:].replace(':', '')
+            tzinfo = tz.tzoffset(None, sign * (int(offset[:2]) * 3600 + int(offset[2:]) * 60))
+
+        try:
+            return datetime.datetime(int(year), int(month), int(day), int(hour or 0), int(minute or 0),
+                                     int(second or 0), int((fraction or '0').ljust(6, '0')), tzinfo)
+        except ValueError:
+            pass
+
+    return parser.parse(string_value)
+
+
 def guess_type(string_value):
     val_type, val = guess_type_and_decode(string_value)
 
@@ -280,7 +520,27 @@ def guess_type_and_decode(string_value):
     if string_value == '' or string_value is None:
         return TYPE_STRING, string_value
 
-    if type(string_value) == unicode:
+    # Values which aren't strings are typed by what their string form would be guessed as, without formatting and
+    # parsing them.
+    value_type = type(string_value)
+    if value_type in (int, long):
+        return TYPE_INTEGER, string_value
+
+    if value_type == float:
+        if string_value.is_integer():
+            return TYPE_INTEGER, int(string_value)
+        return TYPE_FLOAT, string_value
+
+    if value_type == bool:
+        return TYPE_BOOLEAN, string_value
+
+    if value_type == datetime.datetime:
+        return TYPE_DATETIME, string_value
+
+    if value_type == datetime.date:
+        return TYPE_DATETIME, datetime.datetime(string_value.year, string_value.month, string_value.day)
+
+    if value_type == unicode:
         string_value = string_value.encode('utf-8')
 
     if type(string_value) != str:
@@ -299,7 +559,7 @@ def guess_type_and_decode(string_value):
         return TYPE_BOOLEAN, string_value.lower() == 'true'
 
     try:
-        val = parser.parse(string_value)
+        val = _parse_datetime(string_value)
         return TYPE_DATETIME, val
     except (ValueError, OverflowError):
         pass
@@ -307,6 +567,111 @@ def guess_type_and_decode(string_value):
     return TYPE_STRING, string_value
 
 
+_STRING_TYPES = set([str, unicode])
+_INTEGER_TYPES = set([int, long])
+_NUMERIC_OR_NULL_TYPES = set([int, long, float, type(None)])
+
+
+class ColumnTypeGuesser(object):
+    """
+    Guesses the type of a column from its values, which can be fed in batches: the type all the values are guessed
+    as (see guess_type), TYPE_FLOAT for a mix of integers and floats, otherwise TYPE_STRING.
+
+    Once a column can only be a string, further values aren't looked at. Values repeating within a column are only
+    guessed once, purely numeric batches are checked at once (with NumPy, when installed), and batches longer than
+    `sample_size` (TYPE_INFERENCE_SAMPLE_SIZE by default, 0 for no sampling) are sampled at regular intervals.
+    """
+
+    def __init__(self, sample_size=None):
+        self.types = set()
+        self.sample_size = settings.TYPE_INFERENCE_SAMPLE_SIZE if sample_size is None else sample_size
+        self._guesses = {}
+
+    @property
+    def decided(self):
+        return TYPE_STRING in self.types
+
+    @property
+    def type(self):
+        """The guessed type, None before any value was seen."""
+        if not self.types:
+            return None
+        return get_column_type_from_set(set(self.types))
+
+    def _add(self, types):
+        self.types.update(types)
+        if get_column_type_from_set(set(self.types)) == TYPE_STRING:
+            self.types.add(TYPE_STRING)
+
+    def _numeric_types(self, values, value_types):
+        """Types of a batch of numbers (or strings of numbers), None when it isn't one."""
+        if value_types <= _INTEGER_TYPES:
+            return set([TYPE_INTEGER])
+
+        if not (value_types <= _STRING_TYPES or value_types == set([float])) or numpy is None:
+            return None
+
+        try:
+            floats = numpy.array(values, dtype=numpy.float64)
+        except (ValueError, TypeError, OverflowError):
+            return None
+
+        integers = numpy.mod(floats, 1) == 0
+        types = set()
+        if integers.any():
+            types.add(TYPE_INTEGER)
+        if not integers.all():
+            types.add(TYPE_FLOAT)
+        return types
+
+    def update(self, values):
+        if self.decided or not values:
+            return
+
+        if self.sample_size and len(values) > self.sample_size:
+            values = values[::-(-len(values) // self.sample_size)]
+
+        types = self._numeric_types(values, set(map(type, values)))
+        if types is not None:
+            self._add(types)
+            return
+
+        guesses = self._guesses
+        for value in values:
+            # Keyed by type as well, since e.g. True == 1.
+            key = (type(value), value)
+            try:
+                value_type = guesses[key]
+            except KeyError:
+                value_type = guesses[key] = guess_type(value)
+            except TypeError:
+                # Not hashable (lists, dicts).
+                value_type = guess_type(value)
+
+            if value_type not in self.types:
+                self._add([value_type])
+                if self.decided:
+                    return
+
+
+def guess_column_type(values, sample_size=None):
+    guesser = ColumnTypeGuesser(sample_size)
+    guesser.update(values)
+    return guesser.type
+
+
+def guess_column_type_and_decode(values):
+    """
+    Returns the column's type and its values decoded according to it (see guess_type_and_decode). Values of string
+    columns are returned as they are.
+    """
+    column_type = guess_column_type(values, sample_size=0)
+    if column_type in (None, TYPE_STRING):
+        return column_type, values
+
+    return column_type, [guess_type_and_decode(value)[1] for value in values]
+
+
 def default_value_for_type(tp):
     if tp == TYPE_FLOAT or tp == TYPE_INTEGER:
         return 0
@@ -328,12 +693,87 @@ def get_column_type_from_set(type_set):
         return TYPE_STRING
 
 
+def _numeric_array(values):
+    """The values as a float array with NaN for nulls, or None when they aren't all numbers."""
+    if not set(map(type, values)) <= _NUMERIC_OR_NULL_TYPES:
+        return None
+    return numpy.array([numpy.nan if value is None else value for value in values], dtype=numpy.float64)
+
+
+def _evaluate_numeric(expression, symbols, arrays, row_count):
+    """
+    Evaluates the expression over whole columns. Rows with a null in any of the columns, or without a finite result,
+    get null. Returns None when the result isn't numeric or boolean.
+    """
+    function = lambdify(symbols, expression, modules='numpy')
+    with numpy.errstate(all='ignore'):
+        result = numpy.asarray(function(*arrays))
+
+    if result.dtype.kind not in 'biuf':
+        return None
+
+    result = numpy.broadcast_to(result, (row_count,))
+    nulls = numpy.zeros(row_count, dtype=bool)
+    for array in arrays:
+        nulls |= numpy.isnan(array)
+
+    if result.dtype.kind == 'b':
+        return TYPE_BOOLEAN, [None if null else value for value, null in izip(result.tolist(), nulls.tolist())]
+
+    result = result.astype(numpy.float64)
+    nulls |= ~numpy.isfinite(result)
+    with numpy.errstate(all='ignore'):
+        integral = numpy.mod(result, 1) == 0
+
+    if integral[~nulls].all():
+        return TYPE_INTEGER, [None if null else int(value) for value, null in izip(result.tolist(), nulls.tolist())]
+    return TYPE_FLOAT, [None if null else value for value, null in izip(result.tolist(), nulls.tolist())]
+
+
+def _evaluate_expression(expr, values, row_count):
+    """Returns the type and values of an extra column computed from `expr`, over columns `values`."""
+    try:
+        expression = sympify(expr)
+    except Exception:
+        return TYPE_STRING, [expr] * row_count
+
+    symbols = sorted(expression.free_symbols, key=str)
+    if numpy is not None and row_count and all(str(symbol) in values for symbol in symbols):
+        arrays = [_numeric_array(values[str(symbol)]) for symbol in symbols]
+        if all(array is not None for array in arrays):
+            try:
+                result = _evaluate_numeric(expression, symbols, arrays, row_count)
+            except Exception:
+                result = None
+
+            if result is not None:
+                return result
+
+    # Expressions over non numeric values (or without NumPy) are evaluated row by row.
+    names = values.keys()
+    results = []
+    for row_values in (izip(*values.values()) if values else [()] * row_count):
+        try:
+            results.append(str(expression.subs(dict(izip(names, row_values))).evalf()))
+        except Exception:
+            results.append(expr)
+
+    column_type, results = guess_column_type_and_decode(results)
+    return column_type or TYPE_STRING, results
+
+
 def handle_extra_columns(data, extra_columns):
+    """
+    Adds columns computed from expressions over the other columns (`{"expr": "(a + b) / 2", "name": "avg"}`).
+
+    Works on column oriented data: `{'columns': [...], 'values': {column name: [values]}, 'row_count': n}`. Each
+    expression is compiled once and, when the columns it uses are numeric, evaluated over whole columns with NumPy.
+    """
     if extra_columns is None:
         extra_columns = []
 
     columns = data['columns']
-    rows = data['rows']
+    values = data['values']
 
     column_name_set = set()
     for column in columns:
@@ -350,31 +790,17 @@ def handle_extra_columns(data, extra_columns):
                 return "Duplicated columns in extra column definition: " + name, None
 
             column_name_set.add(name)
-            column_data_type = set()
-
-            for row in rows:
-                data = None
-
-                try:
-                    data = str(sympify(expr).subs(row).evalf())
-                except:
-                    data = expr
-                val_type, val = guess_type_and_decode(data)
-
-                column_data_type.add(val_type)
-                row[name] = val
 
-            columns.append(
-                {'name': name, 'friendly_name': name, 'type': get_column_type_from_set(column_data_type)})
+            column_type, values[name] = _evaluate_expression(expr, values, data['row_count'])
+            columns.append({'name': name, 'friendly_name': name, 'type': column_type})
         else:
             return "Unexpected extra column definition!", None
 
-    return None, {'columns': columns, 'rows': rows}
+    return None, data
 
 
 def handle_select_and_ordering(data, selected_columns_set, ordered_columns_list):
     columns = data['columns']
-    rows = data['rows']
 
     column_name_set = set()
     column_name_mapping = {}
@@ -401,24 +827,23 @@ def handle_select_and_ordering(data, selected_columns_set, ordered_columns_list)
         if regular_column_name not in ordered_columns_set and regular_column_name in selected_columns_set:
             new_columns.append(column)
 
-    new_rows = []
-    for row in rows:
-        new_row = OrderedDict()
-        for column in new_columns:
-            if column['name'] in row:
-                new_row[column['name']] = row[column['name']]
-
-        new_rows.append(new_row)
-
-    return None, {'columns': new_columns, 'rows': new_rows}
+    values = dict((column['name'], data['values'][column['name']]) for column in new_columns)
+    return None, {'columns': new_columns, 'values': values, 'row_count': data['row_count']}
 
 
 def handle_alias(data, alias_mapping):
-    columns = data['columns']
-    rows = data['rows']
-
-    for column in columns:
+    for column in data['columns']:
         if column['name'] in alias_mapping:
             column['friendly_name'] = alias_mapping[column['name']]
 
-    return {'columns': columns, 'rows': rows}
+    return data
+
+
+def columns_to_rows(data):
+    """Turns column oriented data (see handle_extra_columns) into rows, the column order being that of `columns`."""
+    names = [column['name'] for column in data['columns']]
+    rows = [dict(izip(names, row_values)) for row_values in izip(*[data['values'][name] for name in names])]
+    if not names:
+        rows = [{} for _ in xrange(data['row_count'])]
+
+    return {'columns': data['columns'], 'rows': rows}
@@ -0,0 +1,105 @@
+import logging
+import os
+import threading
+import time
+
+from redash import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _close(connection):
+    try:
+        connection.close()
+    except Exception:
+        logger.debug("Failed closing pooled connection.", exc_info=True)
+
+
+class ConnectionPool(object):
+    """
+    Idle DB-API connections of a worker process, keyed by (data source id, configuration fingerprint).
+
+    - Connections idle for more than SQL_CONNECTION_POOL_MAX_IDLE_TIME seconds are closed.
+    - Connections idle for more than SQL_CONNECTION_POOL_CHECK_AFTER seconds are health checked before reuse.
+    - Once a data source is used with a different configuration, its connections for the old one are closed.
+    - After a fork, connections inherited from the parent are dropped (without closing them, as the parent still
+      uses them).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._fingerprints = {}
+        self._pid = os.getpid()
+
+    def _evict(self, key):
+        """Takes expired connections and those of outdated configurations out of the pool and returns them."""
+        if self._pid != os.getpid():
+            self._idle = {}
+            self._fingerprints = {}
+            self._pid = os.getpid()
+
+        data_source_id, fingerprint = key
+        self._fingerprints[data_source_id] = fingerprint
+
+        evicted = []
+        expire_before = time.time() - settings.SQL_CONNECTION_POOL_MAX_IDLE_TIME
+        for idle_key in self._idle.keys():
+            if idle_key[0] == data_source_id and idle_key != key:
+                evicted.extend(connection for connection, _ in self._idle.pop(idle_key))
+                continue
+
+            idle = self._idle[idle_key]
+            evicted.extend(connection for connection, released_at in idle if released_at < expire_before)
+            idle[:] = [(connection, released_at) for connection, released_at in idle if released_at >= expire_before]
+
+        return evicted
+
+    def acquire(self, key, connect, check):
+        """
+        Returns an idle connection for the key which passes `check` (when it has been idle for a while), or a new one
+        made by `connect`.
+        """
+        while True:
+            with self._lock:
+                evicted = self._evict(key)
+                idle = self._idle.get(key)
+                connection, released_at = idle.pop() if idle else (None, None)
+
+            for evicted_connection in evicted:
+                _close(evicted_connection)
+
+            if connection is None:
+                return connect()
+
+            if time.time() - released_at < settings.SQL_CONNECTION_POOL_CHECK_AFTER:
+                return connection
+
+            try:
+                check(connection)
+                return connection
+            except Exception:
+                logger.info("Discarding unhealthy pooled connection for data source %s.", key[0])
+                _close(connection)
+
+    def release(self, key, connection):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            keep = (self._pid == os.getpid() and self._fingerprints.get(key[0]) == key[1] and
+                    len(idle) < settings.SQL_CONNECTION_POOL_MAX_SIZE)
+            if keep:
+                idle.append((connection, time.time()))
+
+        if not keep:
+            _close(connection)
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+
+        for connections in idle.values():
+            for connection, _ in connections:
+                _close(connection)
+
+
+connection_pool = ConnectionPool()
@@ -1,7 +1,7 @@
 import logging
 
 from redash.query_runner import *
-from redash.utils import json_dumps, json_loads
+from redash.utils import json_loads
 
 logger = logging.getLogger(__name__)
 
@@ -31,6 +31,7 @@ except ImportError:
 
 class DB2(BaseSQLQueryRunner):
     noop_query = "SELECT 1 FROM SYSIBM.SYSDUMMY1"
+    streaming = True
 
     @classmethod
     def configuration_schema(cls):
@@ -54,6 +55,10 @@ class DB2(BaseSQLQueryRunner):
                 "dbname": {
                     "type": "string",
                     "title": "Database Name"
+                },
+                "batch_size": {
+                    "type": "number",
+                    "title": "Rows per Fetch"
                 }
             },
             "order": ['host', 'port', 'user', 'password', 'dbname'],
@@ -107,15 +112,15 @@ class DB2(BaseSQLQueryRunner):
 
         return schema.values()
 
-    def _get_connection(self):
+    def _connect(self):
         self.connection_string = "DATABASE={};HOSTNAME={};PORT={};PROTOCOL=TCPIP;UID={};PWD={};".format(
             self.configuration["dbname"], self.configuration["host"], self.configuration["port"], self.configuration["user"], self.configuration["password"])
         connection = ibm_db_dbi.connect(self.connection_string, "", "")
 
         return connection
 
-    def run_query(self, query, user):
-        connection = self._get_connection()
+    def run_query_stream(self, query, user):
+        connection = self.acquire_connection()
         cursor = connection.cursor()
 
         try:
@@ -123,28 +128,26 @@ class DB2(BaseSQLQueryRunner):
 
             if cursor.description is not None:
                 columns = self.fetch_columns([(i[0], types_map.get(i[1], None)) for i in cursor.description])
-                rows = [dict(zip((c['name'] for c in columns), row)) for row in cursor]
 
-                data = {'columns': columns, 'rows': rows}
-                error = None
-                json_data = json_dumps(data)
+                # The connection is released by the batches generator once the rows are consumed.
+                return ResultStream(columns, self._fetch_batches(connection, cursor, columns)), None
             else:
                 error = 'Query completed but it returned no data.'
-                json_data = None
+                self.release_connection(connection)
+                return None, error
         except (select.error, OSError) as e:
             error = "Query interrupted. Please retry."
-            json_data = None
         except ibm_db_dbi.DatabaseError as e:
             error = e.message
-            json_data = None
         except (KeyboardInterrupt, InterruptException):
             connection.cancel()
             error = "Query cancelled by user."
-            json_data = None
-        finally:
-            connection.close()
+        except Exception:
+            self.release_connection(connection, discard=True)
+            raise
 
-        return json_data, error
+        self.release_connection(connection, discard=True)
+        return None, error
 
 
 register(DB2)
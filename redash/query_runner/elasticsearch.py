@@ -1,11 +1,16 @@
 import logging
+import Queue
+import threading
+import time
 import urllib
+from collections import OrderedDict
 
 import requests
 from requests.auth import HTTPBasicAuth
 
+from redash import redis_connection, settings
 from redash.query_runner import *
-from redash.utils import json_dumps, json_loads
+from redash.utils import json_loads
 
 try:
     import http.client as http_client
@@ -42,8 +47,124 @@ PYTHON_TYPES_MAPPING = {
 }
 
 
+def _put(pages, item, cancelled):
+    """Puts an item on the queue unless (or until) the consumer is gone. Returns whether it was put."""
+    while not cancelled.is_set():
+        try:
+            pages.put(item, timeout=1)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+
+class MappingCache(object):
+    """
+    Flattened index mappings (field name to column type) by data source and index pattern, kept by each worker
+    process for ELASTICSEARCH_MAPPING_CACHE_TTL seconds.
+
+    - Refreshing a data source's schema drops its entries in every process: entries are stored along with a version
+      of the data source's mappings, kept in Redis and bumped on refresh.
+    - The least recently used entries are evicted to keep at most ELASTICSEARCH_MAPPING_CACHE_MAX_FIELDS fields.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._field_count = 0
+
+    @property
+    def enabled(self):
+        return settings.ELASTICSEARCH_MAPPING_CACHE_TTL > 0
+
+    def _version_key(self, data_source_id):
+        return 'elasticsearch:mappings_version:{}'.format(data_source_id)
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._field_count -= len(entry[2])
+        return entry
+
+    def version(self, data_source_id):
+        return redis_connection.get(self._version_key(data_source_id))
+
+    def get(self, data_source_id, index, version):
+        key = (data_source_id, index)
+        with self._lock:
+            entry = self._pop(key)
+            if entry is None:
+                return None
+
+            expires_at, entry_version, mappings = entry
+            if expires_at < time.time() or entry_version != version:
+                return None
+
+            self._entries[key] = entry
+            self._field_count += len(mappings)
+
+        # Callers add the types of aggregation columns to their copy.
+        return dict(mappings)
+
+    def set(self, data_source_id, index, mappings, version):
+        if len(mappings) > settings.ELASTICSEARCH_MAPPING_CACHE_MAX_FIELDS:
+            return
+
+        key = (data_source_id, index)
+        with self._lock:
+            self._pop(key)
+            while self._entries and \
+                    self._field_count + len(mappings) > settings.ELASTICSEARCH_MAPPING_CACHE_MAX_FIELDS:
+                self._pop(next(iter(self._entries)))
+
+            self._entries[key] = (time.time() + settings.ELASTICSEARCH_MAPPING_CACHE_TTL, version, dict(mappings))
+            self._field_count += len(mappings)
+
+    def invalidate(self, data_source_id):
+        """Drops the data source's entries and returns the new version of its mappings."""
+        version = str(redis_connection.incr(self._version_key(data_source_id)))
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == data_source_id]:
+                self._pop(key)
+        return version
+
+
+mapping_cache = MappingCache()
+
+
+def _flatten_mappings(mappings_data):
+    mappings = {}
+    for index_name in mappings_data:
+        index_mappings = mappings_data[index_name]
+        for m in index_mappings.get("mappings", {}):
+            if "properties" not in index_mappings["mappings"][m]:
+                continue
+            for property_name in index_mappings["mappings"][m]["properties"]:
+                property_data = index_mappings["mappings"][m]["properties"][property_name]
+                if property_name not in mappings:
+                    property_type = property_data.get("type", None)
+                    if property_type:
+                        if property_type in ELASTICSEARCH_TYPES_MAPPING:
+                            mappings[property_name] = ELASTICSEARCH_TYPES_MAPPING[property_type]
+                        else:
+                            mappings[property_name] = TYPE_STRING
+                            # raise Exception("Unknown property type: {0}".format(property_type))
+
+    return mappings
+
+
+def _request_error(e):
+    if isinstance(e, requests.HTTPError):
+        return "Failed to execute query. Return Code: {0}   Reason: {1}".format(e.response.status_code,
+                                                                             e.response.text)
+    return "Connection refused"
+
+
 class BaseElasticSearch(BaseQueryRunner):
     DEBUG_ENABLED = False
+    streaming = True
+    # Size of the pages of paginated searches which don't set one.
+    PAGE_SIZE = 1000
 
     @classmethod
     def configuration_schema(cls):
@@ -102,7 +223,7 @@ class BaseElasticSearch(BaseQueryRunner):
         mappings = {}
         error = None
         try:
-            r = requests.get(url, auth=self.auth)
+            r = self.get_session().get(url, auth=self.auth)
             r.raise_for_status()
 
             mappings = r.json()
@@ -117,27 +238,23 @@ class BaseElasticSearch(BaseQueryRunner):
 
         return mappings, error
 
-    def _get_query_mappings(self, url):
+    def _get_query_mappings(self, index_name):
+        use_cache = mapping_cache.enabled and self.data_source_id is not None
+        if use_cache:
+            # Read before fetching, so that mappings fetched while the schema gets refreshed aren't kept.
+            version = mapping_cache.version(self.data_source_id)
+            mappings = mapping_cache.get(self.data_source_id, index_name, version)
+            if mappings is not None:
+                return mappings, None
+
+        url = "{0}/{1}/_mapping".format(self.server_url, index_name)
         mappings_data, error = self._get_mappings(url)
         if error:
             return mappings_data, error
 
-        mappings = {}
-        for index_name in mappings_data:
-            index_mappings = mappings_data[index_name]
-            for m in index_mappings.get("mappings", {}):
-                if "properties" not in index_mappings["mappings"][m]:
-                    continue
-                for property_name in index_mappings["mappings"][m]["properties"]:
-                    property_data = index_mappings["mappings"][m]["properties"][property_name]
-                    if property_name not in mappings:
-                        property_type = property_data.get("type", None)
-                        if property_type:
-                            if property_type in ELASTICSEARCH_TYPES_MAPPING:
-                                mappings[property_name] = ELASTICSEARCH_TYPES_MAPPING[property_type]
-                            else:
-                                mappings[property_name] = TYPE_STRING
-                                # raise Exception("Unknown property type: {0}".format(property_type))
+        mappings = _flatten_mappings(mappings_data)
+        if use_cache:
+            mapping_cache.set(self.data_source_id, index_name, mappings, version)
 
         return mappings, error
 
@@ -158,6 +275,12 @@ class BaseElasticSearch(BaseQueryRunner):
         url = "{0}/_mappings".format(self.server_url)
         mappings, error = self._get_mappings(url)
 
+        if mappings and mapping_cache.enabled and self.data_source_id is not None:
+            # Queries of single indices get their mappings from this fetch until the next refresh.
+            version = mapping_cache.invalidate(self.data_source_id)
+            for name, index in mappings.items():
+                mapping_cache.set(self.data_source_id, name, _flatten_mappings({name: index}), version)
+
         if mappings:
             # make a schema for each index
             # the index contains a mappings dict with documents
@@ -275,9 +398,123 @@ class BaseElasticSearch(BaseQueryRunner):
         else:
             raise Exception("Redash failed to parse the results it got from Elasticsearch.")
 
+    def _search_pages(self, url, body):
+        r = self.get_session().get(url, json=body, auth=self.auth)
+        r.raise_for_status()
+        yield r.json()
+
+    def _search_after_pages(self, url, body):
+        """Pages of a sorted search, each one requested with the sort values of the previous page's last hit."""
+        body = dict(body)
+        while True:
+            page = next(self._search_pages(url, body))
+            yield page
+
+            hits = page.get('hits', {}).get('hits')
+            if not hits or 'sort' not in hits[-1]:
+                break
+            body['search_after'] = hits[-1]['sort']
+
+    def _scroll_pages(self, url, body, scroll):
+        """Pages of a scroll search (kept alive for `scroll`, e.g. "1m"), which is cleared once done with."""
+        session = self.get_session()
+        scroll_id = None
+        try:
+            r = session.get(url, params={'scroll': scroll}, json=body, auth=self.auth)
+            while True:
+                r.raise_for_status()
+                page = r.json()
+                scroll_id = page.get('_scroll_id', scroll_id)
+                yield page
+
+                if not page.get('hits', {}).get('hits'):
+                    break
+                r = session.post("{0}/_search/scroll".format(self.server_url),
+                                 json={'scroll': scroll, 'scroll_id': scroll_id}, auth=self.auth)
+        finally:
+            if scroll_id is not None:
+                try:
+                    session.delete("{0}/_search/scroll".format(self.server_url),
+                                   json={'scroll_id': [scroll_id]}, auth=self.auth)
+                except requests.exceptions.RequestException:
+                    logger.warning("Failed clearing scroll.", exc_info=True)
+
+    def _sliced_scroll_pages(self, url, body, scroll, slices):
+        """Pages of a scroll search split into `slices` sliced scrolls, which are read concurrently."""
+        pages = Queue.Queue(maxsize=slices * 2)
+        cancelled = threading.Event()
+
+        def read_slice(slice_id):
+            slice_pages = self._scroll_pages(url, dict(body, slice={'id': slice_id, 'max': slices}), scroll)
+            try:
+                for page in slice_pages:
+                    if not _put(pages, page, cancelled):
+                        return
+                _put(pages, None, cancelled)
+            except Exception as e:
+                _put(pages, e, cancelled)
+            finally:
+                slice_pages.close()
+
+        for slice_id in range(slices):
+            thread = threading.Thread(target=read_slice, args=(slice_id,))
+            thread.daemon = True
+            thread.start()
+
+        try:
+            remaining = slices
+            while remaining:
+                try:
+                    page = pages.get(timeout=1)
+                except Queue.Empty:
+                    continue
+
+                if page is None:
+                    remaining -= 1
+                elif isinstance(page, Exception):
+                    raise page
+                else:
+                    yield page
+        finally:
+            cancelled.set()
+
+    def _row_batches(self, mappings, result_fields, first_page, pages, columns, limit=None):
+        """
+        Parses each page (first_page, then the rest of `pages`) into a batch of rows, up to `limit` rows, extending
+        `columns` as fields show up.
+        """
+        row_count = 0
+        page = first_page
+        try:
+            while page is not None:
+                rows = []
+                self._parse_results(mappings, result_fields, page, columns, rows)
+                if limit is not None and row_count + len(rows) >= limit:
+                    yield rows[:limit - row_count]
+                    break
+                row_count += len(rows)
+                if rows:
+                    yield rows
+
+                # Aggregations aren't paginated.
+                if 'aggregations' in page:
+                    break
+                page = next(pages, None)
+        except requests.exceptions.RequestException as e:
+            logger.exception(e)
+            raise Exception(_request_error(e))
+        finally:
+            pages.close()
+
+    def _result_stream(self, mappings, result_fields, pages, limit=None):
+        # The first page is read right away, so that failed searches are reported as errors of the query.
+        first_page = next(pages, None)
+        columns = []
+        return ResultStream(columns, self._row_batches(mappings, result_fields, first_page, pages, columns, limit))
+
     def test_connection(self):
         try:
-            r = requests.get("{0}/_cluster/health".format(self.server_url), auth=self.auth)
+            r = self.get_session().get("{0}/_cluster/health".format(self.server_url), auth=self.auth)
             r.raise_for_status()
         except requests.HTTPError as e:
             logger.exception(e)
@@ -297,22 +534,7 @@ class Kibana(BaseElasticSearch):
     def annotate_query(cls):
         return False
 
-    def _execute_simple_query(self, url, auth, _from, mappings, result_fields, result_columns, result_rows):
-        url += "&from={0}".format(_from)
-        r = requests.get(url, auth=self.auth)
-        r.raise_for_status()
-
-        raw_result = r.json()
-
-        self._parse_results(mappings, result_fields, raw_result, result_columns, result_rows)
-
-        total = raw_result["hits"]["total"]
-        result_size = len(raw_result["hits"]["hits"])
-        logger.debug("Result Size: {0}  Total: {1}".format(result_size, total))
-
-        return raw_result["hits"]["total"]
-
-    def run_query(self, query, user):
+    def run_query_stream(self, query, user):
         try:
             error = None
 
@@ -331,9 +553,8 @@ class Kibana(BaseElasticSearch):
                 return None, error
 
             url = "{0}/{1}/_search?".format(self.server_url, index_name)
-            mapping_url = "{0}/{1}/_mapping".format(self.server_url, index_name)
 
-            mappings, error = self._get_query_mappings(mapping_url)
+            mappings, error = self._get_query_mappings(index_name)
             if error:
                 return None, error
 
@@ -345,38 +566,22 @@ class Kibana(BaseElasticSearch):
             logger.debug("Using URL: {0}".format(url))
             logger.debug("Using Query: {0}".format(query_data))
 
-            result_columns = []
-            result_rows = []
             if isinstance(query_data, str) or isinstance(query_data, unicode):
-                _from = 0
-                while True:
-                    query_size = size if limit >= (_from + size) else (limit - _from)
-                    total = self._execute_simple_query(url + "&size={0}".format(query_size), self.auth, _from, mappings,
-                                                       result_fields, result_columns, result_rows)
-                    _from += size
-                    if _from >= limit:
-                        break
+                # Pages are read with a scroll rather than from/size, which gets slower with every page and can't go
+                # past the index's max_result_window.
+                url += "&size={0}".format(min(size, limit))
+                pages = self._scroll_pages(url, None, "1m")
+                return self._result_stream(mappings, result_fields, pages, limit), None
             else:
                 # TODO: Handle complete ElasticSearch queries (JSON based sent over HTTP POST)
                 raise Exception("Advanced queries are not supported")
-
-            json_data = json_dumps({
-                "columns": result_columns,
-                "rows": result_rows
-            })
         except KeyboardInterrupt:
             error = "Query cancelled by user."
-            json_data = None
-        except requests.HTTPError as e:
-            logger.exception(e)
-            error = "Failed to execute query. Return Code: {0}   Reason: {1}".format(r.status_code, r.text)
-            json_data = None
         except requests.exceptions.RequestException as e:
             logger.exception(e)
-            error = "Connection refused"
-            json_data = None
+            error = _request_error(e)
 
-        return json_data, error
+        return None, error
 
 
 class ElasticSearch(BaseElasticSearch):
@@ -393,7 +598,7 @@ class ElasticSearch(BaseElasticSearch):
     def name(cls):
         return 'Elasticsearch'
 
-    def run_query(self, query, user):
+    def run_query_stream(self, query, user):
         try:
             error = None
 
@@ -402,46 +607,49 @@ class ElasticSearch(BaseElasticSearch):
 
             index_name = query_dict.pop("index", "")
             result_fields = query_dict.pop("result_fields", None)
+            # Pagination: with "scroll" (its keep alive, e.g. "1m") hits are read with the scroll API, split into
+            # "slices" sliced scrolls read concurrently. Otherwise, with a "limit" hits are read page by page with
+            # search_after, which requires a "sort". Either way, reading stops after "limit" hits.
+            scroll = query_dict.pop("scroll", None)
+            slices = int(query_dict.pop("slices", 1))
+            limit = query_dict.pop("limit", None)
+            limit = int(limit) if limit is not None else None
 
             if not self.server_url:
                 error = "Missing configuration key 'server'"
                 return None, error
 
             url = "{0}/{1}/_search".format(self.server_url, index_name)
-            mapping_url = "{0}/{1}/_mapping".format(self.server_url, index_name)
 
-            mappings, error = self._get_query_mappings(mapping_url)
+            mappings, error = self._get_query_mappings(index_name)
             if error:
                 return None, error
 
             logger.debug("Using URL: %s", url)
             logger.debug("Using query: %s", query_dict)
-            r = requests.get(url, json=query_dict, auth=self.auth)
-            r.raise_for_status()
-            logger.debug("Result: %s", r.json())
 
-            result_columns = []
-            result_rows = []
-            self._parse_results(mappings, result_fields, r.json(), result_columns, result_rows)
+            if scroll or limit is not None:
+                query_dict.setdefault("size", self.PAGE_SIZE)
+
+            if scroll and slices > 1:
+                pages = self._sliced_scroll_pages(url, query_dict, scroll, slices)
+            elif scroll:
+                pages = self._scroll_pages(url, query_dict, scroll)
+            elif limit is not None:
+                if "sort" not in query_dict:
+                    return None, "Paginating with a limit requires a sort (or a scroll)."
+                pages = self._search_after_pages(url, query_dict)
+            else:
+                pages = self._search_pages(url, query_dict)
 
-            json_data = json_dumps({
-                "columns": result_columns,
-                "rows": result_rows
-            })
+            return self._result_stream(mappings, result_fields, pages, limit), None
         except KeyboardInterrupt:
-            logger.exception(e)
             error = "Query cancelled by user."
-            json_data = None
-        except requests.HTTPError as e:
-            logger.exception(e)
-            error = "Failed to execute query. Return Code: {0}   Reason: {1}".format(r.status_code, r.text)
-            json_data = None
         except requests.exceptions.RequestException as e:
             logger.exception(e)
-            error = "Connection refused"
-            json_data = None
+            error = _request_error(e)
 
-        return json_data, error
+        return None, error
 
 
 # register(Kibana)
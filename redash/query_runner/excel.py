@@ -35,27 +35,18 @@ def __extract_data(sheet, columns, mapping_idx_to_name):
     nrows = sheet.nrows
 
     rows = []
-    col_data_type_flags = []
-
-    for col_idx in range(0, ncols):
-        col_data_type_flags.append(set())
 
     for row_idx in range(1, nrows):
         row = {}
         for col_idx in range(0, ncols):
-            cell_v = sheet.cell_value(row_idx, col_idx)
-            row[mapping_idx_to_name[col_idx]] = cell_v
-            cell_type = guess_type(cell_v)
-            col_data_type_flags[col_idx].add(cell_type)
+            row[mapping_idx_to_name[col_idx]] = sheet.cell_value(row_idx, col_idx)
 
         rows.append(row)
 
     for col_idx in range(0, ncols):
-        if len(col_data_type_flags[col_idx]) == 1:
-            columns[col_idx]['type'] = col_data_type_flags[col_idx].pop()
-        elif len(col_data_type_flags[col_idx]) == 2 and TYPE_FLOAT in col_data_type_flags[
-            col_idx] and TYPE_INTEGER in col_data_type_flags[col_idx]:
-            columns[col_idx]['type'] = TYPE_FLOAT
+        column_type = guess_column_type(sheet.col_values(col_idx, 1))
+        if column_type is not None:
+            columns[col_idx]['type'] = column_type
 
     data = {'columns': columns, 'rows': rows}
 
@@ -1,30 +1,94 @@
 import datetime
 import logging
-
-import requests
+import re
+import time
 
 from redash.query_runner import *
+from redash.query_runner.time_window_cache import time_window_cache
 from redash.utils import json_dumps
 
 logger = logging.getLogger(__name__)
 
+COLUMNS = ({'name': 'Time::x', 'type': TYPE_DATETIME},
+           {'name': 'value::y', 'type': TYPE_FLOAT},
+           {'name': 'name::series', 'type': TYPE_STRING})
+
+TIME_UNITS = {'s': 1, 'min': 60, 'h': 3600, 'd': 86400, 'w': 604800, 'mon': 2592000, 'y': 31536000}
+_RELATIVE_TIME = re.compile(r'^-(\d+)(s|secs?|seconds?|mins?|minutes?|h|hours?|d|days?|w|weeks?|mon|months?|y|years?)$')
+# Series paths (with wildcards), without render functions: their points don't depend on the requested window, unlike
+# those of functions like summarize, movingAverage, integral or timeShift.
+_SERIES_PATH = re.compile(r'^[\w.*?\-\[\]{},:]+$')
 
-def _transform_result(response):
-    columns = ({'name': 'Time::x', 'type': TYPE_DATETIME},
-               {'name': 'value::y', 'type': TYPE_FLOAT},
-               {'name': 'name::series', 'type': TYPE_STRING})
 
-    rows = []
+def _timed_rows(series_list):
+    """The rows of render API results as (timestamp, row) pairs."""
+    timed_rows = []
 
-    for series in response.json():
+    for series in series_list:
         for values in series['datapoints']:
-            timestamp = datetime.datetime.fromtimestamp(int(values[1]))
-            rows.append({'Time::x': timestamp, 'name::series': series['target'], 'value::y': values[0]})
+            timestamp = int(values[1])
+            timed_rows.append((timestamp, {'Time::x': datetime.datetime.fromtimestamp(timestamp),
+                                           'name::series': series['target'],
+                                           'value::y': values[0]}))
+
+    return timed_rows
+
 
-    data = {'columns': columns, 'rows': rows}
+def _transform_result(response):
+    rows = [row for _, row in _timed_rows(response.json())]
+
+    data = {'columns': COLUMNS, 'rows': rows}
     return json_dumps(data)
 
 
+def _step(timed_rows):
+    """The smallest interval between points of a series, None if no series has two points."""
+    timestamps = {}
+    for timestamp, row in timed_rows:
+        timestamps.setdefault(row['name::series'], []).append(timestamp)
+
+    intervals = [later - earlier for series in timestamps.values() for earlier, later in zip(series, series[1:])]
+    return min(intervals) if intervals else None
+
+
+def _same_resolution(cached_rows, rows):
+    """
+    Graphite reads a window from the finest archive retaining all of it, so a short recent window can come from a
+    finer archive than the cached (longer) one. Its points are only spliced on when they have the same step.
+    """
+    step = _step(rows)
+    return step is not None and step == _step(cached_rows)
+
+
+def _window_independent(params):
+    """Whether the points of a render query are the same whatever the window they're fetched for."""
+    targets = [param[len('target='):] for param in params if param.startswith('target=')]
+    return (bool(targets) and all(_SERIES_PATH.match(target) for target in targets) and
+            # Points are consolidated to fit maxDataPoints over the whole window.
+            not any(param.startswith('maxDataPoints=') for param in params))
+
+
+def _parse_time(value, now):
+    """Seconds since the epoch of a from/until value ("now", a timestamp or relative like -24h), None otherwise."""
+    if value == 'now':
+        return now
+    if value.isdigit():
+        return int(value)
+
+    match = _RELATIVE_TIME.match(value)
+    if match is None:
+        return None
+
+    amount, unit = match.groups()
+    if unit.startswith('mon'):
+        unit = 'mon'
+    elif unit.startswith('min'):
+        unit = 'min'
+    else:
+        unit = unit[0]
+    return now - int(amount) * TIME_UNITS[unit]
+
+
 class Graphite(BaseQueryRunner):
     @classmethod
     def configuration_schema(cls):
@@ -66,17 +130,52 @@ class Graphite(BaseQueryRunner):
         self.base_url = "%s/render?format=json&" % self.configuration['url']
 
     def test_connection(self):
-        r = requests.get("{}/render".format(self.configuration['url']), auth=self.auth, verify=self.verify)
+        r = self.get_session().get("{}/render".format(self.configuration['url']), auth=self.auth, verify=self.verify)
         if r.status_code != 200:
             raise Exception("Got invalid response from Graphite (http status code: {0}).".format(r.status_code))
 
+    def _cached_result(self, params):
+        """
+        Results of queries over a time window (from/until), of which only what's newer than the cached window of the
+        same targets is fetched. None if the query's window can't be told, or its targets aren't plain series paths.
+        """
+        if not _window_independent(params):
+            return None
+
+        now = int(time.time())
+        other_params = [param for param in params if not param.startswith(('from=', 'until='))]
+        window = dict(param.split('=', 1) for param in params if param.startswith(('from=', 'until=')))
+        # The render API's defaults.
+        start = _parse_time(window.get('from', '-24h'), now)
+        end = _parse_time(window.get('until', 'now'), now)
+        if start is None or end is None:
+            return None
+
+        def fetch(fetch_start, fetch_end):
+            # Graphite returns the points after `from`.
+            window_params = ['from={}'.format(int(fetch_start) - 1), 'until={}'.format(int(fetch_end))]
+            url = "%s%s" % (self.base_url, "&".join(other_params + window_params))
+            response = self.get_session().get(url, auth=self.auth, verify=self.verify)
+            if response.status_code != 200:
+                raise Exception("Failed getting results (%d)" % response.status_code)
+            return COLUMNS, _timed_rows(response.json())
+
+        key = (self.data_source_id, tuple(sorted(other_params)))
+        columns, rows = time_window_cache.get(key, start, end, fetch, consistent=_same_resolution)
+        return json_dumps({'columns': columns, 'rows': rows})
+
     def run_query(self, query, user):
         url = "%s%s" % (self.base_url, "&".join(query.split("\n")))
         error = None
         data = None
 
         try:
-            response = requests.get(url, auth=self.auth, verify=self.verify)
+            if time_window_cache.enabled and self.data_source_id is not None:
+                data = self._cached_result(query.split("\n"))
+                if data is not None:
+                    return data, None
+
+            response = self.get_session().get(url, auth=self.auth, verify=self.verify)
 
             if response.status_code == 200:
                 data = _transform_result(response)
@@ -2,7 +2,6 @@ import base64
 import logging
 
 from redash.query_runner import *
-from redash.utils import json_dumps
 
 logger = logging.getLogger(__name__)
 
@@ -37,6 +36,7 @@ types_map = {
 
 class Hive(BaseSQLQueryRunner):
     noop_query = "SELECT 1"
+    streaming = True
 
     @classmethod
     def configuration_schema(cls):
@@ -55,6 +55,10 @@ class Hive(BaseSQLQueryRunner):
                 "username": {
                     "type": "string"
                 },
+                "batch_size": {
+                    "type": "number",
+                    "title": "Rows per Fetch"
+                },
             },
             "order": ["host", "port", "database", "username"],
             "required": ["host"]
@@ -92,7 +96,7 @@ class Hive(BaseSQLQueryRunner):
                 schema[table_name] = {'name': table_name, 'columns': columns}
         return schema.values()
 
-    def _get_connection(self):
+    def _connect(self):
         host = self.configuration['host']
 
         connection = hive.connect(
@@ -104,20 +108,18 @@ class Hive(BaseSQLQueryRunner):
 
         return connection
 
-    def run_query(self, query, user):
+    def run_query_stream(self, query, user):
         connection = None
         try:
-            connection = self._get_connection()
+            connection = self.acquire_connection()
             cursor = connection.cursor()
 
             cursor.execute(query)
 
-            column_names = []
             columns = []
 
             for column in cursor.description:
                 column_name = column[COLUMN_NAME]
-                column_names.append(column_name)
 
                 columns.append({
                     'name': column_name,
@@ -125,21 +127,17 @@ class Hive(BaseSQLQueryRunner):
                     'type': types_map.get(column[COLUMN_TYPE], None)
                 })
 
-            rows = [dict(zip(column_names, row)) for row in cursor]
-
-            data = {'columns': columns, 'rows': rows}
-            json_data = json_dumps(data)
-            error = None
+            # The connection is released by the batches generator once the rows are consumed.
+            return ResultStream(columns, self._fetch_batches(connection, cursor, columns)), None
         except KeyboardInterrupt:
             if connection:
                 connection.cancel()
-            error = "Query cancelled by user."
-            json_data = None
-        finally:
+                self.release_connection(connection, discard=True)
+            return None, "Query cancelled by user."
+        except Exception:
             if connection:
-                connection.close()
-
-        return json_data, error
+                self.release_connection(connection, discard=True)
+            raise
 
 
 class HiveHttp(Hive):
@@ -181,13 +179,17 @@ class HiveHttp(Hive):
                     "type": "string",
                     "title": "Password"
                 },
+                "batch_size": {
+                    "type": "number",
+                    "title": "Rows per Fetch"
+                },
             },
             "order": ["host", "port", "http_path", "username", "http_password", "database", "http_scheme"],
             "secret": ["http_password"],
             "required": ["host", "http_path"]
         }
 
-    def _get_connection(self):
+    def _connect(self):
         host = self.configuration['host']
 
         scheme = self.configuration.get('http_scheme', 'https')
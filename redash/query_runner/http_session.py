@@ -0,0 +1,77 @@
+import logging
+import os
+import threading
+import time
+from cookielib import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from redash import settings
+
+logger = logging.getLogger(__name__)
+
+
+def create_session():
+    """
+    A session with keep-alive connection pools, which retries failed connections. Cookies aren't kept, so requests
+    behave as they would without a session.
+    """
+    session = requests.Session()
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+    retries = Retry(total=settings.HTTP_SESSION_RETRIES, read=False, status=False,
+                    backoff_factor=settings.HTTP_SESSION_RETRY_BACKOFF, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=settings.HTTP_SESSION_POOL_SIZE,
+                          pool_maxsize=settings.HTTP_SESSION_POOL_SIZE,
+                          max_retries=retries)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+class SessionRegistry(object):
+    """
+    The HTTP sessions of a worker process, one per data source, so that consecutive requests of a data source (e.g.
+    pages of a paginated fetch) reuse warm connections. Sessions unused for more than HTTP_SESSION_MAX_IDLE_TIME
+    seconds are closed, and those inherited over fork are dropped.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._pid = os.getpid()
+
+    def get(self, key):
+        now = time.time()
+        expire_before = now - settings.HTTP_SESSION_MAX_IDLE_TIME
+
+        with self._lock:
+            if self._pid != os.getpid():
+                self._sessions = {}
+                self._pid = os.getpid()
+
+            expired = [k for k, (_, last_used) in self._sessions.iteritems() if last_used < expire_before and k != key]
+            expired = [self._sessions.pop(k)[0] for k in expired]
+
+            session = self._sessions.get(key, (None, None))[0]
+            if session is None:
+                session = create_session()
+            self._sessions[key] = (session, now)
+
+        for expired_session in expired:
+            expired_session.close()
+
+        return session
+
+    def clear(self):
+        with self._lock:
+            sessions, self._sessions = self._sessions, {}
+
+        for session, _ in sessions.values():
+            session.close()
+
+
+http_sessions = SessionRegistry()
@@ -1,6 +1,12 @@
+import calendar
 import logging
+import re
+import time
+
+from dateutil import parser
 
 from redash.query_runner import *
+from redash.query_runner.time_window_cache import time_window_cache
 from redash.utils import json_dumps
 
 logger = logging.getLogger(__name__)
@@ -14,40 +20,92 @@ except ImportError:
     enabled = False
 
 
-def _transform_result(results):
+DURATION_UNITS = {'ns': 1e-9, 'u': 1e-6, 'ms': 0.001, 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+_DURATION = r'(\d+)(ns|u|ms|s|m|h|d|w)\b'
+_TIME_CONDITION = re.compile(r'\btime\s*[<>=!]', re.IGNORECASE)
+_RELATIVE_START = re.compile(r'\btime\s*>=?\s*now\(\)\s*-\s*' + _DURATION, re.IGNORECASE)
+_GROUP_BY_TIME = re.compile(r'\bgroup\s+by\b.*\btime\(\s*' + _DURATION + r'\s*\)', re.IGNORECASE)
+# What makes the points of a query depend on the whole window (or on the points before a bucket), so a fresh tail
+# can't be spliced onto cached points: row limits, newest first ordering, selectors, transformations and filling
+# empty buckets from their neighbours.
+_WINDOW_DEPENDENT = re.compile(r'\b(?:s?limit|s?offset|into)\b|\border\s+by\s+time\s+desc\b|'
+                               r'\bfill\s*\(\s*(?:previous|linear)\s*\)|'
+                               r'\b(?:top|bottom|first|last|max|min|percentile|sample|derivative|'
+                               r'non_negative_derivative|difference|non_negative_difference|moving_average|'
+                               r'cumulative_sum|integral|elapsed|holt_winters|holt_winters_with_fit)\s*\(',
+                               re.IGNORECASE)
+_SELECTED_FIELDS = re.compile(r'^\s*select\s+(.*?)\s+from\s+(.)', re.IGNORECASE | re.DOTALL)
+
+
+class _NotCacheable(Exception):
+    pass
+
+
+def _window_independent(statement):
+    """
+    Whether the points of a statement are the same whatever the window they're fetched for: raw series selects and
+    GROUP BY time() aggregates, without row limits, newest first ordering, selectors, transformations or fill(previous)
+    / fill(linear).
+    """
+    if _WINDOW_DEPENDENT.search(statement):
+        return False
+    if _GROUP_BY_TIME.search(statement):
+        return True
+
+    # Raw selects only: no aggregates over the whole window, nor subqueries.
+    fields = _SELECTED_FIELDS.match(statement)
+    return fields is not None and '(' not in fields.group(1) and fields.group(2) != '('
+
+
+def _transform_rows(results):
     result_columns = []
-    result_rows = []
+    column_positions = {}
 
     for result in results:
         for series in result.raw.get('series', []):
-            for column in series['columns']:
-                if column not in result_columns:
+            for column in series['columns'] + series.get('tags', {}).keys():
+                if column not in column_positions:
+                    column_positions[column] = len(result_columns)
                     result_columns.append(column)
-            tags = series.get('tags', {})
-            for key in tags.keys():
-                if key not in result_columns:
-                    result_columns.append(key)
+
+    result_rows = []
 
     for result in results:
         for series in result.raw.get('series', []):
+            tags = series.get('tags', {})
+
+            # Where a series has the same column twice, the first one is used; tags win over columns.
+            positions = {}
+            for index, column in enumerate(series['columns']):
+                if column not in tags:
+                    positions.setdefault(column, index)
+            positions = positions.items()
+
             for point in series['values']:
-                result_row = {}
-                for column in result_columns:
-                    tags = series.get('tags', {})
-                    if column in tags:
-                        result_row[column] = tags[column]
-                    elif column in series['columns']:
-                        index = series['columns'].index(column)
-                        value = point[index]
-                        result_row[column] = value
+                result_row = dict(tags)
+                for column, index in positions:
+                    result_row[column] = point[index]
                 result_rows.append(result_row)
 
+    return [{'name': c} for c in result_columns], result_rows
+
+
+def _transform_result(results):
+    columns, rows = _transform_rows(results)
     return json_dumps({
-        "columns": [{'name': c} for c in result_columns],
-        "rows": result_rows
+        "columns": columns,
+        "rows": rows
     })
 
 
+def _timestamp(value):
+    try:
+        date_time = parser.parse(value)
+    except (TypeError, ValueError, OverflowError):
+        raise _NotCacheable()
+    return calendar.timegm(date_time.utctimetuple()) + date_time.microsecond / 1e6
+
+
 class InfluxDB(BaseQueryRunner):
     noop_query = "show measurements limit 1"
 
@@ -75,6 +133,43 @@ class InfluxDB(BaseQueryRunner):
     def type(cls):
         return "influxdb"
 
+    def _cached_result(self, client, query):
+        """
+        Results of a query over the last X (a single statement with a single `time > now() - X` condition), of which
+        only what's newer than the cached window of the same query is fetched. None if the query doesn't qualify,
+        which includes those whose points depend on the window (see _window_independent).
+        """
+        statement = query.strip().rstrip(';')
+        match = _RELATIVE_START.search(statement)
+        if ';' in statement or match is None or len(_TIME_CONDITION.findall(statement)) != 1:
+            return None
+        if not _window_independent(statement):
+            return None
+
+        end = time.time()
+        start = end - int(match.group(1)) * DURATION_UNITS[match.group(2).lower()]
+
+        align = None
+        group_by = _GROUP_BY_TIME.search(statement)
+        if group_by is not None:
+            # Buckets of GROUP BY time() are aligned on the epoch.
+            interval = int(group_by.group(1)) * DURATION_UNITS[group_by.group(2).lower()]
+            align = lambda timestamp: timestamp - timestamp % interval
+
+        def fetch(fetch_start, fetch_end):
+            condition = u'time >= {}ms'.format(int(fetch_start * 1000))
+            results = client.query(statement[:match.start()] + condition + statement[match.end():])
+            if not isinstance(results, list):
+                results = [results]
+            columns, rows = _transform_rows(results)
+            return columns, [(_timestamp(row.get('time')), row) for row in rows]
+
+        columns, rows = time_window_cache.get((self.data_source_id, statement), start, end, fetch, align)
+        return json_dumps({
+            "columns": columns,
+            "rows": rows
+        })
+
     def run_query(self, query, user):
         client = InfluxDBClusterClient.from_DSN(self.configuration['url'])
 
@@ -82,6 +177,14 @@ class InfluxDB(BaseQueryRunner):
         logger.debug("influxdb got query: %s", query)
 
         try:
+            if time_window_cache.enabled and self.data_source_id is not None:
+                try:
+                    json_data = self._cached_result(client, query)
+                    if json_data is not None:
+                        return json_data, None
+                except _NotCacheable:
+                    logger.debug("Rows without a parseable time, not caching query: %s", query)
+
             results = client.query(query)
             if not isinstance(results, list):
                 results = [results]
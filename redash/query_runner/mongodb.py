@@ -4,8 +4,9 @@ import re
 
 from dateutil.parser import parse
 
+from redash import settings
 from redash.query_runner import *
-from redash.utils import JSONEncoder, json_dumps, json_loads
+from redash.utils import JSONEncoder, json_loads
 
 logger = logging.getLogger(__name__)
 
@@ -80,42 +81,55 @@ def _get_column_by_name(columns, column_name):
     return None
 
 
-def parse_results(results):
-    rows = []
-    columns = []
+def _add_column(columns, column_index, name, value):
+    if name not in column_index:
+        column = {
+            "name": name,
+            "friendly_name": name,
+            "type": TYPES_MAP.get(type(value), TYPE_STRING)
+        }
+        columns.append(column)
+        column_index[name] = column
 
-    for row in results:
-        parsed_row = {}
 
-        for key in row:
-            if isinstance(row[key], dict):
-                for inner_key in row[key]:
-                    column_name = u'{}.{}'.format(key, inner_key)
-                    if _get_column_by_name(columns, column_name) is None:
-                        columns.append({
-                            "name": column_name,
-                            "friendly_name": column_name,
-                            "type": TYPES_MAP.get(type(row[key][inner_key]), TYPE_STRING)
-                        })
+def _parse_result_row(row, columns, column_index=None):
+    """
+    Flattens a document into a row, adding the columns it introduces. column_index maps the names of `columns` to
+    them; callers parsing many rows should keep passing the same one (it's built from `columns` when not given).
+    """
+    if column_index is None:
+        column_index = {c["name"]: c for c in columns if "name" in c}
 
-                    parsed_row[column_name] = row[key][inner_key]
+    parsed_row = {}
 
-            else:
-                if _get_column_by_name(columns, key) is None:
-                    columns.append({
-                        "name": key,
-                        "friendly_name": key,
-                        "type": TYPES_MAP.get(type(row[key]), TYPE_STRING)
-                    })
+    for key, value in row.iteritems():
+        if isinstance(value, dict):
+            for inner_key, inner_value in value.iteritems():
+                column_name = u'{}.{}'.format(key, inner_key)
+                _add_column(columns, column_index, column_name, inner_value)
+                parsed_row[column_name] = inner_value
 
-                parsed_row[key] = row[key]
+        else:
+            _add_column(columns, column_index, key, value)
+            parsed_row[key] = value
+
+    return parsed_row
 
-        rows.append(parsed_row)
+
+def parse_results(results):
+    rows = []
+    columns = []
+    column_index = {}
+
+    for row in results:
+        rows.append(_parse_result_row(row, columns, column_index))
 
     return rows, columns
 
 
 class MongoDB(BaseQueryRunner):
+    streaming = True
+
     @classmethod
     def configuration_schema(cls):
         return {
@@ -218,7 +232,7 @@ class MongoDB(BaseQueryRunner):
 
         return schema.values()
 
-    def run_query(self, query, user):
+    def run_query_stream(self, query, user):
         db = self._get_db()
 
         logger.debug("mongodb connection string: %s", self.configuration['connectionString'])
@@ -264,7 +278,6 @@ class MongoDB(BaseQueryRunner):
                 s.append((field_data["name"], field_data["direction"]))
 
         columns = []
-        rows = []
 
         cursor = None
         if q or (not q and not aggregate):
@@ -281,10 +294,14 @@ class MongoDB(BaseQueryRunner):
 
             if "count" in query_data:
                 cursor = cursor.count()
+            else:
+                # Documents are fetched (and turned into rows) as many at a time as there are rows per batch.
+                cursor = cursor.batch_size(settings.QUERY_RESULTS_ROW_BATCH_SIZE)
 
         elif aggregate:
             allow_disk_use = query_data.get('allowDiskUse', False)
-            r = db[collection].aggregate(aggregate, allowDiskUse=allow_disk_use)
+            r = db[collection].aggregate(aggregate, allowDiskUse=allow_disk_use,
+                                         batchSize=settings.QUERY_RESULTS_ROW_BATCH_SIZE)
 
             # Backwards compatibility with older pymongo versions.
             #
@@ -303,31 +320,31 @@ class MongoDB(BaseQueryRunner):
                 "type": TYPE_INTEGER
             })
 
-            rows.append({"count": cursor})
+            rows = [{"count": cursor}]
         else:
-            rows, columns = parse_results(cursor)
+            column_index = {}
+            rows = (_parse_result_row(row, columns, column_index) for row in cursor)
 
-        if f:
+        batches = self._iter_batches(rows, columns, f, query_data.get('sortColumns'))
+        return ResultStream(columns, batches, MongoDBJSONEncoder), None
+
+    def _iter_batches(self, rows, columns, fields, sort_columns):
+        for batch in iter_batches(rows):
+            yield batch
+
+        # Documents may add columns up to the very last one, so the columns are only ordered at the end.
+        if fields:
             ordered_columns = []
-            for k in sorted(f, key=f.get):
+            for k in sorted(fields, key=fields.get):
                 column = _get_column_by_name(columns, k)
                 if column:
                     ordered_columns.append(column)
 
-            columns = ordered_columns
-
-        if query_data.get('sortColumns'):
-            reverse = query_data['sortColumns'] == 'desc'
-            columns = sorted(columns, key=lambda col: col['name'], reverse=reverse)
-
-        data = {
-            "columns": columns,
-            "rows": rows
-        }
-        error = None
-        json_data = json_dumps(data, cls=MongoDBJSONEncoder)
+            columns[:] = ordered_columns
 
-        return json_data, error
+        if sort_columns:
+            reverse = sort_columns == 'desc'
+            columns.sort(key=lambda col: col['name'], reverse=reverse)
 
 
 register(MongoDB)
@@ -1,7 +1,7 @@
 import logging
 
 from redash.query_runner import *
-from redash.utils import json_dumps, json_loads
+from redash.utils import json_loads
 
 logger = logging.getLogger(__name__)
 
@@ -26,6 +26,7 @@ types_map = {
 
 class SqlServer(BaseSQLQueryRunner):
     noop_query = "SELECT 1"
+    streaming = True
 
     @classmethod
     def configuration_schema(cls):
@@ -59,6 +60,10 @@ class SqlServer(BaseSQLQueryRunner):
                 "db": {
                     "type": "string",
                     "title": "Database Name"
+                },
+                "batch_size": {
+                    "type": "number",
+                    "title": "Rows per Fetch"
                 }
             },
             "required": ["db"],
@@ -111,23 +116,30 @@ class SqlServer(BaseSQLQueryRunner):
 
         return schema.values()
 
-    def run_query(self, query, user):
+    def _connect(self):
+        server = self.configuration.get('server', '')
+        user = self.configuration.get('user', '')
+        password = self.configuration.get('password', '')
+        db = self.configuration['db']
+        port = self.configuration.get('port', 1433)
+        tds_version = self.configuration.get('tds_version', '7.0')
+        charset = self.configuration.get('charset', 'UTF-8')
+
+        if port != 1433:
+            server = server + ':' + str(port)
+
+        return pymssql.connect(server=server, user=user, password=password, database=db,
+                               tds_version=tds_version, charset=charset)
+
+    def run_query_stream(self, query, user):
         connection = None
+        stream = None
+        release = True
+        discard = True
 
         try:
-            server = self.configuration.get('server', '')
-            user = self.configuration.get('user', '')
-            password = self.configuration.get('password', '')
-            db = self.configuration['db']
-            port = self.configuration.get('port', 1433)
-            tds_version = self.configuration.get('tds_version', '7.0')
             charset = self.configuration.get('charset', 'UTF-8')
-
-            if port != 1433:
-                server = server + ':' + str(port)
-
-            connection = pymssql.connect(server=server, user=user, password=password, database=db,
-                                         tds_version=tds_version, charset=charset)
+            connection = self.acquire_connection()
 
             if isinstance(query, unicode):
                 query = query.encode(charset)
@@ -136,20 +148,19 @@ class SqlServer(BaseSQLQueryRunner):
             logger.debug("SqlServer running query: %s", query)
 
             cursor.execute(query)
-            data = cursor.fetchall()
 
             if cursor.description is not None:
                 columns = self.fetch_columns([(i[0], types_map.get(i[1], None)) for i in cursor.description])
-                rows = [dict(zip((c['name'] for c in columns), row)) for row in data]
 
-                data = {'columns': columns, 'rows': rows}
-                json_data = json_dumps(data)
+                # The connection is released by the batches generator once the rows are consumed.
+                release = False
+                stream = ResultStream(columns, self._fetch_batches(connection, cursor, columns))
                 error = None
             else:
                 error = "No data was returned."
-                json_data = None
 
-            cursor.close()
+                cursor.close()
+                discard = False
         except pymssql.Error as e:
             try:
                 # Query errors are at `args[1]`
@@ -157,16 +168,14 @@ class SqlServer(BaseSQLQueryRunner):
             except IndexError:
                 # Connection errors are `args[0][1]`
                 error = e.args[0][1]
-            json_data = None
         except KeyboardInterrupt:
             connection.cancel()
             error = "Query cancelled by user."
-            json_data = None
         finally:
-            if connection:
-                connection.close()
+            if connection and release:
+                self.release_connection(connection, discard=discard)
 
-        return json_data, error
+        return stream, error
 
 
 register(SqlServer)
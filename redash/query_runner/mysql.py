@@ -3,7 +3,7 @@ import os
 
 from redash.query_runner import *
 from redash.settings import parse_boolean
-from redash.utils import json_dumps, json_loads
+from redash.utils import json_loads
 
 logger = logging.getLogger(__name__)
 types_map = {
@@ -28,6 +28,8 @@ types_map = {
 
 class Mysql(BaseSQLQueryRunner):
     noop_query = "SELECT 1"
+    streaming = True
+    pool_connections = True
 
     @classmethod
     def configuration_schema(cls):
@@ -57,6 +59,10 @@ class Mysql(BaseSQLQueryRunner):
                     'type': 'number',
                     'default': 3306,
                     'title': 'Port'
+                },
+                'batch_size': {
+                    'type': 'number',
+                    'title': 'Rows per Fetch'
                 }
             },
             "order": ['host', 'port', 'user', 'passwd', 'db'],
@@ -128,53 +134,86 @@ class Mysql(BaseSQLQueryRunner):
 
         return schema.values()
 
-    def run_query(self, query, user):
+    def _connect(self):
+        import MySQLdb
+
+        return MySQLdb.connect(host=self.configuration.get('host', ''),
+                               user=self.configuration.get('user', ''),
+                               passwd=self.configuration.get('passwd', ''),
+                               db=self.configuration['db'],
+                               port=self.configuration.get('port', 3306),
+                               charset='utf8', use_unicode=True,
+                               ssl=self._get_ssl_parameters(),
+                               connect_timeout=60)
+
+    def _reset_connection(self, connection):
+        # COM_CHANGE_USER rolls back the transaction and resets the whole session: variables, temporary tables,
+        # locks, the current database. Like a new MySQLdb connection, it's then set back to utf8 without autocommit.
+        connection.change_user(self.configuration.get('user', ''), self.configuration.get('passwd', ''),
+                               self.configuration['db'])
+        connection.set_character_set('utf8')
+        connection.autocommit(False)
+
+    def run_query_stream(self, query, user):
         import MySQLdb
+        from MySQLdb.cursors import SSCursor
+
+        # Single statements are read from an unbuffered cursor, as the rows are consumed. Of several statements only
+        # the last result set is returned, which takes buffering the ones before it.
+        unbuffered = self._single_statement(query) is not None
 
         connection = None
+        stream = None
+        release = True
+        discard = True
         try:
-            connection = MySQLdb.connect(host=self.configuration.get('host', ''),
-                                         user=self.configuration.get('user', ''),
-                                         passwd=self.configuration.get('passwd', ''),
-                                         db=self.configuration['db'],
-                                         port=self.configuration.get('port', 3306),
-                                         charset='utf8', use_unicode=True,
-                                         ssl=self._get_ssl_parameters(),
-                                         connect_timeout=60)
-            cursor = connection.cursor()
+            connection = self.acquire_connection()
+            cursor = connection.cursor(SSCursor) if unbuffered else connection.cursor()
             logger.debug("MySQL running query: %s", query)
             cursor.execute(query)
 
-            data = cursor.fetchall()
-
-            while cursor.nextset():
+            if not unbuffered:
                 data = cursor.fetchall()
 
+                while cursor.nextset():
+                    data = cursor.fetchall()
+
             # TODO - very similar to pg.py
             if cursor.description is not None:
                 columns = self.fetch_columns([(i[0], types_map.get(i[1], None)) for i in cursor.description])
-                rows = [dict(zip((c['name'] for c in columns), row)) for row in data]
 
-                data = {'columns': columns, 'rows': rows}
-                json_data = json_dumps(data)
+                if unbuffered:
+                    def fetch():
+                        rows = cursor.fetchmany(self.batch_size)
+                        if not rows:
+                            cursor.close()
+                        return rows
+
+                    # The connection is released by the batches generator once the rows are consumed.
+                    release = False
+                    return ResultStream(columns, self._fetch_batches(connection, cursor, columns, fetch)), None
+
+                column_names = [c['name'] for c in columns]
+                rows = (dict(zip(column_names, row)) for row in data)
+
+                stream = ResultStream(columns, iter_batches(rows, self.batch_size))
                 error = None
             else:
-                json_data = None
                 error = "No data was returned."
 
             cursor.close()
+            discard = False
         except MySQLdb.Error as e:
-            json_data = None
             error = e.args[1]
         except KeyboardInterrupt:
             cursor.close()
             error = "Query cancelled by user."
-            json_data = None
+            stream = None
         finally:
-            if connection:
-                connection.close()
+            if connection and release:
+                self.release_connection(connection, discard=discard)
 
-        return json_data, error
+        return stream, error
 
     def _get_ssl_parameters(self):
         ssl_params = {}
@@ -226,6 +265,10 @@ class RDSMySQL(Mysql):
                 'use_ssl': {
                     'type': 'boolean',
                     'title': 'Use SSL'
+                },
+                'batch_size': {
+                    'type': 'number',
+                    'title': 'Rows per Fetch'
                 }
             },
             "order": ['host', 'port', 'user', 'passwd', 'db'],
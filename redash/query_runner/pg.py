@@ -1,11 +1,15 @@
 import logging
+import Queue
 import select
+import threading
 
 import psycopg2
 from psycopg2.extras import Range
+from sqlparse import tokens as sql_tokens
 
+from redash import settings
 from redash.query_runner import *
-from redash.utils import JSONEncoder, json_dumps, json_loads
+from redash.utils import JSONEncoder, json_loads
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +32,32 @@ types_map = {
 }
 
 
+def _is_plain_select(statement):
+    """
+    Whether a parsed statement is a SELECT that can be run in a cursor or a COPY: SELECT ... INTO and data modifying
+    (or row locking) clauses can't, so they're run as they are.
+    """
+    if statement is None or statement.get_type() != 'SELECT':
+        return False
+
+    for token in statement.flatten():
+        if token.ttype is sql_tokens.Keyword.DML and token.normalized != 'SELECT':
+            return False
+        if token.ttype is sql_tokens.Keyword and token.normalized == 'INTO':
+            return False
+
+    return True
+
+
+def _statement_body(statement):
+    """The SQL of a parsed statement without its trailing semicolon, comments and whitespace."""
+    tokens = list(statement.flatten())
+    while tokens and (tokens[-1].is_whitespace or tokens[-1].ttype in sql_tokens.Comment or
+                      tokens[-1].match(sql_tokens.Punctuation, ';')):
+        tokens.pop()
+    return u''.join(token.value for token in tokens)
+
+
 class PostgreSQLJSONEncoder(JSONEncoder):
     def default(self, o):
         if isinstance(o, Range):
@@ -64,8 +94,63 @@ def _wait(conn, timeout=None):
             raise psycopg2.OperationalError("select.error received")
 
 
+class _CopyBuffer(object):
+    """
+    The file object COPY ... TO STDOUT writes to, handing the data over to a reader in another thread in chunks of
+    about CHUNK_SIZE bytes.
+    """
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self):
+        self.chunks = Queue.Queue(maxsize=16)
+        self.cancelled = threading.Event()
+        self._pending = []
+        self._pending_size = 0
+
+    def put(self, kind, value=None):
+        """Returns False when the reader went away before the chunk could be handed over."""
+        while not self.cancelled.is_set():
+            try:
+                self.chunks.put((kind, value), timeout=1)
+                return True
+            except Queue.Full:
+                pass
+
+        return False
+
+    def write(self, data):
+        self._pending.append(data)
+        self._pending_size += len(data)
+        if self._pending_size >= self.CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self._pending:
+            if not self.put('data', ''.join(self._pending)):
+                raise IOError("Export cancelled.")
+            self._pending = []
+            self._pending_size = 0
+
+
+def _copy_to(connection, sql, buffer):
+    try:
+        cursor = connection.cursor()
+        cursor.copy_expert(sql, buffer)
+        buffer.flush()
+        buffer.put('end')
+    except Exception as e:
+        if buffer.cancelled.is_set():
+            return
+
+        error = e.message if isinstance(e, psycopg2.DatabaseError) else unicode(e)
+        logger.info("COPY export failed: %s", error)
+        buffer.put('error', error)
+
+
 class PostgreSQL(BaseSQLQueryRunner):
     noop_query = "SELECT 1"
+    streaming = True
+    pool_connections = True
 
     @classmethod
     def configuration_schema(cls):
@@ -94,6 +179,10 @@ class PostgreSQL(BaseSQLQueryRunner):
                     "type": "string",
                     "title": "SSL Mode",
                     "default": "prefer"
+                },
+                "batch_size": {
+                    "type": "number",
+                    "title": "Rows per Fetch"
                 }
             },
             "order": ['host', 'port', 'user', 'password'],
@@ -166,7 +255,7 @@ class PostgreSQL(BaseSQLQueryRunner):
 
         return schema.values()
 
-    def _get_connection(self):
+    def _connect(self):
         connection = psycopg2.connect(user=self.configuration.get('user'),
                                       password=self.configuration.get('password'),
                                       host=self.configuration.get('host'),
@@ -174,43 +263,162 @@ class PostgreSQL(BaseSQLQueryRunner):
                                       dbname=self.configuration.get('dbname'),
                                       sslmode=self.configuration.get('sslmode'),
                                       async_=True)
+        _wait(connection, timeout=10)
 
         return connection
 
-    def run_query(self, query, user):
-        connection = self._get_connection()
+    def _check_connection(self, connection):
+        cursor = connection.cursor()
+        cursor.execute(self.noop_query)
         _wait(connection, timeout=10)
+        cursor.close()
 
+    def _reset_connection(self, connection):
+        # Async connections are always in autocommit mode, so only session state (SET, temporary tables, ...) is left.
         cursor = connection.cursor()
+        cursor.execute("DISCARD ALL")
+        _wait(connection, timeout=10)
+        cursor.close()
 
+    def _declare_cursor(self, connection, cursor, query):
+        """
+        Runs a single SELECT through a server side cursor, so its rows are fetched in batches instead of being
+        buffered by libpq. Returns False for other queries (and those a cursor can't be declared for), which have
+        to be executed as they are.
+        """
+        statement = self._single_statement(query)
+        if not _is_plain_select(statement):
+            return False
+
+        cursor.execute("BEGIN; DECLARE redash_cursor NO SCROLL CURSOR FOR {}".format(
+            _statement_body(statement)))
+        _wait(connection)
+        return True
+
+    def _fetch_rows(self, connection, cursor):
         try:
-            cursor.execute(query)
+            cursor.execute("FETCH FORWARD {} FROM redash_cursor".format(self.batch_size))
             _wait(connection)
+        except (KeyboardInterrupt, InterruptException):
+            connection.cancel()
+            raise
+
+        rows = cursor.fetchall()
+        if not rows:
+            # On its own cursor, so the query's keeps its description (needed when there are no rows at all).
+            commit_cursor = connection.cursor()
+            commit_cursor.execute("COMMIT")
+            _wait(connection)
+            commit_cursor.close()
+
+        return rows
+
+    def run_query_stream(self, query, user):
+        connection = self.acquire_connection()
+        cursor = connection.cursor()
+
+        try:
+            if self._declare_cursor(connection, cursor, query):
+                # The first batch gives the cursor's description.
+                pending = [self._fetch_rows(connection, cursor)]
+                fetch = lambda: pending.pop() if pending else self._fetch_rows(connection, cursor)
+            else:
+                cursor.execute(query)
+                _wait(connection)
+                fetch = None
 
             if cursor.description is not None:
                 columns = self.fetch_columns([(i[0], types_map.get(i[1], None)) for i in cursor.description])
-                rows = [dict(zip((c['name'] for c in columns), row)) for row in cursor]
+                batches = self._fetch_batches(connection, cursor, columns, fetch)
 
-                data = {'columns': columns, 'rows': rows}
-                error = None
-                json_data = json_dumps(data, ignore_nan=True, cls=PostgreSQLJSONEncoder)
+                # The connection is released by the batches generator once the rows are consumed.
+                return ResultStream(columns, batches, PostgreSQLJSONEncoder, ignore_nan=True), None
             else:
                 error = 'Query completed but it returned no data.'
-                json_data = None
+                self.release_connection(connection)
+                return None, error
         except (select.error, OSError) as e:
             error = "Query interrupted. Please retry."
-            json_data = None
         except psycopg2.DatabaseError as e:
             error = e.message
-            json_data = None
         except (KeyboardInterrupt, InterruptException):
             connection.cancel()
             error = "Query cancelled by user."
-            json_data = None
-        finally:
+        except Exception:
+            self.release_connection(connection, discard=True)
+            raise
+
+        self.release_connection(connection, discard=True)
+        return None, error
+
+    def export_csv(self, query, user):
+        statement = self._single_statement(query)
+        if not _is_plain_select(statement):
+            return None, "Only single SELECT statements can be exported directly."
+
+        # On lines of their own, so that comments in the query can't swallow the closing parenthesis.
+        sql = u"COPY (\n{}\n) TO STDOUT WITH CSV HEADER".format(_statement_body(statement))
+
+        # COPY can't be used on async connections; this one runs in its own thread so the output can be streamed.
+        connection = psycopg2.connect(user=self.configuration.get('user'),
+                                      password=self.configuration.get('password'),
+                                      host=self.configuration.get('host'),
+                                      port=self.configuration.get('port'),
+                                      dbname=self.configuration.get('dbname'),
+                                      sslmode=self.configuration.get('sslmode'),
+                                      connect_timeout=10,
+                                      options='-c statement_timeout={}'.format(settings.QUERY_EXPORT_TIME_LIMIT * 1000))
+        connection.set_client_encoding('UTF8')
+
+        buffer = _CopyBuffer()
+        thread = threading.Thread(target=_copy_to, args=(connection, sql, buffer))
+        thread.daemon = True
+        thread.start()
+
+        def stop():
+            buffer.cancelled.set()
+            if thread.is_alive():
+                connection.cancel()
+            thread.join()
             connection.close()
 
-        return json_data, error
+        # Wait for the first chunk, so errors in the query are reported before anything is sent.
+        try:
+            kind, value = buffer.chunks.get(timeout=settings.QUERY_EXPORT_FIRST_CHUNK_TIMEOUT)
+        except Queue.Empty:
+            stop()
+            return None, "Export timed out: the query didn't return any rows within {} seconds.".format(
+                settings.QUERY_EXPORT_FIRST_CHUNK_TIMEOUT)
+
+        if kind == 'error':
+            stop()
+            return None, value
+
+        def chunks(kind, value):
+            try:
+                while kind == 'data':
+                    yield value
+                    kind, value = buffer.chunks.get()
+
+                if kind == 'error':
+                    raise Exception(value)
+            finally:
+                stop()
+
+        return chunks(kind, value), None
+
+    def _fetch_batches(self, connection, cursor, columns, fetch=None):
+        batches = super(PostgreSQL, self)._fetch_batches(connection, cursor, columns, fetch)
+
+        try:
+            for batch in batches:
+                yield batch
+        except psycopg2.DatabaseError as e:
+            raise Exception(e.message)
+        except (KeyboardInterrupt, InterruptException):
+            raise Exception("Query cancelled by user.")
+        finally:
+            batches.close()
 
 
 register(PostgreSQL)
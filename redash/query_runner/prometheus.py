@@ -1,12 +1,21 @@
+import calendar
+import math
+import re
 import time
+from collections import OrderedDict
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 from urlparse import parse_qs
 
 import requests
 from dateutil import parser
 
-from redash.query_runner import BaseQueryRunner, register, TYPE_DATETIME, TYPE_STRING
-from redash.utils import json_dumps
+from redash import settings
+from redash.query_runner import BaseQueryRunner, ResultStream, iter_batches, register, TYPE_DATETIME, TYPE_STRING
+from redash.query_runner.time_window_cache import time_window_cache
+
+DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800, 'y': 31536000}
+_DURATION = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h|d|w|y)')
 
 
 def get_instant_rows(metrics_data):
@@ -25,20 +34,103 @@ def get_instant_rows(metrics_data):
 
 def get_range_rows(metrics_data):
     rows = []
+    for batch in iter_range_rows(metrics_data, None):
+        rows.extend(batch)
+    return rows
 
-    for metric in metrics_data:
-        ts_values = metric['values']
-        metric_labels = metric['metric']
 
-        for values in ts_values:
+def _iter_series_rows(metric, date_times, batch_size):
+    """Yields the timestamps and rows of a series in batches of up to batch_size rows (None: a single batch)."""
+    metric_labels = metric['metric']
+    ts_values = metric['values']
+
+    timestamps = [timestamp for timestamp, _ in ts_values]
+    converted = []
+    for timestamp in timestamps:
+        date_time = date_times.get(timestamp)
+        if date_time is None:
+            date_time = date_times[timestamp] = datetime.fromtimestamp(timestamp)
+        converted.append(date_time)
+    values = [value for _, value in ts_values]
+
+    step = batch_size or len(ts_values) or 1
+    for start in range(0, len(ts_values), step):
+        batch = []
+        for date_time, value in zip(converted[start:start + step], values[start:start + step]):
+            # Result writers take rows as dicts, so one is needed per sample either way. Copying the label dict (whose
+            # values every row shares) is the cheapest way to build them: about twice as fast as zipping column
+            # arrays into dicts.
             row_data = metric_labels.copy()
+            row_data['timestamp'] = date_time
+            row_data['value'] = value
+            batch.append(row_data)
+        yield timestamps[start:start + step], batch
 
-            timestamp, value = values
-            date_time = datetime.fromtimestamp(timestamp)
 
-            row_data.update({'timestamp': date_time, 'value': value})
-            rows.append(row_data)
-    return rows
+def iter_range_rows(metrics_data, batch_size):
+    """
+    Yields the rows of range query results in batches of up to batch_size rows (None: one batch per series). The
+    timestamp column is converted once per distinct timestamp, as series share their timestamps, and every row
+    refers to the same converted values.
+    """
+    date_times = {}
+
+    for metric in metrics_data:
+        for _, batch in _iter_series_rows(metric, date_times, batch_size):
+            yield batch
+
+
+def get_timed_range_rows(metrics_data):
+    """The rows of range query results as (timestamp, row) pairs."""
+    date_times = {}
+    timed_rows = []
+
+    for metric in metrics_data:
+        for timestamps, batch in _iter_series_rows(metric, date_times, None):
+            timed_rows.extend(zip(timestamps, batch))
+    return timed_rows
+
+
+def parse_duration(duration):
+    """
+    Seconds of a Prometheus duration (like "1h30m") or float number of seconds, None if it can't be parsed.
+    """
+    try:
+        return float(duration)
+    except ValueError:
+        pass
+
+    parts = _DURATION.findall(duration)
+    if not parts or ''.join(number + unit for number, unit in parts) != duration:
+        return None
+    return sum(float(number) * DURATION_UNITS[unit] for number, unit in parts)
+
+
+def split_range(start, end, step, max_points):
+    """
+    Splits [start, end] into sub-ranges of at most max_points points each. Sub-ranges start on start + n * step, so
+    their points are the same as those of the whole range.
+    """
+    ranges = []
+    i = 0
+    while start + i * step <= end:
+        sub_start = start + i * step
+        ranges.append((sub_start, min(sub_start + (max_points - 1) * step, end)))
+        i += max_points
+    return ranges
+
+
+def merge_series(results):
+    """Concatenates the values of the same series (by labels) across the results of consecutive sub-ranges."""
+    series = OrderedDict()
+    for result in results:
+        for metric in result:
+            key = tuple(sorted(metric['metric'].items()))
+            if key in series:
+                series[key]['values'].extend(metric['values'])
+            else:
+                series[key] = {'metric': metric['metric'], 'values': list(metric['values'])}
+    return series.values()
 
 
 # Convert datetime string to timestamp
@@ -50,22 +142,31 @@ def convert_query_range(payload):
             continue
         value = payload[key][0]
 
-        if type(value) is str:
+        # parse_qs gives unicode values for unicode queries.
+        if isinstance(value, basestring):
             # Don't convert timestamp string
             try:
-                int(value)
+                float(value)
                 continue
             except ValueError:
                 pass
             value = parser.parse(value)
 
         if type(value) is datetime:
-            query_range[key] = [int(time.mktime(value.timetuple()))]
+            if value.tzinfo is not None:
+                query_range[key] = [calendar.timegm(value.utctimetuple())]
+            else:
+                query_range[key] = [int(time.mktime(value.timetuple()))]
 
     payload.update(query_range)
 
 
 class Prometheus(BaseQueryRunner):
+    streaming = True
+    # Range queries over more points than this (per series) are split into sub-ranges, fetched concurrently, as
+    # Prometheus rejects queries over 11000 points.
+    MAX_POINTS_PER_REQUEST = 10000
+    MAX_CONCURRENT_REQUESTS = 4
 
     @classmethod
     def configuration_schema(cls):
@@ -85,13 +186,13 @@ class Prometheus(BaseQueryRunner):
         return False
 
     def test_connection(self):
-        resp = requests.get(self.configuration.get("url", None))
+        resp = self.get_session().get(self.configuration.get("url", None))
         return resp.ok
 
     def get_schema(self, prefix=None):
         base_url = self.configuration["url"]
         metrics_path = '/api/v1/label/__name__/values'
-        response = requests.get(base_url + metrics_path)
+        response = self.get_session().get(base_url + metrics_path)
         response.raise_for_status()
         data = response.json()['data']
 
@@ -100,7 +201,68 @@ class Prometheus(BaseQueryRunner):
             schema[name] = {'name': name, 'columns': []}
         return schema.values()
 
-    def run_query(self, query, user):
+    def _query_range(self, api_endpoint, payload):
+        """Results of a range query, fetched in sub-ranges when it covers more than MAX_POINTS_PER_REQUEST points."""
+        ranges = None
+        step = parse_duration(payload['step'][0])
+        try:
+            start, end = float(payload['start'][0]), float(payload['end'][0])
+        except (KeyError, ValueError):
+            start = end = None
+
+        if step and start is not None and (end - start) / step + 1 > self.MAX_POINTS_PER_REQUEST:
+            ranges = split_range(start, end, step, self.MAX_POINTS_PER_REQUEST)
+
+        def fetch(sub_range=None):
+            params = payload if sub_range is None else dict(payload, start=[sub_range[0]], end=[sub_range[1]])
+            response = self.get_session().get(api_endpoint, params=params)
+            response.raise_for_status()
+            return response.json()['data']['result']
+
+        if ranges is None:
+            return fetch()
+
+        pool = ThreadPool(min(len(ranges), self.MAX_CONCURRENT_REQUESTS))
+        try:
+            # Waiting with a timeout lets KeyboardInterrupt (query cancellation) through.
+            return merge_series(pool.map_async(fetch, ranges).get(timeout=365 * 24 * 3600))
+        finally:
+            pool.close()
+
+    def _range_rows(self, api_endpoint, payload):
+        """
+        The label names (of the first series; None when there are no results) and the batches of rows of a range
+        query. When the query has the same step (and grid) as an earlier one, only the part of its range that's newer
+        than the earlier one's is fetched.
+        """
+        step = parse_duration(payload['step'][0])
+        try:
+            start, end = float(payload['start'][0]), float(payload['end'][0])
+        except (KeyError, ValueError):
+            start = end = None
+
+        if not time_window_cache.enabled or self.data_source_id is None or not step or start is None:
+            metrics = self._query_range(api_endpoint, payload)
+            label_names = metrics[0]['metric'].keys() if metrics else None
+            return label_names, iter_range_rows(metrics, settings.QUERY_RESULTS_ROW_BATCH_SIZE)
+
+        def fetch(fetch_start, fetch_end):
+            metrics = self._query_range(api_endpoint, dict(payload, start=[fetch_start], end=[fetch_end]))
+            label_names = metrics[0]['metric'].keys() if metrics else []
+            return label_names, get_timed_range_rows(metrics)
+
+        def align(timestamp):
+            # The first point of the query's grid at or after the timestamp.
+            return start + math.ceil((timestamp - start) / step - 1e-9) * step
+
+        params = tuple(sorted((k, tuple(v)) for k, v in payload.items() if k not in ('start', 'end')))
+        key = (self.data_source_id, params, start % step)
+        label_names, rows = time_window_cache.get(key, start, end, fetch, align)
+        if not rows:
+            return None, None
+        return label_names, iter_batches(rows)
+
+    def run_query_stream(self, query, user):
         """
         Query Syntax, actually it is the URL query string.
         Check the Prometheus HTTP API for the details of the supported query string.
@@ -150,42 +312,33 @@ class Prometheus(BaseQueryRunner):
 
             api_endpoint = base_url + '/api/v1/{}'.format(query_type)
 
-            response = requests.get(api_endpoint, params=payload)
-            response.raise_for_status()
-
-            metrics = response.json()['data']['result']
+            if query_type == 'query_range':
+                label_names, batches = self._range_rows(api_endpoint, payload)
+            else:
+                response = self.get_session().get(api_endpoint, params=payload)
+                response.raise_for_status()
+                metrics = response.json()['data']['result']
+                label_names = metrics[0]['metric'].keys() if metrics else None
+                batches = iter([get_instant_rows(metrics)])
 
-            if len(metrics) == 0:
+            if label_names is None:
                 return None, 'query result is empty.'
 
-            metric_labels = metrics[0]['metric'].keys()
-
-            for label_name in metric_labels:
+            for label_name in label_names:
                 columns.append({
                     'friendly_name': label_name,
                     'type': TYPE_STRING,
                     'name': label_name
                 })
 
-            if query_type == 'query_range':
-                rows = get_range_rows(metrics)
-            else:
-                rows = get_instant_rows(metrics)
-
-            json_data = json_dumps(
-                {
-                    'rows': rows,
-                    'columns': columns
-                }
-            )
+            return ResultStream(columns, batches), None
 
         except requests.RequestException as e:
             return None, str(e)
         except KeyboardInterrupt:
             error = "Query cancelled by user."
-            json_data = None
 
-        return json_data, error
+        return None, error
 
 
 register(Prometheus)
@@ -1,11 +1,18 @@
+import errno
 import logging
+import os
 import re
 import sqlite3
+import tempfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 
-from redash import models
+from redash import models, settings
 from redash.permissions import has_access, not_view_only
-from redash.query_runner import BaseQueryRunner, TYPE_STRING, guess_type, register
-from redash.utils import json_dumps, json_loads
+from redash.query_runner import (TYPE_BOOLEAN, TYPE_FLOAT, TYPE_INTEGER, BaseQueryRunner, ColumnTypeGuesser,
+                                 ResultStream, register)
+from redash.utils import json_loads
 
 logger = logging.getLogger(__name__)
 
@@ -46,65 +53,322 @@ def get_query_results(user, query_id, bring_from_cache):
     query = _load_query(user, query_id)
     if bring_from_cache:
         if query.latest_query_data_id is not None:
-            results = query.latest_query_data.data
+            return query.latest_query_data.load_data()
         else:
             raise Exception("No cached result available for query {}.".format(query.id))
-    else:
-        results, error = query.data_source.query_runner.run_query(query.query_text, user)
-        if error:
-            raise Exception("Failed loading results for query id {}.".format(query.id))
+
+    results, error = query.data_source.query_runner.run_query(query.query_text, user)
+    if error:
+        raise Exception("Failed loading results for query id {}.".format(query.id))
 
     return json_loads(results)
 
 
-def create_tables_from_query_ids(user, connection, query_ids, cached_query_ids=[]):
+def _run_upstream_query(query_id, query_runner, query_text, user, started, cancelled):
+    if cancelled.is_set():
+        return None, "Cancelled."
+
+    started[query_id] = time.time()
+    return query_runner.run_query(query_text, user)
+
+
+def _upstream_results(query_id, run):
+    try:
+        results, error = run()
+    except Exception as e:
+        error = e.message or repr(e)
+
+    if error:
+        raise Exception(u"Failed loading results for query id {}: {}".format(query_id, error))
+
+    return json_loads(results)
+
+
+def run_upstream_queries(user, query_ids):
+    """
+    Runs the queries concurrently, up to QUERY_RESULTS_UPSTREAM_CONCURRENCY at a time, and returns their results by
+    query id. Fails as soon as one of them fails or runs for more than QUERY_RESULTS_UPSTREAM_TIMEOUT seconds.
+
+    Queries of Query Results data sources run in the calling thread, as they load their own upstream queries from the
+    database. Queries left running after a failure or a timeout can't be interrupted: they finish in the background
+    and their results are dropped.
+    """
+    # Queries and their runners are loaded up front, as the database session can't be used from other threads.
+    queries = [_load_query(user, query_id) for query_id in set(query_ids)]
+    if not queries:
+        return {}
+
+    concurrent = [query for query in queries if not isinstance(query.data_source.query_runner, Results)]
+    inline = [query for query in queries if isinstance(query.data_source.query_runner, Results)]
+
+    started = {}
+    cancelled = threading.Event()
+    pool = ThreadPool(min(len(concurrent), settings.QUERY_RESULTS_UPSTREAM_CONCURRENCY)) if concurrent else None
+    try:
+        pending = [(query.id, pool.apply_async(_run_upstream_query, (query.id, query.data_source.query_runner,
+                                                                     query.query_text, user, started, cancelled)))
+                   for query in concurrent]
+
+        query_results = {}
+        for query in inline:
+            query_results[query.id] = _upstream_results(
+                query.id, lambda: query.data_source.query_runner.run_query(query.query_text, user))
+
+        for query_id, result in pending:
+            while not result.ready():
+                result.wait(1)
+                started_at = started.get(query_id)
+                timeout = settings.QUERY_RESULTS_UPSTREAM_TIMEOUT
+                if timeout and started_at is not None and time.time() - started_at > timeout:
+                    raise Exception("Query id {} didn't finish within {} seconds.".format(query_id, timeout))
+
+            query_results[query_id] = _upstream_results(query_id, result.get)
+
+        return query_results
+    finally:
+        # Queries which haven't started yet are skipped, running ones finish in the background (the pool isn't
+        # joined).
+        cancelled.set()
+        if pool is not None:
+            pool.close()
+
+
+# Keywords which can follow a table name where an alias would otherwise be.
+_NOT_ALIASES = set(['on', 'where', 'join', 'left', 'right', 'inner', 'outer', 'cross', 'natural', 'full', 'using',
+                    'group', 'order', 'limit', 'union', 'having', 'window', 'except', 'intersect'])
+
+_TABLE_REFERENCE = re.compile(r'(?:join|from)\s+((?:cached_)?query_\d+)(?:\s+(?:as\s+)?(\w+))?', re.IGNORECASE)
+_COMPARISON = r'(?:=|==|<>|!=|<=|>=|<|>|\bin\b|\blike\b|\bbetween\b|\bis\b)'
+_COLUMN_REFERENCE = r'(\w+)\.("[^"]+"|\w+)'
+_COMPARED_COLUMNS = (re.compile(_COLUMN_REFERENCE + r'\s*' + _COMPARISON, re.IGNORECASE),
+                     re.compile(_COMPARISON + r'\s*' + _COLUMN_REFERENCE, re.IGNORECASE))
+
+
+def extract_compared_columns(query):
+    """
+    Columns of query_N/cached_query_N tables the query compares (in JOIN ... ON and WHERE conditions), as a dict of
+    table name to column names. Only qualified references (`query_1.id`, or `q.id` with an alias) are found.
+    """
+    aliases = {}
+    for table, alias in _TABLE_REFERENCE.findall(query):
+        table = table.lower()
+        aliases[table] = table
+        if alias and alias.lower() not in _NOT_ALIASES:
+            aliases[alias.lower()] = table
+
+    compared = {}
+    for pattern in _COMPARED_COLUMNS:
+        for alias, column in pattern.findall(query):
+            table = aliases.get(alias.lower())
+            if table is not None:
+                compared.setdefault(table, set()).add(column.strip('"').lower())
+
+    return compared
+
+
+def create_tables_from_query_ids(user, connection, query_ids, cached_query_ids=[], indexed_columns={}):
     for query_id in set(cached_query_ids):
-        results = get_query_results(user, query_id, True)
         table_name = 'cached_query_{query_id}'.format(query_id=query_id)
-        create_table(connection, table_name, results)
+        if table_cache.enabled:
+            query = _load_query(user, query_id)
+            if query.latest_query_data_id is not None:
+                attached = table_cache.attach(connection, table_name, query.latest_query_data_id,
+                                              query.latest_query_data.load_data, indexed_columns.get(table_name))
+                if attached:
+                    continue
+
+        results = get_query_results(user, query_id, True)
+        create_table(connection, table_name, results, indexed_columns.get(table_name))
 
-    for query_id in set(query_ids):
-        results = get_query_results(user, query_id, False)
+    for query_id, results in run_upstream_queries(user, query_ids).iteritems():
         table_name = 'query_{query_id}'.format(query_id=query_id)
-        create_table(connection, table_name, results)
+        create_table(connection, table_name, results, indexed_columns.get(table_name))
 
 
 def fix_column_name(name):
     return u'"{}"'.format(re.sub('[:."\s]', '_', name, flags=re.UNICODE))
 
 
-def create_table(connection, table_name, query_results):
+# Column affinities by result column type. Other columns get none, so their values are stored as they are.
+COLUMN_AFFINITIES = {
+    TYPE_INTEGER: 'INTEGER',
+    TYPE_FLOAT: 'REAL',
+    TYPE_BOOLEAN: 'INTEGER',
+}
+
+
+def create_table(connection, table_name, query_results, indexed_columns=None):
+    """
+    Creates a table holding the query results, with column affinities from their types, and indexes the columns in
+    `indexed_columns` (lower case names).
+    """
     try:
         columns = [column['name']
                    for column in query_results['columns']]
         safe_columns = [fix_column_name(column) for column in columns]
 
-        column_list = ", ".join(safe_columns)
-        create_table = u"CREATE TABLE {table_name} ({column_list})".format(
-            table_name=table_name, column_list=column_list)
+        column_definitions = ", ".join(
+            u"{} {}".format(safe_column, COLUMN_AFFINITIES.get(column.get('type'), '')).strip()
+            for safe_column, column in zip(safe_columns, query_results['columns']))
+        create_table = u"CREATE TABLE {table_name} ({column_definitions})".format(
+            table_name=table_name, column_definitions=column_definitions)
         logger.debug("CREATE TABLE query: %s", create_table)
         connection.execute(create_table)
     except sqlite3.OperationalError as exc:
         raise CreateTableError(u"Error creating table {}: {}".format(table_name, exc.message))
 
+    column_list = ", ".join(safe_columns)
     insert_template = u"insert into {table_name} ({column_list}) values ({place_holders})".format(
         table_name=table_name,
         column_list=column_list,
         place_holders=','.join(['?'] * len(columns)))
 
-    for row in query_results['rows']:
-        values = [row.get(column) for column in columns]
-        connection.execute(insert_template, values)
+    connection.executemany(insert_template, ([row.get(column) for column in columns]
+                                             for row in query_results['rows']))
+
+    if indexed_columns:
+        create_indexes(connection, table_name, safe_columns, indexed_columns)
+
+    connection.commit()
+
+
+def create_indexes(connection, table_name, safe_columns, indexed_columns):
+    for i, safe_column in enumerate(safe_columns):
+        if safe_column.strip('"').lower() in indexed_columns:
+            connection.execute(u"CREATE INDEX {table_name}_{i} ON {table_name} ({column})".format(
+                table_name=table_name, i=i, column=safe_column))
+
+
+def _prepare_connection(connection):
+    # The tables are only written once, so they need neither durability nor a rollback journal.
+    connection.execute('PRAGMA synchronous = OFF')
+    connection.execute('PRAGMA journal_mode = OFF')
+
+
+class TableCache(object):
+    """
+    Query results materialized as SQLite database files, one per query result id, shared by the worker processes of
+    a host. Query results never change, so a file is reused (attached to the query's database) until it's evicted:
+    once the files take more than QUERY_RESULTS_TABLE_CACHE_MAX_SIZE bytes, the least recently used ones are removed.
+
+    Files are only written while they're built, under a temporary name: the indexes they get are those of the query
+    which built them. The connections they're attached to are made read-only (PRAGMA query_only) before running
+    queries, so a query can't change them for everyone else.
+    """
+    table_name = 'results'
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+
+    @property
+    def enabled(self):
+        # PRAGMA query_only needs SQLite 3.8.0, older versions ignore it.
+        return bool(self.path) and self.max_size > 0 and sqlite3.sqlite_version_info >= (3, 8, 0)
+
+    def _filename(self, result_id):
+        return os.path.join(self.path, 'result_{}.sqlite'.format(result_id))
+
+    def _build(self, filename, query_results, indexed_columns):
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                # Another worker might have just created it.
+                if not os.path.isdir(self.path):
+                    raise
+
+        fd, temporary_filename = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        os.close(fd)
+        try:
+            connection = sqlite3.connect(temporary_filename)
+            try:
+                _prepare_connection(connection)
+                create_table(connection, self.table_name, query_results, indexed_columns)
+            finally:
+                connection.close()
+            os.chmod(temporary_filename, 0o444)
+            # Renaming is atomic, so other workers never attach a partially written file.
+            os.rename(temporary_filename, filename)
+        except Exception:
+            os.remove(temporary_filename)
+            raise
+
+        self.evict()
+
+    def attach(self, connection, table_name, result_id, load_results, indexed_columns=None):
+        """
+        Makes `table_name` a view of the materialized table of the query result, materializing it from the results
+        `load_results` returns (with `indexed_columns` indexed) when it's not cached yet. Returns False if the cached
+        table can't be attached, in which case the caller should create the table itself.
+        """
+        filename = self._filename(result_id)
+        try:
+            os.utime(filename, None)
+        except OSError as exc:
+            # Not cached yet, or just evicted by another worker.
+            if exc.errno != errno.ENOENT:
+                raise
+            self._build(filename, load_results(), indexed_columns)
+
+        schema = u'{}_db'.format(table_name)
+        try:
+            connection.execute(u"ATTACH DATABASE ? AS {}".format(schema), (filename,))
+        except sqlite3.OperationalError as exc:
+            # E.g. more tables than SQLite can attach to a single connection.
+            logger.info("Can't attach cached table of query result %s: %s", result_id, exc)
+            return False
+
+        if not connection.execute(u"PRAGMA {}.table_info({})".format(schema, self.table_name)).fetchall():
+            # The file was evicted before it was attached, which created an empty database in its place.
+            connection.execute(u"DETACH DATABASE {}".format(schema))
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            return False
+
+        connection.execute(u"CREATE TEMP VIEW {} AS SELECT * FROM {}.{}".format(table_name, schema, self.table_name))
+        return True
+
+    def evict(self):
+        files = []
+        for name in os.listdir(self.path):
+            if name.startswith('result_') and name.endswith('.sqlite'):
+                try:
+                    stat = os.stat(os.path.join(self.path, name))
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, name))
+
+        total_size = sum(size for _, size, _ in files)
+        for _, size, name in sorted(files):
+            if total_size <= self.max_size:
+                break
+            try:
+                # Workers which have the file attached keep reading it until they detach it.
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total_size -= size
+
+
+table_cache = TableCache(settings.QUERY_RESULTS_TABLE_CACHE_PATH, settings.QUERY_RESULTS_TABLE_CACHE_MAX_SIZE)
 
 
 class Results(BaseQueryRunner):
     noop_query = 'SELECT 1'
+    streaming = True
 
     @classmethod
     def configuration_schema(cls):
         return {
             "type": "object",
             "properties": {
+                "index_compared_columns": {
+                    "type": "boolean",
+                    "title": "Index columns used in JOIN/WHERE conditions"
+                }
             }
         }
 
@@ -116,49 +380,55 @@ class Results(BaseQueryRunner):
     def name(cls):
         return "Query Results"
 
-    def run_query(self, query, user):
+    def run_query_stream(self, query, user):
         connection = sqlite3.connect(':memory:')
-
-        query_ids = extract_query_ids(query)
-        cached_query_ids = extract_cached_query_ids(query)
-        create_tables_from_query_ids(user, connection, query_ids, cached_query_ids)
-
-        cursor = connection.cursor()
+        _prepare_connection(connection)
 
         try:
+            query_ids = extract_query_ids(query)
+            cached_query_ids = extract_cached_query_ids(query)
+            indexed_columns = {}
+            if self.configuration.get('index_compared_columns', False):
+                indexed_columns = extract_compared_columns(query)
+            create_tables_from_query_ids(user, connection, query_ids, cached_query_ids, indexed_columns)
+            # Cached tables are attached from files shared with other queries.
+            connection.execute('PRAGMA query_only = ON')
+
+            cursor = connection.cursor()
             cursor.execute(query)
+        except KeyboardInterrupt:
+            connection.close()
+            return None, "Query cancelled by user."
+        except Exception:
+            connection.close()
+            raise
 
-            if cursor.description is not None:
-                columns = self.fetch_columns(
-                    [(i[0], None) for i in cursor.description])
+        if cursor.description is None:
+            connection.close()
+            return None, 'Query completed but it returned no data.'
 
-                rows = []
-                column_names = [c['name'] for c in columns]
+        columns = self.fetch_columns([(i[0], None) for i in cursor.description])
+        return ResultStream(columns, self._fetch_batches(connection, cursor, columns)), None
 
-                for i, row in enumerate(cursor):
-                    for j, col in enumerate(row):
-                        guess = guess_type(col)
+    def _fetch_batches(self, connection, cursor, columns):
+        column_names = [c['name'] for c in columns]
+        guessers = [ColumnTypeGuesser() for _ in columns]
 
-                        if columns[j]['type'] is None:
-                            columns[j]['type'] = guess
-                        elif columns[j]['type'] != guess:
-                            columns[j]['type'] = TYPE_STRING
+        try:
+            while True:
+                rows = cursor.fetchmany(settings.QUERY_RESULTS_ROW_BATCH_SIZE)
+                if not rows:
+                    break
 
-                    rows.append(dict(zip(column_names, row)))
+                for column, guesser, values in zip(columns, guessers, zip(*rows)):
+                    guesser.update(values)
+                    column['type'] = guesser.type
 
-                data = {'columns': columns, 'rows': rows}
-                error = None
-                json_data = json_dumps(data)
-            else:
-                error = 'Query completed but it returned no data.'
-                json_data = None
+                yield [dict(zip(column_names, row)) for row in rows]
         except KeyboardInterrupt:
-            connection.cancel()
-            error = "Query cancelled by user."
-            json_data = None
+            raise Exception("Query cancelled by user.")
         finally:
             connection.close()
-        return json_data, error
 
 
 register(Results)
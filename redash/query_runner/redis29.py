@@ -1,4 +1,6 @@
 import json
+import re
+import threading
 from collections import OrderedDict
 
 from redash.query_runner import *
@@ -30,9 +32,94 @@ from redash.query_runner import *
 #   }
 # }
 
+# Redis connection pools by data source id, along with the connection settings they were made for.
+_connection_pools = {}
+_connection_pools_lock = threading.Lock()
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+def _skip_whitespace(value, i):
+    return _WHITESPACE.match(value, i).end()
+
+
+def _sample_data(value, count):
+    """
+    The first `count` elements of the "data" array of a JSON document like {"data": [...]}, decoded without decoding
+    the rest of the document (which may be truncated). Returns None if the document doesn't have such an array.
+    """
+    decoder = json.JSONDecoder(object_pairs_hook=OrderedDict)
+    elements = None
+
+    try:
+        i = _skip_whitespace(value, 0)
+        if value[i:i + 1] != '{':
+            return None
+        i = _skip_whitespace(value, i + 1)
+
+        while value[i:i + 1] == '"':
+            key, i = decoder.raw_decode(value, i)
+            i = _skip_whitespace(value, i)
+            if value[i:i + 1] != ':':
+                return None
+            i = _skip_whitespace(value, i + 1)
+
+            if key == 'data':
+                break
+
+            _, i = decoder.raw_decode(value, i)
+            i = _skip_whitespace(value, i)
+            if value[i:i + 1] != ',':
+                return None
+            i = _skip_whitespace(value, i + 1)
+        else:
+            return None
+
+        if value[i:i + 1] != '[':
+            return None
+        i = _skip_whitespace(value, i + 1)
+
+        elements = []
+        while len(elements) < count and value[i:i + 1] not in (']', ''):
+            element, i = decoder.raw_decode(value, i)
+            elements.append(element)
+            i = _skip_whitespace(value, i)
+            if value[i:i + 1] == ',':
+                i = _skip_whitespace(value, i + 1)
+    except ValueError:
+        # The document is truncated (or broken) after the elements decoded so far.
+        if 'elements' not in locals():
+            return None
+
+    return elements
+
+
+def _element_row(element):
+    """A row for an element of a list (JSON objects are rows themselves, anything else goes to a "value" column)."""
+    try:
+        decoded = json.loads(element, object_pairs_hook=OrderedDict)
+        if isinstance(decoded, dict):
+            return decoded
+    except ValueError:
+        pass
+    return OrderedDict([('value', element)])
+
+
+def _stream_entry_row(entry):
+    entry_id, fields = entry
+    row = OrderedDict([('id', entry_id)])
+    row.update(sorted(fields.items()))
+    return row
+
 
 class Redis29(BaseQueryRunner):
     MAX_SCHEMA_COUNT = 100
+    # Columns of a key are derived from its first SCHEMA_SAMPLE_ROWS rows, read from the first SCHEMA_SAMPLE_BYTES
+    # bytes of JSON documents.
+    SCHEMA_SAMPLE_ROWS = 10
+    SCHEMA_SAMPLE_BYTES = 64 * 1024
+    # Hashes, lists and streams are read this many entries per round trip.
+    BATCH_SIZE = 1000
 
     def __init__(self, configuration):
         super(Redis29, self).__init__(configuration)
@@ -86,6 +173,7 @@ class Redis29(BaseQueryRunner):
         return True
 
     def __get_connection(self):
+        """A client using the data source's connection pool (shared by the runners of the worker process)."""
         import redis
 
         host = self.configuration['host'] if 'host' in self.configuration else 'localhost'
@@ -93,17 +181,21 @@ class Redis29(BaseQueryRunner):
         db = self.configuration['db'] if 'db' in self.configuration else 0
         port = self.configuration['port'] if 'port' in self.configuration else 6379
 
-        connection = redis.StrictRedis(host=host,
-                                       password=password,
-                                       db=db,
-                                       port=port)
+        if self.data_source_id is None:
+            return redis.StrictRedis(host=host, password=password, db=db, port=port)
 
-        return connection
+        connection_settings = (host, password, db, port)
+        with _connection_pools_lock:
+            pool, pool_settings = _connection_pools.get(self.data_source_id, (None, None))
+            if pool is None or pool_settings != connection_settings:
+                if pool is not None:
+                    pool.disconnect()
+                pool = redis.ConnectionPool(host=host, password=password, db=db, port=port)
+                _connection_pools[self.data_source_id] = (pool, connection_settings)
 
-    def __get_data(self, key):
-        conn = self.__get_connection()
-        ret = conn.get(key)
+        return redis.StrictRedis(connection_pool=pool)
 
+    def __decode_data(self, ret):
         if ret is not None:
             try:
                 ret_obj = json.loads(ret, object_pairs_hook=OrderedDict)
@@ -116,6 +208,43 @@ class Redis29(BaseQueryRunner):
 
         return None
 
+    def __get_data(self, key):
+        """
+        The rows of a key: the "data" array of a JSON document for strings, field/value pairs for hashes, the elements
+        of lists and the entries (with their id) of streams.
+        """
+        conn = self.__get_connection()
+        key_type = conn.type(key)
+
+        if key_type == 'string':
+            return self.__decode_data(conn.get(key))
+
+        if key_type == 'hash':
+            return [OrderedDict([('field', field), ('value', value)])
+                    for field, value in conn.hscan_iter(key, count=self.BATCH_SIZE)]
+
+        if key_type == 'list':
+            rows = []
+            while True:
+                elements = conn.lrange(key, len(rows), len(rows) + self.BATCH_SIZE - 1)
+                rows.extend(_element_row(element) for element in elements)
+                if len(elements) < self.BATCH_SIZE:
+                    return rows
+
+        if key_type == 'stream':
+            rows = []
+            start = '-'
+            while True:
+                entries = conn.xrange(key, start, '+', count=self.BATCH_SIZE)
+                rows.extend(_stream_entry_row(entry) for entry in entries)
+                if len(entries) < self.BATCH_SIZE:
+                    return rows
+                # The next batch starts right after the last entry id (<milliseconds>-<sequence number>).
+                milliseconds, sequence = entries[-1][0].split('-')
+                start = '{}-{}'.format(milliseconds, int(sequence) + 1)
+
+        return None
+
     def __get_column_names(self, data_obj):
         column_names = []
         column_name_set = set()
@@ -130,64 +259,100 @@ class Redis29(BaseQueryRunner):
         return column_names
 
     def __extract_data(self, data_obj, column_names):
+        """Returns the data column oriented (see handle_extra_columns)."""
         columns = []
-        col_data_type_flags = {}
+        values = {}
 
         for c_name in column_names:
-            columns.append({'name': c_name, 'friendly_name': c_name, 'type': TYPE_STRING})
-            col_data_type_flags[c_name] = set()
-
-        rows = []
-
-        for obj in data_obj:
-            row = OrderedDict()
-            for c_name in column_names:
-                if c_name in obj:
-                    val_type, val = guess_type_and_decode(obj[c_name])
-
-                    col_data_type_flags[c_name].add(val_type)
-                    row[c_name] = val
+            present = [c_name in obj for obj in data_obj]
+            c_type, c_values = guess_column_type_and_decode([obj[c_name] for obj in data_obj if c_name in obj])
+            c_type = c_type or TYPE_STRING
 
-            rows.append(row)
+            c_values = iter(c_values)
+            default = default_value_for_type(c_type)
+            values[c_name] = [next(c_values) if is_present else default for is_present in present]
 
-        for c in columns:
-            c['type'] = get_column_type_from_set(col_data_type_flags[c['name']])
+            columns.append({'name': c_name, 'friendly_name': c_name, 'type': c_type})
 
-        for row in rows:
-            for c in columns:
-                c_name = c['name']
-                if c_name not in row:
-                    row[c_name] = default_value_for_type(c['type'])
-
-        return {'columns': columns, 'rows': rows}
+        return {'columns': columns, 'values': values, 'row_count': len(data_obj)}
 
     def test_connection(self):
         conn = self.__get_connection()
         conn.ping()
 
+    def __sample_data(self, conn, keys):
+        """Sample rows of the keys by key, read with a few pipelined round trips for all of them."""
+        pipe = conn.pipeline(transaction=False)
+        for key in keys:
+            pipe.type(key)
+        key_types = pipe.execute()
+
+        samples = {}
+        pipe = conn.pipeline(transaction=False)
+        sampled_keys = []
+        for key, key_type in zip(keys, key_types):
+            if key_type == 'string':
+                pipe.getrange(key, 0, self.SCHEMA_SAMPLE_BYTES - 1)
+            elif key_type == 'list':
+                pipe.lrange(key, 0, self.SCHEMA_SAMPLE_ROWS - 1)
+            elif key_type == 'stream':
+                pipe.xrange(key, '-', '+', count=self.SCHEMA_SAMPLE_ROWS)
+            else:
+                if key_type == 'hash':
+                    # Hashes always have the same columns.
+                    samples[key] = [OrderedDict([('field', None), ('value', None)])]
+                continue
+            sampled_keys.append((key, key_type))
+
+        truncated = []
+        for (key, key_type), value in zip(sampled_keys, pipe.execute()):
+            if key_type == 'string':
+                rows = _sample_data(value, self.SCHEMA_SAMPLE_ROWS)
+                if not rows and len(value) >= self.SCHEMA_SAMPLE_BYTES:
+                    # The prefix ended before the first row; those documents are fetched in full.
+                    truncated.append(key)
+                    continue
+            elif key_type == 'list':
+                rows = [_element_row(element) for element in value]
+            else:
+                rows = [_stream_entry_row(entry) for entry in value]
+            samples[key] = rows
+
+        if truncated:
+            for key, value in zip(truncated, conn.mget(truncated)):
+                rows = self.__decode_data(value)
+                samples[key] = rows[:self.SCHEMA_SAMPLE_ROWS] if rows is not None else None
+
+        return samples
+
     def get_schema(self, prefix=None):
         conn = self.__get_connection()
         pattern = "*" if prefix is None else prefix
         if '*' not in pattern:
             pattern = pattern + "*"
 
-        schema_dict = OrderedDict()
-
+        # SCAN can return a key more than once. Its count argument is only a hint of the batch size, so the walk over
+        # the keyspace is stopped once MAX_SCHEMA_COUNT keys are found.
+        keys = OrderedDict()
         for key in conn.scan_iter(pattern, self.MAX_SCHEMA_COUNT):
-            schema_dict[key] = {'name': key, 'columns': []}
+            keys[key] = None
+            if len(keys) >= self.MAX_SCHEMA_COUNT:
+                break
+        keys = list(keys)
+
+        samples = self.__sample_data(conn, keys)
 
         ret = []
 
-        for k, v in schema_dict.items():
-            data_obj = self.__get_data(k)
+        for key in keys:
+            data_obj = samples.get(key)
             if data_obj is None:
                 continue
 
             column_names = self.__get_column_names(data_obj)
-            v['columns'] = column_names
 
             if column_names:
-                ret.append(v)
+                ret.append({'name': key, 'columns': column_names})
 
         return ret
 
@@ -261,7 +426,7 @@ class Redis29(BaseQueryRunner):
                 else:
                     return None, "alias field is not a dictionary!"
 
-            return json.dumps(data), None
+            return json.dumps(columns_to_rows(data)), None
 
         except KeyboardInterrupt:
             return None, "Query cancelled by user."
@@ -0,0 +1,103 @@
+import logging
+import threading
+from collections import OrderedDict
+
+from redash import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _merge_columns(cached_columns, columns):
+    merged = list(cached_columns)
+    for column in columns:
+        if column not in merged:
+            merged.append(column)
+    return merged
+
+
+class TimeWindowCache(object):
+    """
+    The rows of time series queries, by data source and query (without its time range), kept by each worker process
+    so that refreshing a moving window (e.g. the last 24 hours) only fetches what's newer than the previous refresh.
+
+    - Rows are kept as (timestamp, row) pairs, timestamps being seconds since the epoch.
+    - The last TIME_WINDOW_CACHE_OVERLAP seconds of a cached window are fetched again, as the newest buckets may
+      still get (late) data.
+    - The least recently used windows are evicted to keep at most TIME_WINDOW_CACHE_MAX_ROWS rows.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._row_count = 0
+
+    @property
+    def enabled(self):
+        return settings.TIME_WINDOW_CACHE_MAX_ROWS > 0
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._row_count -= len(entry[3])
+        return entry
+
+    def _store(self, key, start, end, columns, rows):
+        with self._lock:
+            self._pop(key)
+            if len(rows) > settings.TIME_WINDOW_CACHE_MAX_ROWS:
+                return
+
+            while self._entries and self._row_count + len(rows) > settings.TIME_WINDOW_CACHE_MAX_ROWS:
+                self._pop(next(iter(self._entries)))
+
+            self._entries[key] = (start, end, columns, rows)
+            self._row_count += len(rows)
+
+    def get(self, key, start, end, fetch, align=None, consistent=None):
+        """
+        Returns the columns and rows of the window [start, end].
+
+        `fetch(start, end)` fetches a window, returning its columns and (timestamp, row) pairs. `align(timestamp)`
+        gives the start of the query's time bucket (or grid point) a timestamp falls in, so that partial windows are
+        fetched from a bucket boundary. `consistent(cached_rows, rows)` tells whether the rows of a partial window
+        can be spliced onto the cached ones (e.g. they have the same resolution); when they can't, the whole window
+        is fetched again.
+        """
+        align = align or (lambda timestamp: timestamp)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                # Most recently used.
+                self._entries[key] = self._entries.pop(key)
+
+        if entry is not None:
+            cached_start, cached_end, cached_columns, cached_rows = entry
+            lower = align(start)
+            cutoff = align(max(start, cached_end - settings.TIME_WINDOW_CACHE_OVERLAP))
+
+            if cached_start <= start < cached_end <= end and lower < cutoff:
+                logger.debug("Fetching [%s, %s] of time window [%s, %s] (cached until %s).",
+                             cutoff, end, start, end, cached_end)
+                columns, rows = fetch(cutoff, end)
+                if consistent is None or consistent(cached_rows, rows):
+                    columns = _merge_columns(cached_columns, columns)
+                    rows = ([(timestamp, row) for timestamp, row in cached_rows if lower <= timestamp < cutoff] +
+                            [(timestamp, row) for timestamp, row in rows if timestamp >= cutoff])
+                    self._store(key, start, end, columns, rows)
+                    return columns, [row for _, row in rows]
+
+                logger.debug("Fetched rows of time window [%s, %s] don't match the cached ones, fetching all of it.",
+                             start, end)
+
+        columns, rows = fetch(start, end)
+        self._store(key, start, end, columns, rows)
+        return columns, [row for _, row in rows]
+
+    def clear(self):
+        with self._lock:
+            self._entries = OrderedDict()
+            self._row_count = 0
+
+
+time_window_cache = TimeWindowCache()
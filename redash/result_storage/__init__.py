@@ -0,0 +1,100 @@
+import logging
+
+from redash import settings
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    'BaseResultStorage',
+    'register',
+    'get_result_storage',
+    'import_result_storages',
+    'put',
+    'get',
+    'delete'
+]
+
+
+class BaseResultStorage(object):
+    """
+    A place to keep query result payloads that are too big for the query_results table. Backends store opaque bytes
+    under a key; QueryResult rows keep the location ("<type>:<key>") of their payload. Payloads are put either as a
+    string or as a file object, which backends should copy without reading it in full.
+    """
+
+    @classmethod
+    def name(cls):
+        return cls.__name__
+
+    @classmethod
+    def type(cls):
+        return cls.__name__.lower()
+
+    @classmethod
+    def enabled(cls):
+        return True
+
+    def put(self, key, data):
+        raise NotImplementedError()
+
+    def get(self, key):
+        raise NotImplementedError()
+
+    def delete(self, key):
+        raise NotImplementedError()
+
+
+result_storages = {}
+_instances = {}
+
+
+def register(storage_class):
+    global result_storages
+    if storage_class.enabled():
+        logger.debug("Registering %s (%s) result storage.", storage_class.name(), storage_class.type())
+        result_storages[storage_class.type()] = storage_class
+    else:
+        logger.warning(
+            "%s result storage enabled but not supported, not registering. Either disable or install missing dependencies.",
+            storage_class.name())
+
+
+def get_result_storage(storage_type=None):
+    """Returns the backend of the given type (the configured one by default), or None if there is no such backend."""
+    storage_type = storage_type or settings.RESULT_STORAGE_BACKEND
+    if storage_type not in _instances:
+        storage_class = result_storages.get(storage_type)
+        if storage_class is None:
+            return None
+        _instances[storage_type] = storage_class()
+
+    return _instances[storage_type]
+
+
+def _parse_location(location):
+    storage_type, key = location.split(':', 1)
+    storage = get_result_storage(storage_type)
+    if storage is None:
+        raise Exception("Result storage {} isn't enabled.".format(storage_type))
+    return storage, key
+
+
+def put(key, data):
+    storage = get_result_storage()
+    storage.put(key, data)
+    return u'{}:{}'.format(storage.type(), key)
+
+
+def get(location):
+    storage, key = _parse_location(location)
+    return storage.get(key)
+
+
+def delete(location):
+    storage, key = _parse_location(location)
+    storage.delete(key)
+
+
+def import_result_storages(storage_imports):
+    for storage_import in storage_imports:
+        __import__(storage_import)
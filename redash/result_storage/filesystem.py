@@ -0,0 +1,52 @@
+import errno
+import os
+import shutil
+import tempfile
+
+from redash import settings
+from redash.result_storage import BaseResultStorage, register
+
+
+class FileSystem(BaseResultStorage):
+    def __init__(self):
+        self.root = settings.RESULT_STORAGE_FILESYSTEM_PATH
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def put(self, key, data):
+        path = self._path(key)
+        directory = os.path.dirname(path)
+
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        # Write to a temporary file first, so readers never see a partially written payload.
+        fd, temp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                if hasattr(data, 'read'):
+                    shutil.copyfileobj(data, f)
+                else:
+                    f.write(data)
+            os.rename(temp_path, path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+    def get(self, key):
+        with open(self._path(key), 'rb') as f:
+            return f.read()
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+register(FileSystem)
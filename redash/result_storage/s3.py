@@ -0,0 +1,56 @@
+import logging
+
+from redash import settings
+from redash.result_storage import BaseResultStorage, register
+
+logger = logging.getLogger(__name__)
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+    enabled = True
+except ImportError:
+    enabled = False
+
+
+class S3(BaseResultStorage):
+    """
+    Stores payloads in an S3 bucket. Any S3 compatible service (MinIO, Ceph, ...) can be used by setting
+    REDASH_RESULT_STORAGE_S3_ENDPOINT_URL.
+    """
+
+    @classmethod
+    def enabled(cls):
+        return enabled
+
+    def __init__(self):
+        self.bucket = settings.RESULT_STORAGE_S3_BUCKET
+        self.prefix = settings.RESULT_STORAGE_S3_PREFIX
+        self.client = boto3.client('s3',
+                                   endpoint_url=settings.RESULT_STORAGE_S3_ENDPOINT_URL or None,
+                                   region_name=settings.RESULT_STORAGE_S3_REGION or None,
+                                   aws_access_key_id=settings.RESULT_STORAGE_S3_ACCESS_KEY_ID or None,
+                                   aws_secret_access_key=settings.RESULT_STORAGE_S3_SECRET_ACCESS_KEY or None)
+
+    def _key(self, key):
+        return self.prefix + key
+
+    def put(self, key, data):
+        if hasattr(data, 'read'):
+            # Uploaded in parts, so large payloads aren't read in full.
+            self.client.upload_fileobj(data, self.bucket, self._key(key))
+        else:
+            self.client.put_object(Bucket=self.bucket, Key=self._key(key), Body=data)
+
+    def get(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=self._key(key))['Body'].read()
+
+    def delete(self, key):
+        try:
+            self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchKey':
+                raise
+
+
+register(S3)
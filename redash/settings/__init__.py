@@ -1,5 +1,6 @@
 import importlib
 import os
+import tempfile
 
 from flask_talisman import talisman
 from funcy import distinct, remove
@@ -39,6 +40,14 @@ QUERY_RESULTS_CLEANUP_ENABLED = parse_boolean(os.environ.get("REDASH_QUERY_RESUL
 QUERY_RESULTS_CLEANUP_COUNT = int(os.environ.get("REDASH_QUERY_RESULTS_CLEANUP_COUNT", "100"))
 QUERY_RESULTS_CLEANUP_MAX_AGE = int(os.environ.get("REDASH_QUERY_RESULTS_CLEANUP_MAX_AGE", "7"))
 
+# Query runners hand their rows over in batches of this size, and the serialized result is spooled to a temporary
+# file once it grows beyond QUERY_RESULTS_SPOOL_MAX_SIZE bytes.
+QUERY_RESULTS_ROW_BATCH_SIZE = int(os.environ.get("REDASH_QUERY_RESULTS_ROW_BATCH_SIZE", "1000"))
+QUERY_RESULTS_SPOOL_MAX_SIZE = int(os.environ.get("REDASH_QUERY_RESULTS_SPOOL_MAX_SIZE", 10 * 1024 * 1024))
+# Format new query results are stored in: "json" or "columnar" (see redash.utils.columnar). Results stored in either
+# format can always be read back.
+QUERY_RESULTS_STORAGE_FORMAT = os.environ.get("REDASH_QUERY_RESULTS_STORAGE_FORMAT", "json")
+
 SCHEMAS_REFRESH_SCHEDULE = int(os.environ.get("REDASH_SCHEMAS_REFRESH_SCHEDULE", 30))
 SCHEMAS_REFRESH_QUEUE = os.environ.get("REDASH_SCHEMAS_REFRESH_QUEUE", "celery")
 
@@ -181,6 +190,10 @@ LDAP_SEARCH_DN = os.environ.get('REDASH_LDAP_SEARCH_DN', os.environ.get('REDASH_
 STATIC_ASSETS_PATH = fix_assets_path(os.environ.get("REDASH_STATIC_ASSETS_PATH", "../client/dist/"))
 
 JOB_EXPIRY_TIME = int(os.environ.get("REDASH_JOB_EXPIRY_TIME", 3600 * 12))
+# Queries over their data source's or org's concurrency limit (see dynamic_settings.query_concurrency_limits) are
+# retried after this many seconds (times their turn, see redash.tasks.queries.QueryAdmission).
+QUERY_ADMISSION_RETRY_INTERVAL = int(os.environ.get("REDASH_QUERY_ADMISSION_RETRY_INTERVAL", 5))
+QUERY_ADMISSION_MAX_RETRY_INTERVAL = int(os.environ.get("REDASH_QUERY_ADMISSION_MAX_RETRY_INTERVAL", 300))
 
 LOG_LEVEL = os.environ.get("REDASH_LOG_LEVEL", "DEBUG")
 LOG_STDOUT = parse_boolean(os.environ.get('REDASH_LOG_STDOUT', 'false'))
@@ -279,6 +292,69 @@ additional_destinations = array_from_string(os.environ.get("REDASH_ADDITIONAL_DE
 
 DESTINATIONS = distinct(enabled_destinations + additional_destinations)
 
+# Connections of SQL query runners which can reset their sessions (PostgreSQL, MySQL) are kept open and reused by each
+# worker process (see redash.query_runner.connection_pool). Up to SQL_CONNECTION_POOL_MAX_SIZE idle connections are
+# kept per data source.
+SQL_CONNECTION_POOL_ENABLED = parse_boolean(os.environ.get("REDASH_SQL_CONNECTION_POOL_ENABLED", "true"))
+SQL_CONNECTION_POOL_MAX_SIZE = int(os.environ.get("REDASH_SQL_CONNECTION_POOL_MAX_SIZE", "2"))
+SQL_CONNECTION_POOL_MAX_IDLE_TIME = int(os.environ.get("REDASH_SQL_CONNECTION_POOL_MAX_IDLE_TIME", "300"))
+SQL_CONNECTION_POOL_CHECK_AFTER = int(os.environ.get("REDASH_SQL_CONNECTION_POOL_CHECK_AFTER", "30"))
+
+# HTTP based query runners share a keep-alive session per data source (see redash.query_runner.http_session).
+HTTP_SESSION_POOL_SIZE = int(os.environ.get("REDASH_HTTP_SESSION_POOL_SIZE", "10"))
+HTTP_SESSION_RETRIES = int(os.environ.get("REDASH_HTTP_SESSION_RETRIES", "2"))
+HTTP_SESSION_RETRY_BACKOFF = float(os.environ.get("REDASH_HTTP_SESSION_RETRY_BACKOFF", "0.5"))
+HTTP_SESSION_MAX_IDLE_TIME = int(os.environ.get("REDASH_HTTP_SESSION_MAX_IDLE_TIME", "300"))
+
+# Maximum run time (in seconds) of queries exported directly from the data source (e.g. with PostgreSQL's COPY).
+QUERY_EXPORT_TIME_LIMIT = int(os.environ.get("REDASH_QUERY_EXPORT_TIME_LIMIT", "3600"))
+# How long (in seconds) an export waits for the data source to send its first rows before giving up. Has to stay
+# below the web server's worker timeout (gunicorn's default is 30 seconds), or the worker is killed mid-request.
+QUERY_EXPORT_FIRST_CHUNK_TIMEOUT = int(os.environ.get("REDASH_QUERY_EXPORT_FIRST_CHUNK_TIMEOUT", "25"))
+
+# Columns without type information (e.g. of the Query Results and Excel data sources) get their type guessed from
+# their values. When set, only that many (evenly spaced) values of every batch of rows are looked at.
+TYPE_INFERENCE_SAMPLE_SIZE = int(os.environ.get("REDASH_TYPE_INFERENCE_SAMPLE_SIZE", "0"))
+
+# Cached results used by the Query Results data source (cached_query_N tables) are kept as SQLite files in
+# QUERY_RESULTS_TABLE_CACHE_PATH, up to QUERY_RESULTS_TABLE_CACHE_MAX_SIZE bytes. Setting either to empty/0 disables it.
+QUERY_RESULTS_TABLE_CACHE_PATH = os.environ.get("REDASH_QUERY_RESULTS_TABLE_CACHE_PATH",
+                                                os.path.join(tempfile.gettempdir(), "redash_table_cache"))
+QUERY_RESULTS_TABLE_CACHE_MAX_SIZE = int(os.environ.get("REDASH_QUERY_RESULTS_TABLE_CACHE_MAX_SIZE",
+                                                        512 * 1024 * 1024))
+
+# Live queries used by the Query Results data source (query_N tables) run concurrently, up to
+# QUERY_RESULTS_UPSTREAM_CONCURRENCY at a time, each for at most QUERY_RESULTS_UPSTREAM_TIMEOUT seconds (0: no limit).
+# Queries which time out can't be interrupted: they keep running in the background (and their results are dropped).
+QUERY_RESULTS_UPSTREAM_CONCURRENCY = int(os.environ.get("REDASH_QUERY_RESULTS_UPSTREAM_CONCURRENCY", "4"))
+QUERY_RESULTS_UPSTREAM_TIMEOUT = int(os.environ.get("REDASH_QUERY_RESULTS_UPSTREAM_TIMEOUT", "0"))
+
+# Elasticsearch index mappings are cached by each worker process for ELASTICSEARCH_MAPPING_CACHE_TTL seconds (0
+# disables the cache), up to ELASTICSEARCH_MAPPING_CACHE_MAX_FIELDS fields in total. Refreshing the schema drops them.
+ELASTICSEARCH_MAPPING_CACHE_TTL = int(os.environ.get("REDASH_ELASTICSEARCH_MAPPING_CACHE_TTL", "300"))
+ELASTICSEARCH_MAPPING_CACHE_MAX_FIELDS = int(os.environ.get("REDASH_ELASTICSEARCH_MAPPING_CACHE_MAX_FIELDS", "100000"))
+
+# Time series runners (Prometheus, Graphite, InfluxDB) keep the rows of the time windows they fetched, and only fetch
+# what's newer (plus the last TIME_WINDOW_CACHE_OVERLAP seconds) when the window moves. Up to
+# TIME_WINDOW_CACHE_MAX_ROWS rows are kept by each worker process, as Python dicts: 100000 rows take about 50MB (for
+# narrow rows) to well over 100MB (for wide ones) per worker. Disabled (0) by default.
+TIME_WINDOW_CACHE_MAX_ROWS = int(os.environ.get("REDASH_TIME_WINDOW_CACHE_MAX_ROWS", "0"))
+TIME_WINDOW_CACHE_OVERLAP = int(os.environ.get("REDASH_TIME_WINDOW_CACHE_OVERLAP", "120"))
+
+# Query result storage: payloads of at least RESULT_STORAGE_THRESHOLD bytes are written to the given backend
+# ("filesystem" or "s3") instead of the query_results table. Offloading is disabled when no backend is set.
+RESULT_STORAGES = array_from_string(os.environ.get("REDASH_RESULT_STORAGES",
+                                                   "redash.result_storage.filesystem,redash.result_storage.s3"))
+RESULT_STORAGE_BACKEND = os.environ.get("REDASH_RESULT_STORAGE_BACKEND", "")
+RESULT_STORAGE_THRESHOLD = int(os.environ.get("REDASH_RESULT_STORAGE_THRESHOLD", 1024 * 1024))
+RESULT_STORAGE_FILESYSTEM_PATH = os.environ.get("REDASH_RESULT_STORAGE_FILESYSTEM_PATH", "/var/lib/redash/query_results")
+RESULT_STORAGE_S3_BUCKET = os.environ.get("REDASH_RESULT_STORAGE_S3_BUCKET", "")
+RESULT_STORAGE_S3_PREFIX = os.environ.get("REDASH_RESULT_STORAGE_S3_PREFIX", "query_results/")
+RESULT_STORAGE_S3_ENDPOINT_URL = os.environ.get("REDASH_RESULT_STORAGE_S3_ENDPOINT_URL", "")
+RESULT_STORAGE_S3_REGION = os.environ.get("REDASH_RESULT_STORAGE_S3_REGION", "")
+RESULT_STORAGE_S3_ACCESS_KEY_ID = os.environ.get("REDASH_RESULT_STORAGE_S3_ACCESS_KEY_ID", "")
+RESULT_STORAGE_S3_SECRET_ACCESS_KEY = os.environ.get("REDASH_RESULT_STORAGE_S3_SECRET_ACCESS_KEY", "")
+
 EVENT_REPORTING_WEBHOOKS = array_from_string(os.environ.get("REDASH_EVENT_REPORTING_WEBHOOKS", ""))
 
 # Support for Sentry (https://getsentry.com/). Just set your Sentry DSN to enable it:
@@ -9,3 +9,12 @@ def query_time_limit(is_scheduled, user_id, org_id):
     adhoc_time_limit = int_or_none(os.environ.get('REDASH_ADHOC_QUERY_TIME_LIMIT', None))
 
     return scheduled_time_limit if is_scheduled else adhoc_time_limit
+
+
+# Replace this method with your own implementation in case you want to limit how many queries can execute at the same
+# time on certain data sources or orgs. Returns (data source limit, org limit); 0 means unlimited.
+def query_concurrency_limits(data_source_id, org_id):
+    data_source_limit = int_or_none(os.environ.get('REDASH_QUERY_CONCURRENCY_PER_DATA_SOURCE', None))
+    org_limit = int_or_none(os.environ.get('REDASH_QUERY_CONCURRENCY_PER_ORG', None))
+
+    return data_source_limit or 0, org_limit or 0
@@ -3,15 +3,19 @@ import signal
 import time
 
 import redis
+from celery import states
+from celery.backends.base import BaseKeyValueStoreBackend
 from celery.exceptions import SoftTimeLimitExceeded, TimeLimitExceeded
 from celery.result import AsyncResult
+from celery.utils import uuid
 from celery.utils.log import get_task_logger
 from six import text_type
 
 from redash import models, redis_connection, settings, statsd_client
 from redash.query_runner import InterruptException
 from redash.tasks.alerts import check_alerts_for_query
-from redash.utils import gen_query_hash, json_dumps, utcnow, mustache_render
+from redash.utils import dt_from_timestamp, gen_query_hash, json_dumps, utcnow, mustache_render
+from redash.utils.result_writer import get_result_writer
 from redash.worker import celery
 
 logger = get_task_logger(__name__)
@@ -25,6 +29,121 @@ def _unlock(query_hash, data_source_id):
     redis_connection.delete(_job_lock_id(query_hash, data_source_id))
 
 
+# Takes a slot in the data source's and the org's semaphores at once, unless either one is full. Slots are sorted set
+# members scored by their lease expiry, so slots of workers that died are freed once their lease is over. Denied tasks
+# are added to their org's deferred set (scored by when they were first deferred) and get back their rank in it.
+_ADMIT_SCRIPT = """
+local task_id, now, lease_until = ARGV[1], tonumber(ARGV[2]), ARGV[3]
+local data_source_limit, org_limit = tonumber(ARGV[4]), tonumber(ARGV[5])
+
+redis.call('zremrangebyscore', KEYS[1], '-inf', now)
+redis.call('zremrangebyscore', KEYS[2], '-inf', now)
+redis.call('zremrangebyscore', KEYS[3], '-inf', now - tonumber(ARGV[6]))
+
+local reason = nil
+if data_source_limit > 0 and redis.call('zcard', KEYS[1]) >= data_source_limit then
+    reason = 'data_source'
+elseif org_limit > 0 and redis.call('zcard', KEYS[2]) >= org_limit then
+    reason = 'org'
+end
+
+if reason then
+    if not redis.call('zscore', KEYS[3], task_id) then
+        redis.call('zadd', KEYS[3], now, task_id)
+    end
+    redis.call('expire', KEYS[3], ARGV[6])
+    redis.call('set', KEYS[4], reason, 'EX', ARGV[6])
+    return {0, reason, redis.call('zrank', KEYS[3], task_id)}
+end
+
+redis.call('zadd', KEYS[1], lease_until, task_id)
+redis.call('zadd', KEYS[2], lease_until, task_id)
+redis.call('zrem', KEYS[3], task_id)
+redis.call('del', KEYS[4])
+return {1, '', 0}
+"""
+
+
+class QueryAdmission(object):
+    """
+    Limits how many queries execute at the same time per data source and per org (see
+    dynamic_settings.query_concurrency_limits), using Redis semaphores shared by all workers.
+
+    Queries over a limit are deferred: the task is retried later with the same id, so its job lock and status stay
+    in place. To keep orgs with a big backlog from crowding out everyone else, deferred queries of an org come back
+    in turns: the n-th deferred query of an org waits n / limit retry intervals, so every org gets about `limit`
+    attempts per interval however many queries it has waiting.
+    """
+    def __init__(self, task_id, data_source, time_limit=None):
+        self.task_id = task_id
+        self.data_source_id = data_source.id
+        self.org_id = data_source.org_id
+        self.data_source_limit, self.org_limit = settings.dynamic_settings.query_concurrency_limits(
+            data_source.id, data_source.org_id)
+        self.lease = (time_limit or settings.JOB_EXPIRY_TIME) + 60
+
+    @staticmethod
+    def data_source_key(data_source_id):
+        return 'query_admission:data_source:{}'.format(data_source_id)
+
+    @staticmethod
+    def org_key(org_id):
+        return 'query_admission:org:{}'.format(org_id)
+
+    @staticmethod
+    def org_deferred_key(org_id):
+        return 'query_admission:org:{}:deferred'.format(org_id)
+
+    @staticmethod
+    def deferred_reason_key(task_id):
+        return 'query_admission:deferred:{}'.format(task_id)
+
+    @property
+    def limited(self):
+        return self.data_source_limit > 0 or self.org_limit > 0
+
+    def acquire(self):
+        """Returns None when admitted, otherwise the number of seconds to defer the query by."""
+        if not self.limited:
+            return None
+
+        now = time.time()
+        admitted, reason, rank = _admit(keys=[self.data_source_key(self.data_source_id),
+                                              self.org_key(self.org_id),
+                                              self.org_deferred_key(self.org_id),
+                                              self.deferred_reason_key(self.task_id)],
+                                        args=[self.task_id, now, now + self.lease, self.data_source_limit,
+                                              self.org_limit, settings.JOB_EXPIRY_TIME])
+        if admitted:
+            return None
+
+        limit = self.data_source_limit if reason == 'data_source' else self.org_limit
+        countdown = min(settings.QUERY_ADMISSION_RETRY_INTERVAL * (1 + rank // limit),
+                        settings.QUERY_ADMISSION_MAX_RETRY_INTERVAL)
+        logger.info("task=execute_query state=deferred reason=%s ds_id=%d org_id=%d task_id=%s countdown=%d",
+                    reason, self.data_source_id, self.org_id, self.task_id, countdown)
+        return countdown
+
+    def withdraw(self):
+        """For queries that gave up after being deferred (instead of being retried later)."""
+        pipe = redis_connection.pipeline()
+        pipe.zrem(self.org_deferred_key(self.org_id), self.task_id)
+        pipe.delete(self.deferred_reason_key(self.task_id))
+        pipe.execute()
+
+    def release(self):
+        if not self.limited:
+            return
+
+        pipe = redis_connection.pipeline()
+        pipe.zrem(self.data_source_key(self.data_source_id), self.task_id)
+        pipe.zrem(self.org_key(self.org_id), self.task_id)
+        pipe.execute()
+
+
+_admit = redis_connection.register_script(_ADMIT_SCRIPT)
+
+
 class QueryTask(object):
     # TODO: this is mapping to the old Job class statuses. Need to update the client side and remove this
     STATUSES = {
@@ -32,7 +151,9 @@ class QueryTask(object):
         'STARTED': 2,
         'SUCCESS': 3,
         'FAILURE': 4,
-        'REVOKED': 4
+        'REVOKED': 4,
+        # Deferred by QueryAdmission, waiting to be retried.
+        'RETRY': 1
     }
 
     def __init__(self, job_id=None, async_result=None):
@@ -55,7 +176,9 @@ class QueryTask(object):
 
         status = self.STATUSES[task_status]
 
-        if isinstance(result, (TimeLimitExceeded, SoftTimeLimitExceeded)):
+        if task_status == 'RETRY':
+            error = ''
+        elif isinstance(result, (TimeLimitExceeded, SoftTimeLimitExceeded)):
             error = "Query exceeded Redash query execution time limit."
             status = 4
         elif isinstance(result, Exception):
@@ -94,6 +217,29 @@ class QueryTask(object):
         return self._async_result.revoke(terminate=True, signal='SIGINT')
 
 
+def _execute_query_options(query, data_source, user_id, is_api_key, scheduled_query, metadata):
+    if scheduled_query:
+        queue_name = data_source.scheduled_queue_name
+        scheduled_query_id = scheduled_query.id
+    else:
+        queue_name = data_source.queue_name
+        scheduled_query_id = None
+
+    args = (query, data_source.id, metadata, user_id, scheduled_query_id, is_api_key)
+    argsrepr = json_dumps({
+        'org_id': data_source.org_id,
+        'data_source_id': data_source.id,
+        'enqueue_time': time.time(),
+        'scheduled': scheduled_query_id is not None,
+        'query_id': metadata.get('Query ID'),
+        'user_id': user_id
+    })
+
+    time_limit = settings.dynamic_settings.query_time_limit(scheduled_query, user_id, data_source.org_id)
+
+    return dict(args=args, argsrepr=argsrepr, queue=queue_name, time_limit=time_limit)
+
+
 def enqueue_query(query, data_source, user_id, is_api_key=False, scheduled_query=None, metadata={}):
     query_hash = gen_query_hash(query)
     logging.info("Inserting job for %s with metadata=%s", query_hash, metadata)
@@ -120,29 +266,8 @@ def enqueue_query(query, data_source, user_id, is_api_key=False, scheduled_query
             if not job:
                 pipe.multi()
 
-                if scheduled_query:
-                    queue_name = data_source.scheduled_queue_name
-                    scheduled_query_id = scheduled_query.id
-                else:
-                    queue_name = data_source.queue_name
-                    scheduled_query_id = None
-
-                args = (query, data_source.id, metadata, user_id, scheduled_query_id, is_api_key)
-                argsrepr = json_dumps({
-                    'org_id': data_source.org_id,
-                    'data_source_id': data_source.id,
-                    'enqueue_time': time.time(),
-                    'scheduled': scheduled_query_id is not None,
-                    'query_id': metadata.get('Query ID'),
-                    'user_id': user_id
-                })
-
-                time_limit = settings.dynamic_settings.query_time_limit(scheduled_query, user_id, data_source.org_id)
-
-                result = execute_query.apply_async(args=args,
-                                                   argsrepr=argsrepr,
-                                                   queue=queue_name,
-                                                   time_limit=time_limit)
+                result = execute_query.apply_async(**_execute_query_options(query, data_source, user_id, is_api_key,
+                                                                            scheduled_query, metadata))
 
                 job = QueryTask(async_result=result)
                 logging.info("[%s] Created new job: %s", query_hash, job.id)
@@ -159,14 +284,130 @@ def enqueue_query(query, data_source, user_id, is_api_key=False, scheduled_query
     return job
 
 
+def _finished_job_ids(job_ids):
+    """
+    Returns the ids of the given jobs that are done. Key/value result backends (like Redis) are read with a single
+    MGET instead of one lookup per job.
+    """
+    backend = celery.backend
+    if not isinstance(backend, BaseKeyValueStoreBackend):
+        return set(job_id for job_id in job_ids if QueryTask(job_id=job_id).ready())
+
+    metas = backend.mget([backend.get_key_for_task(job_id) for job_id in job_ids]) if job_ids else []
+    return set(job_id for job_id, meta in zip(job_ids, metas)
+               if meta and backend.decode_result(meta)['status'] in states.READY_STATES)
+
+
+def _remove_stale_lock(lock_id, job_id):
+    """Removes a job lock, unless it was taken by another job since it was found held by `job_id`."""
+    pipe = redis_connection.pipeline()
+    try:
+        pipe.watch(lock_id)
+        if pipe.get(lock_id) == job_id:
+            pipe.multi()
+            pipe.delete(lock_id)
+            pipe.execute()
+    except redis.WatchError:
+        pass
+    finally:
+        pipe.reset()
+
+
+def _take_held_lock(lock_id, task_id):
+    """
+    Called when taking a job lock failed. Returns the id of the job holding the lock or, when the lock expired in the
+    meantime, takes it for `task_id` and returns None.
+    """
+    for _ in range(5):
+        job_id = redis_connection.get(lock_id)
+        if job_id:
+            return job_id
+        if redis_connection.set(lock_id, task_id, ex=settings.JOB_EXPIRY_TIME, nx=True):
+            return None
+
+    raise redis.WatchError("Job lock {} keeps changing.".format(lock_id))
+
+
+def enqueue_queries(queries):
+    """
+    Bulk version of enqueue_query, for many queries at once (like the scheduler's due queries). `queries` is a list
+    of (query, data_source, user_id, scheduled_query, metadata) tuples. Existing jobs are looked up with a single
+    MGET, job locks are taken with one pipelined round of SET NX and all tasks are published over one producer
+    connection. Returns the job of each query, in the same order.
+    """
+    lock_ids = [_job_lock_id(gen_query_hash(query), data_source.id) for query, data_source, _, _, _ in queries]
+    jobs = [None] * len(queries)
+
+    job_ids = redis_connection.mget(lock_ids) if lock_ids else []
+    finished_job_ids = _finished_job_ids([job_id for job_id in job_ids if job_id])
+    for i, job_id in enumerate(job_ids):
+        if job_id in finished_job_ids:
+            logging.info("[%s] job found is ready (%s), removing lock", lock_ids[i], job_id)
+            _remove_stale_lock(lock_ids[i], job_id)
+        elif job_id:
+            jobs[i] = QueryTask(job_id=job_id)
+
+    pending = {}
+    for i, lock_id in enumerate(lock_ids):
+        # The same query can be due more than once in a batch (e.g. for different schedules); enqueue it once.
+        if jobs[i] is None and lock_id not in pending:
+            pending[lock_id] = i
+
+    # Task ids are generated upfront so the locks can be taken before publishing.
+    task_ids = [(lock_id, uuid()) for lock_id in pending]
+
+    pipe = redis_connection.pipeline(transaction=False)
+    for lock_id, task_id in task_ids:
+        pipe.set(lock_id, task_id, ex=settings.JOB_EXPIRY_TIME, nx=True)
+    locked = pipe.execute()
+
+    failed_lock_ids = []
+    with celery.producer_or_acquire() as producer:
+        for (lock_id, task_id), acquired in zip(task_ids, locked):
+            i = pending[lock_id]
+            if not acquired:
+                try:
+                    job_id = _take_held_lock(lock_id, task_id)
+                except redis.WatchError:
+                    logging.exception("[Manager][%s] Failed adding job for query.", lock_id)
+                    continue
+
+                if job_id:
+                    # Someone else enqueued this query in the meantime.
+                    jobs[i] = QueryTask(job_id=job_id)
+                    continue
+
+            query, data_source, user_id, scheduled_query, metadata = queries[i]
+            try:
+                result = execute_query.apply_async(task_id=task_id, producer=producer,
+                                                   **_execute_query_options(query, data_source, user_id, False,
+                                                                            scheduled_query, metadata))
+                jobs[i] = QueryTask(async_result=result)
+                logging.info("[%s] Created new job: %s", lock_id, task_id)
+            except Exception:
+                logging.exception("[Manager][%s] Failed adding job for query.", lock_id)
+                failed_lock_ids.append(lock_id)
+
+    if failed_lock_ids:
+        redis_connection.delete(*failed_lock_ids)
+
+    for i, lock_id in enumerate(lock_ids):
+        if jobs[i] is None and lock_id in pending:
+            jobs[i] = jobs[pending[lock_id]]
+
+    return jobs
+
+
 @celery.task(name="redash.tasks.refresh_queries")
 def refresh_queries():
     logger.info("Refreshing queries...")
 
     outdated_queries_count = 0
     query_ids = []
+    now = utcnow()
 
     with statsd_client.timer('manager.outdated_queries_lookup'):
+        due_queries = []
         for query in models.Query.outdated_queries():
             if settings.FEATURE_DISABLE_REFRESH_QUERIES:
                 logging.info("Disabled refresh queries.")
@@ -185,27 +426,36 @@ def refresh_queries():
                 else:
                     query_text = query.query_text
 
-                enqueue_query(query_text, query.data_source, query.user_id,
-                              scheduled_query=query,
-                              metadata={'Query ID': query.id, 'Username': 'Scheduled'})
+                due_queries.append((query_text, query.data_source, query.user_id, query,
+                                    {'Query ID': query.id, 'Username': 'Scheduled'}))
 
                 query_ids.append(query.id)
                 outdated_queries_count += 1
 
+        jobs = enqueue_queries(due_queries)
+        for (_, _, _, query, _), job in zip(due_queries, jobs):
+            # Not due again until the next iteration; set precisely once the execution finishes. Queries that
+            # couldn't be enqueued are left due, to be picked up by the next pass.
+            if job is not None:
+                query.schedule_next_run(now)
+                query.skip_updated_at = True
+        models.db.session.commit()
+
     statsd_client.gauge('manager.outdated_queries', outdated_queries_count)
 
     logger.info("Done refreshing queries. Found %d outdated queries: %s" % (outdated_queries_count, query_ids))
 
     status = redis_connection.hgetall('redash:status')
-    now = time.time()
+    refreshed_at = time.time()
 
     redis_connection.hmset('redash:status', {
         'outdated_queries_count': outdated_queries_count,
-        'last_refresh_at': now,
+        'last_refresh_at': refreshed_at,
         'query_ids': json_dumps(query_ids)
     })
 
-    statsd_client.gauge('manager.seconds_since_refresh', now - float(status.get('last_refresh_at', now)))
+    statsd_client.gauge('manager.seconds_since_refresh',
+                        refreshed_at - float(status.get('last_refresh_at', refreshed_at)))
 
 
 @celery.task(name="redash.tasks.cleanup_query_results")
@@ -221,14 +471,22 @@ def cleanup_query_results():
     logging.info("Running query results clean up (removing maximum of %d unused results, that are %d days old or more)",
                  settings.QUERY_RESULTS_CLEANUP_COUNT, settings.QUERY_RESULTS_CLEANUP_MAX_AGE)
 
-    unused_query_results = models.QueryResult.unused(settings.QUERY_RESULTS_CLEANUP_MAX_AGE).limit(
-        settings.QUERY_RESULTS_CLEANUP_COUNT)
-    deleted_count = models.QueryResult.query.filter(
-        models.QueryResult.id.in_(unused_query_results.subquery())
-    ).delete(synchronize_session=False)
+    # The ids are read once, so the payloads removed below are those of the rows actually deleted.
+    unused_ids = [result.id for result in models.QueryResult.unused(settings.QUERY_RESULTS_CLEANUP_MAX_AGE).limit(
+        settings.QUERY_RESULTS_CLEANUP_COUNT)]
+
+    data_locations = []
+    deleted_count = 0
+    if unused_ids:
+        unused_query_results = models.QueryResult.query.filter(models.QueryResult.id.in_(unused_ids))
+        data_locations = [location for location, in unused_query_results.with_entities(
+            models.QueryResult.data_location).filter(models.QueryResult.data_location.isnot(None))]
+        deleted_count = unused_query_results.delete(synchronize_session=False)
     models.db.session.commit()
     logger.info("Deleted %d unused query results.", deleted_count)
 
+    models.QueryResult.delete_stored_data(data_locations)
+
 
 @celery.task(name="redash.tasks.refresh_schema", time_limit=90, soft_time_limit=60)
 def refresh_schema(data_source_id):
@@ -307,9 +565,6 @@ class QueryExecutor(object):
         models.db.session.close()
         self.query_hash = gen_query_hash(self.query)
         self.scheduled_query = scheduled_query
-        # Load existing tracker or create a new one if the job was created before code update:
-        if scheduled_query:
-            models.scheduled_queries_executions.update(scheduled_query.id)
 
     def run(self):
         signal.signal(signal.SIGINT, signal_handler)
@@ -321,17 +576,36 @@ class QueryExecutor(object):
         query_runner = self.data_source.query_runner
         annotated_query = self._annotate_query(query_runner)
 
+        writer = get_result_writer()
+        try:
+            return self._run(query_runner, annotated_query, started_at, writer)
+        finally:
+            # Holds the serialized result until it's stored.
+            writer.close()
+
+    def _run(self, query_runner, annotated_query, started_at, writer):
+        stream = None
         try:
-            data, error = query_runner.run_query(annotated_query, self.user)
+            stream, error = query_runner.run_query_stream(annotated_query, self.user)
+            if stream is not None:
+                # Rows are serialized batch by batch as the runner produces them, and the output is handed over to
+                # store_result as is: it's only read in full when it goes to the data column.
+                writer.write(stream)
+                data = writer
+            else:
+                data = None
         except Exception as e:
             error = text_type(e)
             data = None
             logging.warning('Unexpected error while running query:', exc_info=1)
+        finally:
+            if stream is not None:
+                stream.close()
 
         run_time = time.time() - started_at
 
-        logger.info(u"task=execute_query query_hash=%s data_length=%s error=[%s]", self.query_hash, data and len(data),
-                    error)
+        logger.info(u"task=execute_query query_hash=%s data_length=%s error=[%s]", self.query_hash,
+                    data and data.size, error)
 
         _unlock(self.query_hash, self.data_source.id)
 
@@ -340,6 +614,7 @@ class QueryExecutor(object):
             if self.scheduled_query is not None:
                 self.scheduled_query = models.db.session.merge(self.scheduled_query, load=False)
                 self.scheduled_query.schedule_failures += 1
+                self.scheduled_query.schedule_next_run(dt_from_timestamp(started_at))
                 models.db.session.add(self.scheduled_query)
             models.db.session.commit()
             raise result
@@ -391,12 +666,24 @@ class QueryExecutor(object):
 
 # user_id is added last as a keyword argument for backward compatability -- to support executing previously submitted
 # jobs before the upgrade to this version.
-@celery.task(name="redash.tasks.execute_query", bind=True, track_started=True)
+@celery.task(name="redash.tasks.execute_query", bind=True, track_started=True, max_retries=None)
 def execute_query(self, query, data_source_id, metadata, user_id=None,
                   scheduled_query_id=None, is_api_key=False):
-    if scheduled_query_id is not None:
-        scheduled_query = models.Query.query.get(scheduled_query_id)
-    else:
-        scheduled_query = None
-    return QueryExecutor(self, query, data_source_id, user_id, is_api_key, metadata,
-                         scheduled_query).run()
+    data_source = models.DataSource.query.get(data_source_id)
+    hard_time_limit = (self.request.timelimit or (None, None))[0]
+    admission = QueryAdmission(self.request.id, data_source, hard_time_limit)
+
+    countdown = admission.acquire()
+    if countdown is not None:
+        models.db.session.close()
+        raise self.retry(countdown=countdown)
+
+    try:
+        if scheduled_query_id is not None:
+            scheduled_query = models.Query.query.get(scheduled_query_id)
+        else:
+            scheduled_query = None
+        return QueryExecutor(self, query, data_source_id, user_id, is_api_key, metadata,
+                             scheduled_query).run()
+    finally:
+        admission.release()
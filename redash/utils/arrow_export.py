@@ -0,0 +1,138 @@
+"""
+Parquet and Arrow IPC (file format) exports of query results. Column types come from the result's column metadata,
+so consumers get typed data without re-inferring it. Each batch of rows is written as its own row group / record
+batch, so only one batch is converted at a time. Requires pyarrow.
+"""
+import datetime
+import logging
+
+import pytz
+from dateutil import parser
+from six import string_types, text_type
+
+from redash.query_runner import (TYPE_BOOLEAN, TYPE_DATE, TYPE_DATETIME, TYPE_FLOAT, TYPE_INTEGER,
+                                 TYPE_STRING)
+from redash.utils import json_dumps
+
+logger = logging.getLogger(__name__)
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+    enabled = True
+except ImportError:
+    enabled = False
+
+ROW_GROUP_SIZE = 10000
+
+
+def _to_integer(value):
+    if isinstance(value, float) and not value.is_integer():
+        raise ValueError("Not an integer: {}".format(value))
+    return int(value)
+
+
+def _to_boolean(value):
+    if isinstance(value, string_types):
+        if value.lower() in ('true', 't', 'yes', '1'):
+            return True
+        if value.lower() in ('false', 'f', 'no', '0'):
+            return False
+        raise ValueError("Not a boolean: {}".format(value))
+    return bool(value)
+
+
+def _to_string(value):
+    if isinstance(value, string_types):
+        return value
+    if isinstance(value, (dict, list)):
+        return json_dumps(value)
+    return text_type(value)
+
+
+def _to_datetime(value):
+    if not isinstance(value, datetime.datetime):
+        value = parser.parse(value)
+    if value.tzinfo is not None:
+        value = value.astimezone(pytz.utc).replace(tzinfo=None)
+    return value
+
+
+def _to_date(value):
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    return parser.parse(value).date()
+
+
+def _column_types():
+    return {
+        TYPE_INTEGER: (pyarrow.int64(), _to_integer),
+        TYPE_FLOAT: (pyarrow.float64(), float),
+        TYPE_BOOLEAN: (pyarrow.bool_(), _to_boolean),
+        TYPE_STRING: (pyarrow.string(), _to_string),
+        # Timestamps are written in UTC.
+        TYPE_DATETIME: (pyarrow.timestamp('us'), _to_datetime),
+        TYPE_DATE: (pyarrow.date32(), _to_date),
+    }
+
+
+class _BatchConverter(object):
+    def __init__(self, columns):
+        column_types = _column_types()
+        default = column_types[TYPE_STRING]
+
+        self.names = [column['name'] for column in columns]
+        self.types = []
+        self.converters = []
+        for column in columns:
+            arrow_type, converter = column_types.get(column.get('type'), default)
+            self.types.append(arrow_type)
+            self.converters.append(converter)
+
+        self.schema = pyarrow.schema([pyarrow.field(name, arrow_type)
+                                      for name, arrow_type in zip(self.names, self.types)])
+        self.failed = set()
+
+    def _convert(self, name, converter, value):
+        if value is None:
+            return None
+        try:
+            return converter(value)
+        except (ValueError, TypeError, OverflowError):
+            if name not in self.failed:
+                logger.warning("Can't convert value %r of column %s, writing null instead.", value, name)
+                self.failed.add(name)
+            return None
+
+    def convert(self, rows):
+        arrays = []
+        for name, arrow_type, converter in zip(self.names, self.types, self.converters):
+            values = [self._convert(name, converter, row.get(name)) for row in rows]
+            arrays.append(pyarrow.array(values, type=arrow_type))
+        return pyarrow.RecordBatch.from_arrays(arrays, self.names)
+
+
+def write_parquet(filename, columns, batches):
+    converter = _BatchConverter(columns)
+    writer = pyarrow.parquet.ParquetWriter(filename, converter.schema, compression='snappy')
+    try:
+        for rows in batches:
+            if rows:
+                writer.write_table(pyarrow.Table.from_batches([converter.convert(rows)]))
+    finally:
+        writer.close()
+
+
+def write_arrow(filename, columns, batches):
+    converter = _BatchConverter(columns)
+    sink = pyarrow.OSFile(filename, 'wb')
+    writer = pyarrow.RecordBatchFileWriter(sink, converter.schema)
+    try:
+        for rows in batches:
+            if rows:
+                writer.write_batch(converter.convert(rows))
+    finally:
+        writer.close()
+        sink.close()
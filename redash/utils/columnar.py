@@ -0,0 +1,363 @@
+"""
+Compact columnar encoding for query result data.
+
+Instead of a JSON list of row objects, rows are split into chunks of CHUNK_ROWS and every column of a chunk is
+stored as its own zlib compressed block, holding a typed array (64 bit integers, doubles, booleans), dictionary
+encoded strings or, for anything else, a JSON list. A payload looks like:
+
+    MAGIC, VERSION (1 byte) | column blocks ... | header (JSON) | header length (uint32, little endian)
+
+The header lists the column metadata and where each block lives, so readers only decompress the columns and the
+chunks (row ranges) they actually need. Decoded values are the same as those of a JSON round trip of the rows.
+"""
+import bisect
+import hashlib
+import struct
+import tempfile
+import zlib
+from itertools import izip
+
+from redash import settings
+from redash.utils import json_dumps, json_loads
+
+MAGIC = 'RDCOL'
+VERSION = 1
+CHUNK_ROWS = 10000
+
+# Marks a key which is absent from a row (as opposed to being null).
+MISSING = object()
+
+_STATE_VALUE, _STATE_NULL, _STATE_MISSING = 0, 1, 2
+_LENGTH = struct.Struct('<I')
+_INT64_MIN, _INT64_MAX = -2 ** 63, 2 ** 63 - 1
+_JSON_NATIVE_TYPES = (str, unicode, int, long, bool)
+
+
+def is_columnar(payload):
+    return payload is not None and payload[:len(MAGIC)] == MAGIC
+
+
+def _encode_dictionary(values):
+    indexes = {}
+    dictionary = []
+    codes = []
+
+    for value in values:
+        code = indexes.get(value)
+        if code is None:
+            code = indexes[value] = len(dictionary)
+            dictionary.append(value)
+        codes.append(code)
+
+    if len(dictionary) < 2 ** 8:
+        width = 'B'
+    elif len(dictionary) < 2 ** 16:
+        width = 'H'
+    else:
+        width = 'I'
+
+    encoded_dictionary = json_dumps(dictionary)
+    body = _LENGTH.pack(len(encoded_dictionary)) + encoded_dictionary + struct.pack('<%d%s' % (len(codes), width),
+                                                                                    *codes)
+    return len(dictionary), width, body
+
+
+def _encode_values(values):
+    """Returns the encoding name, index width (for dictionaries) and the encoded body of non null values."""
+    if not values:
+        return 'none', None, ''
+
+    types = set(type(v) for v in values)
+
+    if types == {bool}:
+        return 'bool', None, str(bytearray(values))
+
+    if types <= {int, long} and _INT64_MIN <= min(values) and max(values) <= _INT64_MAX:
+        return 'int', None, struct.pack('<%dq' % len(values), *values)
+
+    if types == {float}:
+        return 'float', None, struct.pack('<%dd' % len(values), *values)
+
+    if types <= {str, unicode}:
+        dictionary_size, width, body = _encode_dictionary(values)
+        # Dictionary encoding only pays off when values repeat.
+        if dictionary_size <= len(values) / 2:
+            return 'dict', width, body
+
+    return 'json', None, json_dumps(values)
+
+
+def _decode_values(encoding, width, body, count):
+    if encoding == 'none':
+        return []
+
+    if encoding == 'bool':
+        return [b == 1 for b in bytearray(body)]
+
+    if encoding == 'int':
+        return list(struct.unpack('<%dq' % count, body))
+
+    if encoding == 'float':
+        return list(struct.unpack('<%dd' % count, body))
+
+    if encoding == 'dict':
+        dictionary_length, = _LENGTH.unpack_from(body)
+        start = _LENGTH.size
+        dictionary = json_loads(body[start:start + dictionary_length])
+        codes = struct.unpack_from('<%d%s' % (count, width), body, start + dictionary_length)
+        return [dictionary[code] for code in codes]
+
+    if encoding == 'json':
+        return json_loads(body)
+
+    raise ValueError("Unknown columnar encoding: {}".format(encoding))
+
+
+class ColumnarResultWriter(object):
+    """
+    Encodes a ResultStream into the columnar format, one chunk of rows at a time. Has the same interface as
+    JSONResultWriter.
+    """
+
+    def __init__(self, chunk_rows=CHUNK_ROWS):
+        self.file = tempfile.SpooledTemporaryFile(max_size=settings.QUERY_RESULTS_SPOOL_MAX_SIZE)
+        self.chunk_rows = chunk_rows
+        self.row_count = 0
+        self.size = 0
+        self.fields = []
+        self._field_indexes = {}
+        self._chunks = []
+        self._hash = hashlib.sha256()
+
+    @property
+    def checksum(self):
+        return self._hash.hexdigest()
+
+    def _write(self, data):
+        self.file.write(data)
+        self._hash.update(data)
+        self.size += len(data)
+
+    def write(self, stream):
+        self._json_encoder = stream.json_encoder
+        self._json_options = stream.json_options
+        self._default = stream.json_encoder().default
+
+        self._write(MAGIC + chr(VERSION))
+
+        pending = []
+        for batch in stream:
+            pending.extend(batch)
+            while len(pending) >= self.chunk_rows:
+                self._write_chunk(pending[:self.chunk_rows])
+                pending = pending[self.chunk_rows:]
+
+        if pending:
+            self._write_chunk(pending)
+
+        header = json_dumps({
+            'columns': stream.columns,
+            'fields': self.fields,
+            'row_count': self.row_count,
+            'chunks': self._chunks
+        }, cls=self._json_encoder, **self._json_options)
+
+        self._write(header)
+        self._write(_LENGTH.pack(len(header)))
+
+    def _normalize(self, value):
+        """Converts a value to what a JSON round trip with the stream's encoder would give back."""
+        if value is None or isinstance(value, _JSON_NATIVE_TYPES):
+            return value
+
+        if isinstance(value, float):
+            if value != value or value in (float('inf'), float('-inf')):
+                return None if self._json_options.get('ignore_nan') else value
+            return value
+
+        if isinstance(value, (dict, list, tuple)):
+            return json_loads(json_dumps(value, cls=self._json_encoder, **self._json_options))
+
+        return self._normalize(self._default(value))
+
+    def _write_chunk(self, rows):
+        for row in rows:
+            for field in row:
+                if field not in self._field_indexes:
+                    self._field_indexes[field] = len(self.fields)
+                    self.fields.append(field)
+
+        blocks = []
+        for index, field in enumerate(self.fields):
+            states = bytearray(len(rows))
+            values = []
+            missing = 0
+
+            for i, row in enumerate(rows):
+                value = row.get(field, MISSING)
+                if value is MISSING:
+                    states[i] = _STATE_MISSING
+                    missing += 1
+                    continue
+
+                value = self._normalize(value)
+                if value is None:
+                    states[i] = _STATE_NULL
+                else:
+                    values.append(value)
+
+            if len(values) == len(rows):
+                states = bytearray()
+            elif missing == len(rows):
+                # Fields absent from a whole chunk need no block at all.
+                continue
+
+            encoding, width, body = _encode_values(values)
+            block = zlib.compress(str(states) + body, 1)
+            blocks.append([index, self.size, len(block), encoding, width, len(values)])
+            self._write(block)
+
+        self._chunks.append({'rows': len(rows), 'blocks': blocks})
+        self.row_count += len(rows)
+
+    def getvalue(self):
+        self.file.seek(0)
+        return self.file.read()
+
+    def open(self):
+        self.file.seek(0)
+        return self.file
+
+    def close(self):
+        self.file.close()
+
+
+class ColumnarReader(object):
+    """Random access to a columnar payload: decodes only the requested columns and row ranges."""
+
+    def __init__(self, payload):
+        if not is_columnar(payload):
+            raise ValueError("Not a columnar query result payload.")
+
+        version = ord(payload[len(MAGIC)])
+        if version != VERSION:
+            raise ValueError("Unsupported columnar query result version: {}".format(version))
+
+        header_length, = _LENGTH.unpack(payload[-_LENGTH.size:])
+        header = json_loads(payload[-_LENGTH.size - header_length:-_LENGTH.size])
+
+        self.payload = payload
+        self.columns = header['columns']
+        self.fields = header['fields']
+        self.row_count = header['row_count']
+        self._field_indexes = {field: i for i, field in enumerate(self.fields)}
+        self._chunks = []
+
+        start = 0
+        for chunk in header['chunks']:
+            blocks = {block[0]: block[1:] for block in chunk['blocks']}
+            self._chunks.append((start, chunk['rows'], blocks))
+            start += chunk['rows']
+
+    def _decode_block(self, block, rows):
+        offset, length, encoding, width, count = block
+        data = zlib.decompress(self.payload[offset:offset + length])
+
+        if count == rows:
+            return _decode_values(encoding, width, data, count)
+
+        values = iter(_decode_values(encoding, width, data[rows:], count))
+        return [next(values) if state == _STATE_VALUE else (None if state == _STATE_NULL else MISSING)
+                for state in bytearray(data[:rows])]
+
+    def column_values(self, field, start=0, stop=None):
+        """Values of a column for rows [start, stop), with MISSING where a row doesn't have the key."""
+        stop = self.row_count if stop is None else min(stop, self.row_count)
+        index = self._field_indexes.get(field)
+        values = []
+
+        for chunk_start, rows, blocks in self._chunks:
+            chunk_stop = chunk_start + rows
+            if chunk_stop <= start or chunk_start >= stop:
+                continue
+
+            if index in blocks:
+                chunk_values = self._decode_block(blocks[index], rows)
+            else:
+                chunk_values = [MISSING] * rows
+
+            values.extend(chunk_values[max(start - chunk_start, 0):min(stop, chunk_stop) - chunk_start])
+
+        return values
+
+    def rows(self, fields=None, start=0, stop=None):
+        if fields is None:
+            fields = self.fields
+        stop = self.row_count if stop is None else min(stop, self.row_count)
+
+        rows = [{} for _ in xrange(max(stop - start, 0))]
+        for field in fields:
+            if field not in self._field_indexes:
+                continue
+
+            for row, value in izip(rows, self.column_values(field, start, stop)):
+                if value is not MISSING:
+                    row[field] = value
+
+        return rows
+
+    def iter_batches(self, fields=None):
+        """Yields the rows one chunk at a time."""
+        for start, rows, _ in self._chunks:
+            yield self.rows(fields, start, start + rows)
+
+    def take(self, indexes, fields=None):
+        """Rows at the given positions (in that order), decoding only the chunks they fall in."""
+        if fields is None:
+            fields = self.fields
+
+        chunk_starts = [chunk[0] for chunk in self._chunks]
+        positions = {}
+        for i, index in enumerate(indexes):
+            chunk = bisect.bisect_right(chunk_starts, index) - 1
+            positions.setdefault(chunk, []).append((i, index - chunk_starts[chunk]))
+
+        rows = [{} for _ in indexes]
+        for field in fields:
+            field_index = self._field_indexes.get(field)
+            if field_index is None:
+                continue
+
+            for chunk, chunk_positions in positions.iteritems():
+                _, chunk_rows, blocks = self._chunks[chunk]
+                if field_index not in blocks:
+                    continue
+
+                values = self._decode_block(blocks[field_index], chunk_rows)
+                for i, position in chunk_positions:
+                    if values[position] is not MISSING:
+                        rows[i][field] = values[position]
+
+        return rows
+
+    def sorted_indexes(self, order_by):
+        """Row positions sorted by the given (field, descending) pairs."""
+        indexes = range(self.row_count)
+        # Sorts are stable, so sorting by the least significant key first gives a multi key sort.
+        for field, descending in reversed(order_by):
+            values = [None if value is MISSING else value for value in self.column_values(field)]
+            indexes.sort(key=values.__getitem__, reverse=descending)
+        return indexes
+
+    def to_dict(self, fields=None, offset=0, limit=None, order_by=None):
+        columns = self.columns
+        if fields is not None:
+            columns = [column for column in columns if column['name'] in fields]
+
+        stop = None if limit is None else offset + limit
+        if order_by:
+            rows = self.take(self.sorted_indexes(order_by)[offset:stop], fields)
+        else:
+            rows = self.rows(fields, offset, stop)
+
+        return {'columns': columns, 'rows': rows, 'total_rows': self.row_count}
@@ -0,0 +1,76 @@
+import hashlib
+import tempfile
+
+from six import text_type
+
+from redash import settings
+from redash.utils import json_dumps
+from redash.utils.columnar import ColumnarResultWriter
+
+
+class JSONResultWriter(object):
+    """
+    Serializes a ResultStream into the JSON document stored as query result data, one batch of rows at a time, so
+    the rows never have to be held in memory all at once. Output past QUERY_RESULTS_SPOOL_MAX_SIZE goes to disk.
+
+    Writers are handed over to QueryResult.set_data as they are: the size and checksum of the output are kept as it's
+    written, and payloads going to a result storage backend are copied from the spooled file.
+    """
+
+    def __init__(self):
+        self.file = tempfile.SpooledTemporaryFile(max_size=settings.QUERY_RESULTS_SPOOL_MAX_SIZE)
+        self.row_count = None
+        self.size = 0
+        self._hash = hashlib.sha256()
+
+    @property
+    def checksum(self):
+        return self._hash.hexdigest()
+
+    def _write(self, data):
+        if isinstance(data, text_type):
+            data = data.encode('utf-8')
+        self.file.write(data)
+        self._hash.update(data)
+        self.size += len(data)
+
+    def write(self, stream):
+        if stream.json_data is not None:
+            # Runners that don't stream already serialized their result; store it as is.
+            self._write(stream.json_data)
+            return
+
+        self.row_count = 0
+        self._write('{"rows": [')
+
+        for batch in stream:
+            if not batch:
+                continue
+
+            if self.row_count > 0:
+                self._write(', ')
+            # Serialize the whole batch as a list and drop its brackets, which is much faster than a dump per row.
+            self._write(json_dumps(batch, cls=stream.json_encoder, **stream.json_options)[1:-1])
+            self.row_count += len(batch)
+
+        self._write('], "columns": ')
+        self._write(json_dumps(stream.columns, cls=stream.json_encoder, **stream.json_options))
+        self._write('}')
+
+    def getvalue(self):
+        self.file.seek(0)
+        return self.file.read()
+
+    def open(self):
+        """The output as a file object, positioned at its start."""
+        self.file.seek(0)
+        return self.file
+
+    def close(self):
+        self.file.close()
+
+
+def get_result_writer():
+    if settings.QUERY_RESULTS_STORAGE_FORMAT == 'columnar':
+        return ColumnarResultWriter()
+    return JSONResultWriter()